@@ -11,37 +11,92 @@ Description: 将data和message从缓存(redis, mqtt ...)持久化到数据库(Po
 使用concurrent模块开启异步多线程
 """
 
-import json
+import asyncio
 import logging
 import os
 import threading
 import time
 from concurrent.futures import ThreadPoolExecutor
 # 因为使用了多进程，需要Queue进行跨进程通信，而queue.Queue是进程内通信队列
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Value
+from queue import Empty
 
 import toml
 
-from plugins.parser_postgresql import parse_data
-from utils.database_wrapper import PostgresqlWrapper
-from utils.log_wrapper import setup_logging
-from utils.mqtt_wrapper import subscriber
+from plugins.parser_postgresql import parse_data, reject
+from utils.batch_wrapper import Batcher
+from utils.database_wrapper import AsyncPostgresqlWrapper, PostgresqlWrapper
+from utils.json_wrapper import get_decoder
+from utils import metrics_wrapper as metrics
+from utils.log_wrapper import Summary, setup_logging
+from utils.ring_wrapper import RingBuffer
+from utils.scale_wrapper import Autoscaler
+from utils.mqtt_wrapper import async_subscriber, subscriber
 
 logger = logging.getLogger('DataWizard.main')
 
+# 运行指标
+MESSAGES = metrics.counter('datawizard_messages_total',
+                           'Messages taken from the queue, by topic', ['topic'])
+QUEUE_DEPTH = metrics.gauge('datawizard_queue_depth',
+                            'Items waiting in the queue, by topic', ['topic'])
+PAUSED = metrics.gauge('datawizard_intake_paused_seconds',
+                       'Total time intake was paused by flow control',
+                       ['topic'])
+RING_REJECTED = metrics.gauge('datawizard_ring_rejected_records',
+                              'Records larger than the ring buffer, by topic',
+                              ['topic'])
+DECODE_LATENCY = metrics.histogram('datawizard_decode_seconds',
+                                   'Time to decode one message')
+PARSE_LATENCY = metrics.histogram('datawizard_parse_seconds',
+                                  'Time to parse one message')
+FLUSH_LATENCY = metrics.histogram('datawizard_flush_seconds',
+                                  'Time to flush one batch, by topic',
+                                  ['topic'])
+
+# 热路径日志汇总
+PERSISTED_SUMMARY = Summary(
+    logger,
+    'Persisted %d rows in %d batches (%.3fs) for (%s) in the last %.0fs')
+
 
 class Wizard(object):
     """Data Wizard"""
-    def __init__(self, config):
+    def __init__(self, config, creator=None):
         """Initialize
 
         :config: 总配置信息
+        :creator: 数据库连接的创建者，None表示使用默认驱动（用于基准测试替换数据库）
 
         """
+        self.creator = creator
+        # [log] - Log记录器配置（最先配置，以便记录后续配置检查的结果）
+        log_conf = config.get('log', dict())
+        setup_logging(log_conf)
+
         # [main] - Wizard配置
         main_conf = config.get('main', dict())
         # # 线程池中每个topic的最大worker数，如果未配置则取值当前进程可用CPU核心数x2
         self.number = main_conf.get('number', len(os.sched_getaffinity(0)) * 2)
+        # # JSON解码器，'auto'表示自动选择可用的最快解码器
+        self.decoder_name, self.decoder = get_decoder(
+            main_conf.get('decoder', 'auto'))
+        # # 执行模式：'thread'（单个Wizard进程内的线程池）、'process'（多个Wizard进程）
+        # # 或'asyncio'（数据源和持久化在同一个事件循环中）
+        self.mode = main_conf.get('mode', 'thread').lower()
+        # # 'process'模式的Wizard进程数，如果未配置则取值当前进程可用CPU核心数
+        self.processes = main_conf.get('processes',
+                                       0) or len(os.sched_getaffinity(0))
+        # # 'asyncio'模式同时写入的最大批数（即异步数据库连接数）
+        self.inflight = main_conf.get('inflight', 8)
+        # # 'thread'模式下按队列深度、flush耗时和数据库往返时间自动伸缩每个topic的worker数
+        self.autoscale = main_conf.get('autoscale', False)
+        self.min_workers = main_conf.get('min_workers', 1)
+        self.max_workers = main_conf.get('max_workers', self.number)
+        self.scale_interval = main_conf.get('scale_interval', 5)
+        self.scale_up_depth = main_conf.get('scale_up_depth', 100)
+        self.rtt_limit = main_conf.get('rtt_limit', 0.5)
+        self.autoscaler = None
 
         # [source] - 数据源配置
         source_conf = config.get('source', dict())
@@ -52,87 +107,307 @@ class Wizard(object):
         # [cache] - 缓存配置
         cache_conf = config.get('cache', dict())
         self.cordon = cache_conf.get('cordon', 5000)
+        # # 流控：队列深度达到cordon*high_watermark时暂停订阅，降到cordon*low_watermark时恢复
+        # # （'ring'通道按字节计，见下文）
+        high_watermark = cache_conf.get('high_watermark', 0.8)
+        low_watermark = cache_conf.get('low_watermark', 0.5)
+        self.high_watermark = int(self.cordon * high_watermark)
+        self.low_watermark = int(self.cordon * low_watermark)
+        # # 各topic累计暂停订阅的时长（秒），由数据源进程更新
+        self.paused = {topic: Value('d', 0.0) for topic in self.topics}
+        # # 分批方案：批内行数达到batch_size或等待时间达到linger秒时入库
+        self.batch_size = cache_conf.get('batch_size', 500)
+        self.linger = cache_conf.get('linger', 1)
+        # # 进程间数据通道：'queue'（multiprocessing.Queue）或'ring'（共享内存环形缓冲区）
+        self.transport = cache_conf.get('transport', 'queue').lower()
+        # # 'ring'通道每个topic的缓冲区容量（字节）
+        self.ring_size = cache_conf.get('ring_size', 8 * 1024 * 1024)
+        # # 数据源进程将消息攒成数据块后放入队列：块内消息数达到chunk_size或等待chunk_linger秒
+        self.chunk_size = cache_conf.get('chunk_size', 1)
+        self.chunk_linger = cache_conf.get('chunk_linger', 0.005)
 
         # [storage] - 数据存储配置
         self.storage_conf = storage_conf = config.get('storage', dict())
         self.storage_select = storage_select = storage_conf.get(
             'select', 'postgresql')
-        storage_entity = storage_conf.get(storage_select.lower(), dict())
+        self.storage_entity = storage_conf.get(storage_select.lower(), dict())
+        self.reject_file = self.storage_entity.get('reject_file', str())
 
         # 根据topic数量动态构造数据缓存队列的字典
-        queues = [Queue(maxsize=self.cordon) for _ in range(len(self.topics))]
-        self.queue_dict = dict(zip(self.topics, queues))
+        # 'process'模式下每个topic有processes个分片队列，每个Wizard进程消费其中一个
+        shards = self.processes if self.mode in ['process'] else 1
+        if self.transport in ['ring'] and not self.check_shm(
+                len(self.topics) * shards):
+            self.transport = 'queue'
+        if self.transport in ['ring']:
+            # 环形缓冲区的容量以字节计，水位为ring_size的倍数，队列深度为已用字节数（见Chunker.depth）
+            self.high_watermark = int(self.ring_size * high_watermark)
+            self.low_watermark = int(self.ring_size * low_watermark)
+        if self.mode in ['process']:
+            self.queue_dict = {
+                topic: [self.new_queue() for _ in range(self.processes)]
+                for topic in self.topics
+            }
+        else:
+            self.queue_dict = {topic: self.new_queue() for topic in self.topics}
+
+        # 数据存储客户端在执行持久化的进程中构建（见open_database、start_wizard_shard和run_asyncio），
+        # 其重试线程和回放线程不会随fork进入子进程，连接池的连接也不应由多个进程共用
+        self.database = None
+
+        # [metrics] - 运行指标配置
+        metrics_conf = config.get('metrics', dict())
+        self.metrics_enable = metrics_conf.get('enable', False)
+        self.metrics_host = metrics_conf.get('host', '0.0.0.0')
+        self.metrics_port = metrics_conf.get('port', 9108)
+
+    def check_shm(self, count, path='/dev/shm'):
+        """检查共享内存文件系统能否容纳count个环形缓冲区
+
+        共享内存写满时进程会在写入时收到SIGBUS，而不是在创建时出错，因此须提前检查
+        （例如Docker容器默认的/dev/shm只有64MB）
+
+        :count: 环形缓冲区个数
+        :path: 共享内存文件系统的挂载点
+        :returns: True表示空间足够
 
-        # 构建数据存储客户端
-        if storage_select.lower() in ['postgresql']:
-            self.database = PostgresqlWrapper(conf=storage_entity)
+        """
+        try:
+            stat = os.statvfs(path)
+        except OSError as e:
+            logger.warning('Unable to check free space of {path}: {text}'.
+                           format(path=path, text=e))
+            return True
+
+        need = count * self.ring_size
+        free = stat.f_bavail * stat.f_frsize
+        if need > free:
+            logger.error('Ring buffers need {need} bytes ({count} x ring_size '
+                         '{size}) but {path} has only {free} bytes free, '
+                         'fall back to transport \'queue\'. Lower '
+                         '[cache].ring_size or enlarge {path} (e.g. docker run '
+                         '--shm-size)'.format(need=need,
+                                              count=count,
+                                              size=self.ring_size,
+                                              path=path,
+                                              free=free))
+            return False
+
+        return True
+
+    def new_queue(self):
+        """构造一个数据缓存队列
+
+        :returns: Queue或RingBuffer实例
 
-        # [log] - Log记录器配置
-        log_conf = config.get('log', dict())
-        setup_logging(log_conf)
+        """
+        if self.transport in ['ring']:
+            return RingBuffer(size=self.ring_size)
+        return Queue(maxsize=self.cordon)
+
+    def new_database(self, workers, name='wizard'):
+        """构建数据存储客户端
+
+        :workers: 使用该客户端的worker线程数
+        :name: 客户端名，各Wizard进程须各不相同（用作溢写日志的子目录名）
+        :returns: 数据存储客户端，未支持的存储类型返回None
+
+        """
+        if self.storage_select.lower() in ['postgresql']:
+            return PostgresqlWrapper(conf=self.storage_entity,
+                                     workers=workers,
+                                     spill_name=name,
+                                     creator=self.creator)
+        return None
+
+    def open_database(self):
+        """构建'thread'模式的数据存储客户端（需在执行持久化的进程中调用）
+
+        :returns: 数据存储客户端
+
+        """
+        if self.database is None:
+            # 自动伸缩时按最大worker数确定连接池大小，另留一个连接测量往返时间
+            workers = self.max_workers + 1 if self.autoscale else self.number
+            self.database = self.new_database(workers=len(self.topics) *
+                                              workers)
+
+        return self.database
+
+    def start_metrics(self, queues, offset=0):
+        """启动运行指标HTTP服务（需在执行持久化的进程中调用）
 
-    @staticmethod
-    def convert(raw_data):
+        :queues: 本进程消费的队列字典：{'topic': 队列}，用于采集队列深度
+        :offset: 端口偏移，'process'模式下各Wizard进程分别监听port+序号
+
+        """
+        if not self.metrics_enable:
+            return
+
+        for topic, topic_queue in queues.items():
+            QUEUE_DEPTH.labels(topic).set_function(topic_queue.qsize)
+            PAUSED.labels(topic).set_function(
+                lambda paused=self.paused[topic]: paused.value)
+            if isinstance(topic_queue, RingBuffer):
+                RING_REJECTED.labels(topic).set_function(topic_queue.rejected)
+        metrics.start_server(host=self.metrics_host,
+                             port=self.metrics_port + offset)
+
+    def convert(self, raw_data):
         """解码并加载数据
+
+        直接解码bytes/memoryview，不先转换为str
+
+        :raw_data: 原始数据
         :returns: data
 
         """
-        data_str = raw_data.decode('UTF-8')
-        data = json.loads(data_str)
+        data = self.decoder(raw_data)
 
         return data
 
-    def persistence(self, topic):
-        """数据持久化
+    def parse(self, payload, batcher):
+        """解码并解析一条原始数据，将物料加入批
 
-        :topic: topic name
+        无法解码或解析的原始数据被拒绝（计数并可写入reject_file），不会导致worker退出
+
+        :payload: 原始数据
+        :batcher: Batcher实例
 
         """
-        while True:
-            # 获取原始数据
-            topic_queue = self.queue_dict.get(topic,
-                                              Queue(maxsize=self.cordon))
-            data_bytes = topic_queue.get()
-            size = topic_queue.qsize()
-            logger.info(
-                'Get data from queue ({topic}), queue size = {size}'.format(
-                    topic=topic, size=size))
-
-            # 解析原始数据
-            datas = self.convert(data_bytes)
+        start_time = time.perf_counter()
+        try:
+            datas = self.convert(payload)
+        except ValueError as e:
+            reject(record=bytes(payload).decode('UTF-8', 'replace'),
+                   reason='invalid JSON: {text}'.format(text=e),
+                   sink=self.reject_file)
+            return
+        decode_time = time.perf_counter()
+        DECODE_LATENCY.observe(decode_time - start_time)
+
+        try:
             result = parse_data(flow=self.storage_select,
                                 config=self.storage_conf,
                                 datas=datas)
+        except Exception as e:
+            reject(record=datas,
+                   reason='parse error: {text}'.format(text=e),
+                   sink=self.reject_file)
+            return
+        PARSE_LATENCY.observe(time.perf_counter() - decode_time)
 
-            # 持久化数据
-            start_time = time.time()
-            # # 调用新版数据插入函数
-            for res in result:
-                if res:
-                    self.database.insert(material=res)
-            # # 调用旧版数据插入函数
-            # self.database.insert_oldgen(datas)
-            end_time = time.time()
-            logger.info('Persistence time cost: {cost}s'.format(cost=end_time -
-                                                                start_time))
-
-            # 存活线程计数
-            logger.info("Currently active threads = {count}".format(
-                count=threading.active_count()))
-
-            # 队列已满则阻塞
-            if topic_queue.full():
-                logger.error('Queue {name} is full, so it is blocking'.format(
-                    name=topic))
+        for res in result:
+            batcher.add(res)
+
+    def flush(self, batcher):
+        """将批内数据入库
+
+        :batcher: Batcher实例
+        :returns: 耗时（秒）
+
+        """
+        rows = len(batcher)
+
+        start_time = time.time()
+        # flush期间独占一个连接，每个schema.table只执行一次insert
+        with self.database.checkout():
+            for material in batcher.drain():
+                self.database.insert(material=material)
+        end_time = time.time()
+        logger.debug('Persistence %d rows, time cost: %.3fs', rows,
+                     end_time - start_time)
+
+        return end_time - start_time
+
+    def persistence(self, topic, index=None, stop=None):
+        """数据持久化
+
+        从队列获取数据并合并成批，批内行数达到batch_size或等待时间达到linger秒时入库
+
+        :topic: topic name
+        :index: 'process'模式下的分片序号
+        :stop: 停止事件，被设置后将批内剩余数据入库并退出（用于自动伸缩）
+
+        """
+        topic_queue = self.queue_dict.get(topic, Queue(maxsize=self.cordon))
+        if index is not None:
+            topic_queue = topic_queue[index]
+        batcher = Batcher(size=self.batch_size, linger=self.linger)
+        messages = MESSAGES.labels(topic)
+        flush_latency = FLUSH_LATENCY.labels(topic)
+        # 队列是否已满，只在状态变化时记录日志
+        full = False
+
+        while stop is None or not stop.is_set():
+            # 获取原始数据，批非空时最多等待到时间片截止，有停止事件时至少每秒检查一次
+            timeout = batcher.remaining()
+            if stop is not None:
+                timeout = 1 if timeout is None else min(timeout, 1)
+            try:
+                data_bytes = topic_queue.get(timeout=timeout)
+            except Empty:
+                data_bytes = None
+
+            if data_bytes is not None:
+                # 数据源进程可能将多条消息攒成一个数据块（list）
+                chunk = data_bytes if isinstance(data_bytes,
+                                                 list) else [data_bytes]
+                messages.inc(len(chunk))
+
+                # 解析原始数据并加入批
+                for payload in chunk:
+                    self.parse(payload, batcher)
+
+            # 持久化数据，写入失败的批由数据库客户端重试，不会导致worker退出
+            if batcher.due():
+                rows = len(batcher)
+                try:
+                    cost = self.flush(batcher)
+                except Exception as e:
+                    logger.error('Wizard worker of ({topic}) flush error: '
+                                 '{text}'.format(topic=topic, text=e))
+                    continue
+                flush_latency.observe(cost)
+                PERSISTED_SUMMARY.add(topic, rows, 1, cost)
+                if self.autoscaler is not None:
+                    self.autoscaler.observe(topic=topic, cost=cost)
+
+                # 存活线程计数
+                logger.debug('Currently active threads = %d',
+                             threading.active_count())
+
+            # 队列已满，数据源进程此时已暂停订阅并在本地暂存数据
+            if topic_queue.full() != full:
+                full = not full
+                if full:
+                    logger.error('Queue %s is full, intake paused for %.3fs '
+                                 'in total', topic, self.paused[topic].value)
+                else:
+                    logger.warning('Queue %s is no longer full', topic)
+
+        # 被缩容的worker将批内剩余数据入库后退出，并将连接归还连接池，以便新的worker检出
+        if len(batcher):
+            self.flush(batcher)
+        self.database.release()
+        logger.info('Wizard worker of ({topic}) stopped'.format(topic=topic))
 
     def start_source(self):
         """启动数据源客户端获取数据"""
         logger.info('Get data from {}'.format(self.source_select.upper()))
         if self.source_select.lower() in ['mqtt']:
-            subscriber(queues=self.queue_dict)
+            subscriber(queues=self.queue_dict,
+                       chunk_size=self.chunk_size,
+                       chunk_linger=self.chunk_linger,
+                       high=self.high_watermark,
+                       low=self.low_watermark,
+                       paused=self.paused,
+                       limit=self.cordon)
 
     def start_wizard_threadpool(self):
         """启动持久化函数 -- 线程池版"""
+        self.open_database()
+        self.start_metrics(queues=self.queue_dict)
         # 生成任务列表
         tasks = self.topics * self.number
         # max_workers大小和任务列表长度须一致，否则不能在一个周期内完成所有任务
@@ -140,8 +415,179 @@ class Wizard(object):
                                 thread_name_prefix='Wizard') as executor:
             executor.map(self.persistence, tasks, chunksize=len(self.topics))
 
+    def start_wizard_autoscale(self):
+        """启动持久化函数 -- 自动伸缩版
+
+        每个topic的worker数在[min_workers, max_workers]之间按负载自动增减
+        """
+        self.open_database()
+        self.start_metrics(queues=self.queue_dict)
+
+        def spawn(topic, stop):
+            task = threading.Thread(target=self.persistence,
+                                    args=(topic, None, stop),
+                                    name='Wizard-{}'.format(topic))
+            task.start()
+            return task
+
+        def depth(topic):
+            return self.queue_dict[topic].qsize()
+
+        self.autoscaler = Autoscaler(topics=self.topics,
+                                     spawn=spawn,
+                                     depth=depth,
+                                     ping=self.database.ping,
+                                     min_workers=self.min_workers,
+                                     max_workers=self.max_workers,
+                                     interval=self.scale_interval,
+                                     high=self.scale_up_depth,
+                                     rtt_limit=self.rtt_limit)
+        self.autoscaler.run()
+
+    def start_wizard_shard(self, index):
+        """启动持久化函数 -- 单个分片的Wizard进程
+
+        每个topic只有一个线程消费本分片的队列，从而保证同一设备的数据按顺序入库
+
+        :index: 分片序号
+
+        """
+        # 每个进程使用自己的连接池
+        self.database = self.new_database(
+            workers=len(self.topics), name='shard-{index}'.format(index=index))
+        shard_queues = {
+            topic: topic_queue[index]
+            for topic, topic_queue in self.queue_dict.items()
+        }
+        self.start_metrics(queues=shard_queues, offset=index + 1)
+
+        tasks = list()
+        for topic in self.topics:
+            task = threading.Thread(target=self.persistence,
+                                    args=(topic, index),
+                                    name='Wizard-{}'.format(index))
+            task.start()
+            tasks.append(task)
+        for task in tasks:
+            task.join()
+
+    def start_wizard_process(self):
+        """启动持久化函数 -- 多进程版
+
+        启动processes个Wizard进程，数据按deviceid的哈希值分片，
+        解码和解析分散到多个CPU核心，不受GIL限制
+        """
+        shards = list()
+        for index in range(self.processes):
+            shard = Process(target=self.start_wizard_shard,
+                            args=(index, ),
+                            name='Wizard-{}'.format(index))
+            shard.start()
+            shards.append(shard)
+        logger.info('Started {count} wizard processes'.format(count=len(shards)))
+        for shard in shards:
+            shard.join()
+
+    async def flush_async(self, topic, materials, rows):
+        """将批内数据入库 -- asyncio版
+
+        :topic: topic name
+        :materials: Batcher.drain返回的物料列表
+        :rows: 批内数据行数
+
+        """
+        start_time = time.time()
+        for material in materials:
+            await self.database.insert(material=material)
+        end_time = time.time()
+        FLUSH_LATENCY.labels(topic).observe(end_time - start_time)
+        PERSISTED_SUMMARY.add(topic, rows, 1, end_time - start_time)
+        logger.debug('Persistence %d rows, time cost: %.3fs', rows,
+                     end_time - start_time)
+
+    async def persistence_async(self, topic, topic_queue, inflight):
+        """数据持久化 -- asyncio版
+
+        从asyncio队列获取数据并合并成批，批满后作为独立的任务入库，
+        同时入库的批数受inflight限制，队列读取不会被入库阻塞
+
+        :topic: topic name
+        :topic_queue: 该topic的asyncio.Queue
+        :inflight: 限制同时入库批数的asyncio.Semaphore
+
+        """
+        batcher = Batcher(size=self.batch_size, linger=self.linger)
+        messages = MESSAGES.labels(topic)
+        flushing = set()
+
+        while True:
+            # 获取原始数据，批非空时最多等待到时间片截止
+            try:
+                data_bytes = await asyncio.wait_for(topic_queue.get(),
+                                                    timeout=batcher.remaining())
+            except asyncio.TimeoutError:
+                data_bytes = None
+
+            if data_bytes is not None:
+                messages.inc()
+                # 解析原始数据并加入批
+                self.parse(data_bytes, batcher)
+
+            # 持久化数据
+            if batcher.due():
+                rows = len(batcher)
+                materials = batcher.drain()
+                await inflight.acquire()
+                task = asyncio.create_task(
+                    self.flush_async(topic, materials, rows))
+                flushing.add(task)
+                task.add_done_callback(flushing.discard)
+                task.add_done_callback(lambda _: inflight.release())
+
+    async def run_asyncio(self):
+        """数据源和持久化在同一个事件循环中运行"""
+        self.database = AsyncPostgresqlWrapper(conf=self.storage_entity,
+                                               inflight=self.inflight)
+        await self.database.start()
+
+        inflight = asyncio.Semaphore(self.inflight)
+        queues = {topic: asyncio.Queue() for topic in self.topics}
+        self.start_metrics(queues=queues)
+
+        def handler(name, payload):
+            topic_queue = queues[name]
+            topic_queue.put_nowait(payload)
+            # 队列超过警戒线
+            if topic_queue.qsize() > self.cordon:
+                logger.error('Queue {name} exceeds the cordon ({cordon})'.
+                             format(name=name, cordon=self.cordon))
+
+        tasks = [
+            asyncio.create_task(
+                self.persistence_async(topic, queues[topic], inflight))
+            for topic in self.topics
+        ]
+        logger.info('Get data from {}'.format(self.source_select.upper()))
+        await async_subscriber(handler=handler,
+                               depths={
+                                   topic: topic_queue.qsize
+                                   for topic, topic_queue in queues.items()
+                               },
+                               high=self.high_watermark,
+                               low=self.low_watermark,
+                               paused=self.paused)
+        await asyncio.gather(*tasks)
+
+    def start_wizard_asyncio(self):
+        """启动持久化函数 -- asyncio版
+
+        每个topic一个协程，不论topic多少都只使用一个线程读取数据和写入数据库
+        """
+        asyncio.run(self.run_asyncio())
+
     def start_wizard_thread(self):
         """启动持久化函数 -- 多线程版"""
+        self.open_database()
         logger.info('Get data from {}'.format(self.source_select.upper()))
         for topic in self.topics:
             for num in range(1, self.number + 1):
@@ -161,11 +607,21 @@ if __name__ == "__main__":
     app_version = app_conf.get('version', None)
     logger.info('{name}({version}) start running'.format(name=app_name,
                                                          version=app_version))
-
-    # 创建并启动进程
-    source = Process(target=wizard.start_source)
-    wizard = Process(target=wizard.start_wizard_threadpool)
-    source.start()
-    wizard.start()
-    source.join()
-    wizard.join()
+    logger.info('JSON decoder: {name}'.format(name=wizard.decoder_name))
+
+    # 'asyncio'模式下数据源和持久化都在当前进程的事件循环中运行
+    if wizard.mode in ['asyncio']:
+        wizard.start_wizard_asyncio()
+    else:
+        # 创建并启动进程
+        source = Process(target=wizard.start_source)
+        if wizard.mode in ['process']:
+            wizard = Process(target=wizard.start_wizard_process)
+        elif wizard.autoscale:
+            wizard = Process(target=wizard.start_wizard_autoscale)
+        else:
+            wizard = Process(target=wizard.start_wizard_threadpool)
+        source.start()
+        wizard.start()
+        source.join()
+        wizard.join()
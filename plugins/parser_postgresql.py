@@ -11,9 +11,23 @@ Description: 为PostgreSQL进行原始数据解析
 
 import json
 import logging
+import threading
+from functools import lru_cache
+
+from utils import metrics_wrapper as metrics
 
 logger = logging.getLogger('DataWizard.plugins.parser_postgresql')
 
+# INSERT语句模板缓存的最大条目数
+TEMPLATE_CACHE_SIZE = 1024
+
+# 不符合要求而被拒绝的数据计数：{'count': 总数, 'reasons': {原因: 数量}}
+REJECTS = {'count': 0, 'reasons': dict()}
+REJECT_LOCK = threading.Lock()
+# 被拒绝数据的计数指标，按原因的类别（':'之前的部分）区分
+REJECT_COUNTER = metrics.counter('datawizard_rejects_total',
+                                 'Records rejected by the parser', ['reason'])
+
 
 def checker(data):
     """检查数据结构是否符合要求
@@ -59,6 +73,62 @@ def checker(data):
     return result
 
 
+def build_sql(schema, table, columns):
+    """构建INSERT语句
+
+    :schema: schema名
+    :table: table名
+    :columns: 全部列名组成的有序序列
+    :returns: SQL语句
+
+    """
+    SQL = ("INSERT INTO {schema_name}.{table_name} ({column_name}) "
+           "VALUES ({column_value});".format(
+               schema_name=schema,
+               table_name=table,
+               column_name=','.join(columns),
+               column_value=','.join(['%s'] * len(columns))))
+
+    return SQL
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def build_template(schema, table, columns):
+    """构建INSERT语句模板（LRU缓存）
+
+    同一schema.table和列集合的数据只在第一次出现时拼接SQL语句
+
+    :schema: schema名
+    :table: table名
+    :columns: 全部列名组成的元组
+    :returns: (SQL语句, 列名元组)
+
+    """
+    return build_sql(schema=schema, table=table, columns=columns), columns
+
+
+def template_cache_info():
+    """INSERT语句模板缓存的命中情况
+
+    :returns: 字典，结构为：
+              {
+                  'hits': 命中次数,
+                  'misses': 未命中次数,
+                  'size': 当前条目数,
+                  'maxsize': 最大条目数,
+              }
+
+    """
+    info = build_template.cache_info()
+
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'maxsize': info.maxsize,
+    }
+
+
 def fork_message(conf, datas):
     """转储message数据到一个独立的数据表
 
@@ -72,7 +142,8 @@ def fork_message(conf, datas):
                   'column': {
                         'column_1': 'int',
                         'column_2': 'json',
-                  }
+                  },
+                  'columns': ('timestamp', 'deviceid', 'column_1', 'column_2')
               }
 
     """
@@ -86,62 +157,158 @@ def fork_message(conf, datas):
     message_table = message_conf.get('message_table', 'message')
     message_column = message_conf.get('message_column', list())
 
-    # 定义变量
-    column_type = dict()  # 列名及其类型组成的字典
-    columns_name = str()  # 所有列名组成的字符串
-    column_value = list()  # 单一dict中的列值组成的列表
-    columns_value = list()  # 多个column_value组成的列表
-    column_value_mark = str()  # 单一dict中的列值的占位字符串
-
     column_ts = datas.get('timestamp', '1970-01-01 08:00:00')
     column_id = datas.get('deviceid', 'id')
 
-    # 构建列名字符串 - 非空列
-    columns_name = ','.join([column_ts_tag, column_id_tag])
-    # 构建列值列表 - 非空列
-    column_value.append(column_ts)
-    column_value.append(column_id)
-    # 构建列值占位字符串 - 非空列
-    column_value_mark = ','.join(['%s'] * len(fixed_columns))
-
-    # 补充列名字符串、列名类型字典、列值列表和列值占位字符串 - 其他列
+    # 构建列名类型字典和列值列表 - 非空列在前，其他列按message_column顺序
     fields = datas.get('fields', dict())
-    for name in message_column:
-        if name in fields.keys():
-            columns_name = ','.join([columns_name, name])
-            column_type.update(
-                {name: fields.get(name, dict()).get('type', 'str')})
-            column_value.append(fields.get(name, dict()).get('value', str()))
-            column_value_mark = ','.join([column_value_mark, '%s'])
-    # 合并列值列表成一个大列表
-    columns_value.append(column_value)
-
-    # 构建SQL语句
-    SQL = ("INSERT INTO {schema_name}.{table_name} ({column_name}) "
-           "VALUES ({column_value});".format(schema_name=message_schema,
-                                             table_name=message_table,
-                                             column_name=columns_name,
-                                             column_value=column_value_mark))
+    names = [name for name in message_column if name in fields]
+    column_type = {name: fields[name].get('type', 'str') for name in names}
+    column_value = [column_ts, column_id]
+    column_value.extend([fields[name].get('value', str()) for name in names])
+
+    # 获取SQL语句模板
+    SQL, columns = build_template(schema=message_schema,
+                                  table=message_table,
+                                  columns=(column_ts_tag, column_id_tag) +
+                                  tuple(names))
 
     # 构建返回值
     message = dict()
     message['schema'] = message_schema
     message['table'] = message_table
     message['sql'] = SQL
-    message['value'] = columns_value
+    message['value'] = [column_value]
     message['column'] = column_type
+    message['columns'] = columns
 
     return message
 
 
+def reject(record, reason, sink=None):
+    """记录一条不符合要求的数据
+
+    :record: 被拒绝的数据
+    :reason: 拒绝原因
+    :sink: 被拒绝数据的存储文件（JSON Lines），为空则只计数和记录日志
+
+    """
+    REJECT_COUNTER.labels(reason.split(':')[0]).inc()
+    with REJECT_LOCK:
+        REJECTS['count'] += 1
+        REJECTS['reasons'][reason] = REJECTS['reasons'].get(reason, 0) + 1
+
+        if sink:
+            try:
+                line = json.dumps({
+                    'reason': reason,
+                    'data': record
+                },
+                                  ensure_ascii=False,
+                                  default=str)
+                with open(sink, 'a', encoding='UTF-8') as f:
+                    f.write(line + '\n')
+            except Exception as e:
+                logger.error('Unable to write reject sink: {text}'.format(
+                    text=e))
+
+    logger.warning('The following data does not meet the requirements '
+                   '({reason}): \n{data}'.format(reason=reason, data=record))
+
+
+def reject_info():
+    """被拒绝数据的计数
+
+    :returns: 字典，结构为：{'count': 总数, 'reasons': {原因: 数量}}
+
+    """
+    with REJECT_LOCK:
+        return {
+            'count': REJECTS['count'],
+            'reasons': dict(REJECTS['reasons']),
+        }
+
+
+def extract(record):
+    """单次遍历完成单条数据的结构检查和列值提取
+
+    数据须为非空字典，其'fields'元素的值须为非空字典，且'fields'的每个值都是字典
+
+    :record: 单条数据
+    :returns: (拒绝原因, 列名类型字典, 列值列表)，数据符合要求时拒绝原因为None
+
+    """
+    if not record or not isinstance(record, dict):
+        return 'data is not a non-empty dict', None, None
+
+    fields = record.get('fields')
+    if not fields or not isinstance(fields, dict):
+        return "'fields' is not a non-empty dict", None, None
+
+    column_type = dict()
+    column_value = list()
+    for name, field in fields.items():
+        if not isinstance(field, dict):
+            return "field is not a dict", None, None
+        type_ = field.get('type', 'str')
+        column_type[name] = type_
+        value = field.get('value', None)
+        column_value.append(json.dumps(value) if type_ == 'json' else value)
+
+    return None, column_type, column_value
+
+
+def extract_packed(record, hot, column):
+    """与extract相同，但只有热字段作为独立的列，其余字段打包为一个JSONB列
+
+    :record: 单条数据
+    :hot: 热字段名的集合
+    :column: 打包列名
+    :returns: (拒绝原因, 列名类型字典, 列值列表)，数据符合要求时拒绝原因为None
+
+    """
+    if not record or not isinstance(record, dict):
+        return 'data is not a non-empty dict', None, None
+
+    fields = record.get('fields')
+    if not fields or not isinstance(fields, dict):
+        return "'fields' is not a non-empty dict", None, None
+
+    column_type = dict()
+    column_value = list()
+    packed = dict()
+    for name, field in fields.items():
+        if not isinstance(field, dict):
+            return "field is not a dict", None, None
+        value = field.get('value', None)
+        if name in hot:
+            type_ = field.get('type', 'str')
+            column_type[name] = type_
+            column_value.append(
+                json.dumps(value) if type_ == 'json' else value)
+        else:
+            packed[name] = value
+
+    # 打包列是最后一列
+    column_type[column] = 'jsonb'
+    column_value.append(json.dumps(packed, ensure_ascii=False))
+
+    return None, column_type, column_value
+
+
 def parse_data(flow, config, datas):
     """解析数据得到SQL语句
     根据datas解析出SQL语句及其需要的数据
 
+    对每条数据单次遍历完成检查和提取，不符合要求的数据被单独拒绝（计数并可写入reject_file），
+    同一批中符合要求的数据照常入库
+    datas是list时，schema.table、时间戳和ID取自其中第一条符合要求的数据
+    配置为打包存储的schema.table只有热字段作为独立的列，其余字段打包到一个JSONB列
+
     :flow: 数据流向，决定使用storage配置中的哪个部分
     :config: storage部分配置信息
     :datas: 要插入的数据，可以是元素为dict的list或者单独的dict
-    :returns: 多个字典组成的列表，字典结构为：
+    :returns: 多个字典组成的列表（列集合不同的数据和message数据各占一个字典），字典结构为：
               {
                   'schema': 'public',
                   'table': 'example',
@@ -150,20 +317,14 @@ def parse_data(flow, config, datas):
                   'column': {
                         'column_1': 'int',
                         'column_2': 'json',
-                  }
+                  },
+                  'columns': ('timestamp', 'deviceid', 'column_1', 'column_2')
               }
 
     """
-    # 定义变量
-    SQL = str()  # SQL语句
-    schema = str()  # schema名
-    table = str()  # table名
-    column_type = dict()  # 列名及其类型组成的字典
-    columns_name = str()  # 所有列名组成的字符串
-    column_value = list()  # 单一dict中的列值组成的列表
-    columns_value = list()  # 多个column_value组成的列表
-    column_value_mark = str()  # 单一dict中的列值的占位字符串
-    message = dict()  # 报警信息字典
+    # 按SQL语句（即schema.table和列集合）分组的数据和message数据
+    groups = dict()
+    messages = dict()
 
     # 如果数据流向PostgreSQL
     if flow.lower() in ['postgresql']:
@@ -172,132 +333,75 @@ def parse_data(flow, config, datas):
         fixed_columns = db_conf.get('column', dict())
         column_ts_tag = fixed_columns.get('column_ts', 'timestamp')
         column_id_tag = fixed_columns.get('column_id', 'id')
+        reject_file = db_conf.get('reject_file', str())
         # message数据配置
-        message = dict()
         message_conf = db_conf.get('message', dict())
         message_switch = message_conf.get('message_switch', False)
+        # 打包存储配置：{'schema.table': [热字段, ...]}
+        pack_conf = db_conf.get('pack', dict())
+        pack_column = pack_conf.get('column', 'fields')
+        pack_tables = pack_conf.get('tables', dict())
 
         if isinstance(datas, dict):
-            # 判断数据结构是否符合要求
-            result = checker(datas)
-            judge = True if result == 1 else False
-            if judge:
-                # 获取schem.table名、非空列名和数据字段
-                schema = datas.get('schema', 'public')
-                table = datas.get('table', 'example')
-                column_ts = datas.get('timestamp', '1970-01-01 08:00:00')
-                column_id = datas.get('deviceid', 'id')
-
-                # 构建列名字符串 - 非空列
-                columns_name = ','.join([column_ts_tag, column_id_tag])
-                # 构建列值列表 - 非空列
-                column_value.append(column_ts)
-                column_value.append(column_id)
-                # 构建列值占位字符串 - 非空列
-                column_value_mark = ','.join(['%s'] * len(fixed_columns))
-
-                # 补充列名字符串、列名类型字典、列值列表和列值占位字符串 - 其他列
-                for name, data in datas.get('fields', dict()).items():
-                    columns_name = ','.join([columns_name, name])
-                    column_type.update({name: data.get('type', 'str')})
-                    if data.get('type', None) == 'json':
-                        value = json.dumps(data.get('value', None))
-                    else:
-                        value = data.get('value', None)
-                    column_value.append(value)
-                    column_value_mark = ','.join([column_value_mark, '%s'])
-                # 合并列值列表成一个大列表
-                columns_value.append(column_value)
-
-                # 检索处理message数据
-                if message_switch and 'message' in datas.get('fields',
-                                                             dict()).keys():
-                    message = fork_message(conf=db_conf, datas=datas)
-
-                # 构建SQL语句
-                SQL = (
-                    "INSERT INTO {schema_name}.{table_name} ({column_name}) "
-                    "VALUES ({column_value});".format(
-                        schema_name=schema,
-                        table_name=table,
-                        column_name=columns_name,
-                        column_value=column_value_mark))
-            else:
-                logger.warning(
-                    'The following data does not meet the requirements '
-                    '(count: {count}): \n{data}'.format(count=1 - result,
-                                                        data=datas))
+            records = [datas]
         elif isinstance(datas, list):
-            # 判断数据结构是否符合要求
-            result = checker(datas)
-            judge = True if result == 1 else False
-            if judge:
-                # 获取第一个dict的schem.table名、非空列名和数据字段
-                schema = datas[0].get('schema', 'public')
-                table = datas[0].get('table', 'example')
-                column_ts = datas[0].get('timestamp', '1970-01-01 08:00:00')
-                column_id = datas[0].get('deviceid', 'id')
-
-                # 构建列名字符串 - 非空列
-                columns_name = ','.join([column_ts_tag, column_id_tag])
-                # 构建列值占位字符串 - 非空列
-                column_value_mark = ','.join(['%s'] * len(fixed_columns))
-
-                # 补充列名字符串和列值占位字符串 - 其他列
-                for name, data in datas[0].get('fields', dict()).items():
-                    columns_name = ','.join([columns_name, name])
-                    column_type.update({name: data.get('type', 'str')})
-                    column_value_mark = ','.join([column_value_mark, '%s'])
-
-                # 构建列值列表
-                for data in datas:
-                    # 初始化列值列表
-                    column_value = list()
-                    # 补充列值列表 - 非空列
-                    column_value.append(column_ts)
-                    column_value.append(column_id)
-                    # 补充列值列表 - 其他列
-                    for field in data.get('fields', dict()).values():
-                        if field.get('type', None) == 'json':
-                            value = json.dumps(field.get('value', None))
-                        else:
-                            value = field.get('value', None)
-                        column_value.append(value)
-                    # 合并列值列表成一个大列表
-                    columns_value.append(column_value)
-
-                    # 检索处理message数据
-                    if message_switch and 'message' in data.get(
-                            'fields', dict()).keys():
-                        message = fork_message(conf=db_conf, datas=data)
-
-                # 构建SQL语句
-                SQL = (
-                    "INSERT INTO {schema_name}.{table_name} ({column_name}) "
-                    "VALUES ({column_value});".format(
-                        schema_name=schema,
-                        table_name=table,
-                        column_name=columns_name,
-                        column_value=column_value_mark))
-            else:
-                logger.warning(
-                    'The following data does not meet the requirements '
-                    '(count: {count}): \n{data}'.format(count=1 - result,
-                                                        data=datas))
+            records = datas
         else:
+            records = list()
             logger.error("Data type error, 'datas' must be list or dict")
 
-    # 构建返回值
-    result = list()
-
-    data = dict()
-    data['schema'] = schema
-    data['table'] = table
-    data['sql'] = SQL
-    data['value'] = columns_value
-    data['column'] = column_type
+        head = None  # schema.table、时间戳和ID
+        for record in records:
+            hot = None
+            if pack_tables and isinstance(record, dict):
+                schema, table = head[:2] if head else (record.get(
+                    'schema', 'public'), record.get('table', 'example'))
+                hot = pack_tables.get('{schema}.{table}'.format(
+                    schema=schema, table=table))
+            if hot is None:
+                reason, column_type, column_value = extract(record)
+            else:
+                reason, column_type, column_value = extract_packed(
+                    record, hot=set(hot), column=pack_column)
+            if reason:
+                reject(record=record, reason=reason, sink=reject_file)
+                continue
+
+            if head is None:
+                head = (record.get('schema', 'public'),
+                        record.get('table', 'example'),
+                        record.get('timestamp', '1970-01-01 08:00:00'),
+                        record.get('deviceid', 'id'))
+            schema, table, column_ts, column_id = head
+
+            # 获取SQL语句模板
+            SQL, columns = build_template(
+                schema=schema,
+                table=table,
+                columns=(column_ts_tag, column_id_tag) + tuple(column_type))
+
+            data = groups.get(SQL)
+            if data is None:
+                data = groups[SQL] = {
+                    'schema': schema,
+                    'table': table,
+                    'sql': SQL,
+                    'value': list(),
+                    'column': column_type,
+                    'columns': columns,
+                }
+            data['value'].append([column_ts, column_id] + column_value)
+
+            # 检索处理message数据
+            if message_switch and 'message' in record['fields']:
+                message = fork_message(conf=db_conf, datas=record)
+                if message['sql'] in messages:
+                    messages[message['sql']]['value'].extend(message['value'])
+                else:
+                    messages[message['sql']] = message
 
-    result.append(data)
-    result.append(message)
+    # 构建返回值
+    result = list(groups.values())
+    result.extend(messages.values())
 
     return result
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: bench_decoder.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 11:20:45
+
+Description: JSON解码器微基准测试，比较各解码器在不同数据大小下的解码耗时
+
+使用方法：`python scripts/Benchmark/bench_decoder.py [number]`，
+其中[number]为每种数据大小的解码次数（默认1000）
+
+数据来自tools/genesis，按字段数生成不同大小的payload
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..'))
+
+from tools.genesis import genesis  # noqa: E402
+from utils.json_wrapper import available, get_decoder  # noqa: E402
+
+# payload的字段数
+WIDTHS = [1, 8, 64, 256, 576]
+
+
+def payload(width):
+    """构建指定字段数的payload
+
+    :width: 字段数
+    :returns: bytes
+
+    """
+    return json.dumps(genesis(width=width)).encode('UTF-8')
+
+
+def bench(number):
+    """运行基准测试
+
+    :number: 每种数据大小的解码次数
+
+    """
+    decoders = [get_decoder(name) for name in available()]
+    # str路径：原Wizard.convert的先decode再json.loads
+    baseline = ('json(str)', lambda raw: json.loads(raw.decode('UTF-8')))
+
+    print('{:>6} {:>9} {:>12} {:>12} {:>10}'.format('width', 'bytes',
+                                                     'decoder', 'us/payload',
+                                                     'MB/s'))
+    for width in WIDTHS:
+        raw = payload(width)
+        for name, decode in [baseline] + decoders:
+            for kind, data in [('', raw), ('(mv)', memoryview(raw))]:
+                if name == 'json(str)' and kind:
+                    continue
+                cost = timeit.timeit(lambda: decode(data),
+                                     number=number) / number
+                print('{:>6} {:>9} {:>12} {:>12.2f} {:>10.2f}'.format(
+                    width, len(raw), name + kind, cost * 1e6,
+                    len(raw) / cost / 1e6))
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    bench(number)
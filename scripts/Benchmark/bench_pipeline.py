@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: bench_pipeline.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 19:58:06
+
+Description: 持久化流水线的离线吞吐量基准测试，不需要MQTT Broker和数据库
+
+使用方法：`python scripts/Benchmark/bench_pipeline.py [options]`，
+选项见`python scripts/Benchmark/bench_pipeline.py --help`
+
+数据来自tools/genesis（字段数可配置），在当前线程中依次执行：
+    1. decode: Wizard.convert，解码原始数据
+    2. check: checker，检查数据结构
+    3. parse: parse_data，解析得到入库物料
+    4. insert: Wizard.flush，批满后经PostgresqlWrapper写入tools/fakedb中的替身数据库
+
+结果以JSON输出（msgs/s、rows/s、各阶段耗时的p50/p99、峰值RSS等），便于比较升级前后的结果
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+CWD = os.getcwd()
+sys.path.append(ROOT)
+# mqtt_wrapper在导入时以相对路径读取配置文件
+os.chdir(ROOT)
+
+import toml  # noqa: E402
+
+from main import Wizard  # noqa: E402
+from plugins.parser_postgresql import checker, parse_data  # noqa: E402
+from tools.fakedb import RecordingDatabase  # noqa: E402
+from tools.genesis import genesis, humans  # noqa: E402
+from utils.batch_wrapper import Batcher  # noqa: E402
+
+confile = 'conf/config.toml'
+
+
+def percentile(samples, percent):
+    """取已排序样本的百分位数
+
+    :samples: 已排序的样本
+    :percent: 百分位（0~100）
+    :returns: 样本值，没有样本时返回0
+
+    """
+    if not samples:
+        return 0
+    index = int(round(percent / 100 * (len(samples) - 1)))
+
+    return samples[index]
+
+
+def summarize(samples):
+    """统计一个阶段的耗时
+
+    :samples: 耗时样本（秒）
+    :returns: 字典，耗时单位为微秒
+
+    """
+    samples = sorted(samples)
+    count = len(samples)
+
+    return {
+        'count': count,
+        'mean_us': round(sum(samples) / count * 1e6, 3) if count else 0,
+        'p50_us': round(percentile(samples, 50) * 1e6, 3),
+        'p99_us': round(percentile(samples, 99) * 1e6, 3),
+        'max_us': round(samples[-1] * 1e6, 3) if count else 0,
+    }
+
+
+def build_config(args):
+    """在配置文件的基础上按命令行参数构建基准测试使用的配置
+
+    :args: 命令行参数
+    :returns: 配置字典
+
+    """
+    config = toml.load(confile)
+
+    main_conf = config.setdefault('main', dict())
+    main_conf['mode'] = 'thread'
+    main_conf['autoscale'] = False
+    main_conf['number'] = 1
+    if args.decoder:
+        main_conf['decoder'] = args.decoder
+
+    cache_conf = config.setdefault('cache', dict())
+    if args.batch_size:
+        cache_conf['batch_size'] = args.batch_size
+
+    storage_conf = config.setdefault('storage', dict())
+    storage_conf['select'] = 'postgresql'
+    entity = storage_conf.setdefault('postgresql', dict())
+    if args.insert_mode:
+        entity['insert_mode'] = args.insert_mode
+    if args.copy_format:
+        entity['copy_format'] = args.copy_format
+    if args.pack is not None:
+        # universe.earth（genesis数据的表）使用打包存储，前pack个字段为热字段
+        entity['pack'] = {
+            'column': 'fields',
+            'tables': {
+                'universe.earth': humans(min(args.pack, args.width))
+            }
+        }
+    # 替身数据库不会失败，关闭溢写和死信表，避免写入磁盘和额外的DDL
+    entity.setdefault('spill', dict())['enable'] = False
+    entity.setdefault('retry', dict())['dead_letter_table'] = str()
+    entity['reject_file'] = str()
+
+    config['metrics'] = {'enable': False}
+    config['log'] = {'console': False, 'file': False}
+
+    return config
+
+
+def payloads(width, devices):
+    """为每个设备构建一条原始数据
+
+    :width: 字段数
+    :devices: 设备数
+    :returns: bytes列表
+
+    """
+    return [
+        json.dumps(genesis(width=width, deviceid='Device-{}'.format(index)),
+                   ensure_ascii=False).encode('UTF-8')
+        for index in range(devices)
+    ]
+
+
+def run(wizard, raws, messages, batch_size):
+    """运行流水线
+
+    :wizard: Wizard实例
+    :raws: 原始数据，循环使用
+    :messages: 消息数
+    :batch_size: 批内行数
+    :returns: (各阶段耗时样本, 写入行数, 总耗时)
+
+    """
+    stages = {
+        'decode': list(),
+        'check': list(),
+        'parse': list(),
+        'insert': list()
+    }
+    # linger设为很大的值，批只按batch_size触发，结果不受计时抖动影响
+    batcher = Batcher(size=batch_size, linger=3600)
+    flow = wizard.storage_select
+    conf = wizard.storage_conf
+    rows = 0
+    clock = time.perf_counter
+
+    start_time = clock()
+    for raw in itertools.islice(itertools.cycle(raws), messages):
+        t0 = clock()
+        datas = wizard.convert(raw)
+        t1 = clock()
+        checker(datas)
+        t2 = clock()
+        result = parse_data(flow=flow, config=conf, datas=datas)
+        t3 = clock()
+        stages['decode'].append(t1 - t0)
+        stages['check'].append(t2 - t1)
+        stages['parse'].append(t3 - t2)
+
+        for res in result:
+            batcher.add(res)
+        if batcher.due():
+            rows += len(batcher)
+            stages['insert'].append(wizard.flush(batcher))
+
+    if len(batcher):
+        rows += len(batcher)
+        stages['insert'].append(wizard.flush(batcher))
+    elapsed = clock() - start_time
+
+    return stages, rows, elapsed
+
+
+def bench(args):
+    """运行基准测试
+
+    :args: 命令行参数
+    :returns: 结果字典
+
+    """
+    config = build_config(args)
+    sink = RecordingDatabase(latency=args.latency)
+    wizard = Wizard(config, creator=sink)
+    wizard.open_database()
+    raws = payloads(width=args.width, devices=args.devices)
+
+    # 预热：首批数据会触发建表等DDL，不计入结果
+    if args.warmup:
+        run(wizard=wizard,
+            raws=raws,
+            messages=args.warmup,
+            batch_size=wizard.batch_size)
+    sink.reset()
+
+    stages, rows, elapsed = run(wizard=wizard,
+                                raws=raws,
+                                messages=args.messages,
+                                batch_size=wizard.batch_size)
+
+    return {
+        'config': {
+            'messages': args.messages,
+            'width': args.width,
+            'devices': args.devices,
+            'payload_bytes': round(sum([len(raw) for raw in raws]) /
+                                   len(raws)),
+            'batch_size': wizard.batch_size,
+            'insert_mode': wizard.database._insert_mode,
+            'copy_format': wizard.database._copy_format,
+            'decoder': wizard.decoder_name,
+            'latency': args.latency,
+            'pack': args.pack,
+        },
+        'elapsed': round(elapsed, 6),
+        'messages': args.messages,
+        'rows': rows,
+        'msgs_per_s': round(args.messages / elapsed, 2),
+        'rows_per_s': round(rows / elapsed, 2),
+        'stages': {name: summarize(samples)
+                   for name, samples in stages.items()},
+        'sink': sink.stats(),
+        # Linux上ru_maxrss的单位是KB
+        'peak_rss_bytes':
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Offline throughput benchmark of the ingest pipeline')
+    parser.add_argument('-n', '--messages', type=int, default=10000,
+                        help='number of messages (default: 10000)')
+    parser.add_argument('-w', '--width', type=int, default=576,
+                        help='fields per message (default: 576)')
+    parser.add_argument('-d', '--devices', type=int, default=10,
+                        help='distinct payloads/devices (default: 10)')
+    parser.add_argument('-b', '--batch-size', type=int, default=0,
+                        help='rows per batch (default: [cache].batch_size)')
+    parser.add_argument('-m', '--insert-mode', default=None,
+                        choices=['executemany', 'values', 'copy', 'prepared'],
+                        help='insert mode (default: from config)')
+    parser.add_argument('--copy-format', default=None,
+                        choices=['text', 'binary'],
+                        help='COPY format (default: from config)')
+    parser.add_argument('--pack', type=int, default=None, metavar='HOT',
+                        help='store all but the first HOT fields in one JSONB '
+                        'column (default: one column per field)')
+    parser.add_argument('--decoder', default=None,
+                        help='JSON decoder (default: from config)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated seconds per SQL statement '
+                        '(default: 0)')
+    parser.add_argument('--warmup', type=int, default=200,
+                        help='messages run before measuring (default: 200)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the JSON result to this file')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = bench(args)
+    text = json.dumps(result, indent=4, ensure_ascii=False)
+    if args.output:
+        with open(os.path.join(CWD, args.output), 'w',
+                  encoding='UTF-8') as f:
+            f.write(text + '\n')
+    print(text)
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: load_harness.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 20:36:52
+
+Description: 端到端负载测试，按main.py的进程拓扑运行，逐级提高发布速率，找出可持续吞吐量的拐点
+
+使用方法：`python scripts/Benchmark/load_harness.py [options]`，
+选项见`python scripts/Benchmark/load_harness.py --help`
+
+进程拓扑与main.py的'thread'模式一致：
+    数据源进程（以注入的消息流代替MQTT Broker，同样经Chunker放入队列）
+        -> 进程间队列
+        -> Wizard进程（线程池，每个topic number个worker）
+        -> 数据库（默认为tools/fakedb中的替身，--postgres时使用配置文件中的PostgreSQL）
+
+每级速率持续step秒，统计已发布和已入库的消息数，积压（已发布 - 已入库）的增长超过容差时视为发散，
+此前最后一个稳定的速率即拐点，结果以JSON输出
+Wizard进程统计的是入库行数，按注入数据的平均每条消息行数换算为消息数后再与已发布的消息数比较
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from multiprocessing import Event, Process, Value
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+CWD = os.getcwd()
+sys.path.append(ROOT)
+# mqtt_wrapper在导入时以相对路径读取配置文件
+os.chdir(ROOT)
+
+import toml  # noqa: E402
+
+from main import Wizard  # noqa: E402
+from plugins.parser_postgresql import parse_data  # noqa: E402
+from tools.fakedb import RecordingDatabase  # noqa: E402
+from tools.genesis import genesis  # noqa: E402
+from utils.batch_wrapper import Chunker  # noqa: E402
+
+confile = 'conf/config.toml'
+
+
+def build_config(args):
+    """在配置文件的基础上按命令行参数构建负载测试使用的配置
+
+    :args: 命令行参数
+    :returns: 配置字典
+
+    """
+    config = toml.load(confile)
+
+    main_conf = config.setdefault('main', dict())
+    main_conf['mode'] = 'thread'
+    main_conf['autoscale'] = False
+    if args.number:
+        main_conf['number'] = args.number
+
+    cache_conf = config.setdefault('cache', dict())
+    for key in [
+            'batch_size', 'linger', 'cordon', 'chunk_size', 'chunk_linger'
+    ]:
+        value = getattr(args, key)
+        if value is not None:
+            cache_conf[key] = value
+
+    storage_conf = config.setdefault('storage', dict())
+    storage_conf['select'] = 'postgresql'
+    entity = storage_conf.setdefault('postgresql', dict())
+    if args.insert_mode:
+        entity['insert_mode'] = args.insert_mode
+    if not args.postgres:
+        # 替身数据库不会失败，关闭溢写和死信表，避免写入磁盘和额外的DDL
+        entity.setdefault('spill', dict())['enable'] = False
+        entity.setdefault('retry', dict())['dead_letter_table'] = str()
+        entity['reject_file'] = str()
+
+    source_conf = config.setdefault('source', dict())
+    source_conf['select'] = 'mqtt'
+    mqtt_conf = source_conf.setdefault('mqtt', dict())
+    if args.topics:
+        mqtt_conf['topics'] = [
+            'harness/{}'.format(index) for index in range(args.topics)
+        ]
+    elif not mqtt_conf.get('topics'):
+        mqtt_conf['topics'] = ['harness/0']
+
+    config['metrics'] = {'enable': False}
+    config['log'] = {'console': False, 'file': False}
+
+    return config
+
+
+def feed(queues, raws, rate, published, stop, chunk_size, chunk_linger,
+         limit):
+    """数据源进程：按目标速率向各topic队列轮流注入消息（代替MQTT Broker和订阅者）
+
+    :queues: 队列字典：{'topic': 队列}
+    :raws: 原始数据，循环使用
+    :rate: 目标速率（条/秒），multiprocessing.Value('d')
+    :published: 已发布消息数，multiprocessing.Value('L')
+    :stop: 停止事件
+    :chunk_size: Chunker块内消息数
+    :chunk_linger: Chunker等待时间（秒）
+    :limit: Chunker积压区上限
+
+    """
+    chunkers = [
+        Chunker(name=name,
+                queue=queue,
+                size=chunk_size,
+                linger=chunk_linger,
+                limit=limit)
+        for name, queue in queues.items()
+    ]
+    payloads = itertools.cycle(raws)
+    tick = 0.002
+    credit = 0.0
+    sent = 0
+    last = time.monotonic()
+
+    while not stop.is_set():
+        now = time.monotonic()
+        target = rate.value
+        # 最多累计0.1s的额度，数据源跟不上时不会在之后突发
+        credit = min(credit + (now - last) * target, max(target * 0.1, 1))
+        last = now
+
+        count = int(credit)
+        credit -= count
+        for _ in range(count):
+            chunkers[sent % len(chunkers)].put(next(payloads))
+            sent += 1
+        published.value = sent
+
+        time.sleep(tick)
+
+
+def rows_per_message(wizard, raws):
+    """计算注入数据的平均每条消息的入库行数
+
+    与Wizard进程相同地解码和解析每条原始数据，只统计会加入批的物料（有sql）的行数
+
+    :wizard: Wizard实例
+    :raws: 原始数据，循环使用
+    :returns: 平均每条消息的行数
+
+    """
+    rows = 0
+    for raw in raws:
+        result = parse_data(flow=wizard.storage_select,
+                            config=wizard.storage_conf,
+                            datas=wizard.convert(raw))
+        rows += sum([
+            len(material.get('value', list())) for material in result
+            if material and material.get('sql')
+        ])
+
+    return rows / len(raws) if raws else 1
+
+
+def consume(wizard, consumed):
+    """Wizard进程：启动线程池，统计已入库的行数
+
+    :wizard: Wizard实例
+    :consumed: 已入库行数，multiprocessing.Value('L')
+
+    """
+    flush = wizard.flush
+
+    def counted(batcher):
+        rows = len(batcher)
+        cost = flush(batcher)
+        with consumed.get_lock():
+            consumed.value += rows
+        return cost
+
+    wizard.flush = counted
+    wizard.start_wizard_threadpool()
+
+
+def ramp(args, wizard, rate, published, consumed, ratio):
+    """逐级提高发布速率，直到积压发散、数据源达不到目标速率或达到最大速率
+
+    :args: 命令行参数
+    :wizard: Wizard实例
+    :rate: 目标速率，multiprocessing.Value('d')
+    :published: 已发布消息数
+    :consumed: 已入库行数
+    :ratio: 平均每条消息的行数，用于将已入库行数换算为消息数
+    :returns: (各级结果列表, 结束原因)
+
+    """
+    workers = len(wizard.topics) * wizard.number
+    steps = list()
+    target = args.start
+    reason = 'max_rate'
+
+    while target <= args.max_rate:
+        rate.value = target
+        start_time = time.monotonic()
+        published_start = published.value
+        consumed_start = int(consumed.value / ratio)
+        time.sleep(args.step)
+        elapsed = time.monotonic() - start_time
+        published_end = published.value
+        consumed_end = int(consumed.value / ratio)
+
+        growth = (published_end - consumed_end) - (published_start -
+                                                   consumed_start)
+        # 积压的增长超过本级消息数的tolerance，或超过所有worker的批内消息数之和
+        tolerance = max(args.tolerance * target * elapsed,
+                        wizard.batch_size * workers / ratio)
+        step = {
+            'target_per_s': target,
+            'published_per_s': round((published_end - published_start) /
+                                     elapsed, 2),
+            'consumed_per_s': round((consumed_end - consumed_start) /
+                                    elapsed, 2),
+            'backlog': published_end - consumed_end,
+            'backlog_growth': growth,
+            'queue_depth': sum([
+                topic_queue.qsize()
+                for topic_queue in wizard.queue_dict.values()
+            ]),
+        }
+        step['stable'] = growth <= tolerance
+        steps.append(step)
+        print('target {target_per_s:>9.0f}/s  '
+              'published {published_per_s:>9.0f}/s  '
+              'consumed {consumed_per_s:>9.0f}/s  '
+              'backlog {backlog:>8}  queue {queue_depth:>6}  {state}'.format(
+                  state='stable' if step['stable'] else 'diverging', **step),
+              file=sys.stderr)
+
+        if step['published_per_s'] < target * 0.9:
+            reason = 'feeder_limited'
+            break
+        if not step['stable']:
+            reason = 'diverged'
+            break
+        target = round(target * args.factor, 2)
+
+    return steps, reason
+
+
+def harness(args):
+    """运行负载测试
+
+    :args: 命令行参数
+    :returns: 结果字典
+
+    """
+    config = build_config(args)
+    sink = None if args.postgres else RecordingDatabase(latency=args.latency)
+    wizard = Wizard(config, creator=sink)
+    raws = [
+        json.dumps(genesis(width=args.width,
+                           deviceid='Device-{}'.format(index)),
+                   ensure_ascii=False).encode('UTF-8')
+        for index in range(args.devices)
+    ]
+
+    ratio = rows_per_message(wizard, raws) or 1
+
+    rate = Value('d', 0.0)
+    published = Value('L', 0)
+    consumed = Value('L', 0)
+    stop = Event()
+    source = Process(target=feed,
+                     args=(wizard.queue_dict, raws, rate, published, stop,
+                           wizard.chunk_size, wizard.chunk_linger,
+                           wizard.cordon),
+                     name='Source')
+    consumer = Process(target=consume,
+                       args=(wizard, consumed),
+                       name='Wizard',
+                       daemon=True)
+    source.start()
+    consumer.start()
+
+    try:
+        steps, reason = ramp(args=args,
+                             wizard=wizard,
+                             rate=rate,
+                             published=published,
+                             consumed=consumed,
+                             ratio=ratio)
+    finally:
+        stop.set()
+        source.join()
+        consumer.terminate()
+        consumer.join()
+
+    stable = [step for step in steps if step['stable']]
+    knee = stable[-1] if stable else None
+
+    return {
+        'config': {
+            'topics': wizard.topics,
+            'number': wizard.number,
+            'batch_size': wizard.batch_size,
+            'linger': wizard.linger,
+            'cordon': wizard.cordon,
+            'chunk_size': wizard.chunk_size,
+            'transport': wizard.transport,
+            'insert_mode': wizard.storage_entity.get('insert_mode',
+                                                     'executemany'),
+            'decoder': wizard.decoder_name,
+            'database': 'postgresql' if args.postgres else 'fakedb',
+            'latency': 0 if args.postgres else args.latency,
+            'width': args.width,
+            'rows_per_message': round(ratio, 3),
+            'step': args.step,
+            'factor': args.factor,
+            'tolerance': args.tolerance,
+        },
+        'result': reason,
+        # 拐点：最后一个稳定的速率，以及发散时实际达到的入库速率（容量估计）
+        'knee_per_s': knee['target_per_s'] if knee else None,
+        'sustained_per_s': knee['consumed_per_s'] if knee else None,
+        'capacity_per_s': max([step['consumed_per_s'] for step in steps],
+                              default=None),
+        'steps': steps,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='End-to-end load harness: ramp the publish rate until '
+        'the backlog diverges')
+    parser.add_argument('--start', type=float, default=500,
+                        help='first publish rate in msgs/s (default: 500)')
+    parser.add_argument('--factor', type=float, default=1.5,
+                        help='rate multiplier per step (default: 1.5)')
+    parser.add_argument('--max-rate', type=float, default=200000,
+                        help='stop at this rate in msgs/s (default: 200000)')
+    parser.add_argument('--step', type=float, default=5,
+                        help='seconds per step (default: 5)')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed backlog growth as a fraction of the '
+                        'messages published in a step (default: 0.1)')
+    parser.add_argument('-w', '--width', type=int, default=576,
+                        help='fields per message (default: 576)')
+    parser.add_argument('-d', '--devices', type=int, default=10,
+                        help='distinct payloads/devices (default: 10)')
+    parser.add_argument('-t', '--topics', type=int, default=0,
+                        help='number of topics (default: from config)')
+    parser.add_argument('-n', '--number', type=int, default=0,
+                        help='workers per topic (default: [main].number)')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+                        default=None,
+                        help='rows per batch (default: from config)')
+    parser.add_argument('--linger', type=float, default=None,
+                        help='batch linger in seconds (default: from config)')
+    parser.add_argument('--cordon', type=int, default=None,
+                        help='queue capacity (default: from config)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=None,
+                        help='messages per chunk (default: from config)')
+    parser.add_argument('--chunk-linger', dest='chunk_linger', type=float,
+                        default=None,
+                        help='chunk linger in seconds (default: from config)')
+    parser.add_argument('-m', '--insert-mode', default=None,
+                        choices=['executemany', 'values', 'copy', 'prepared'],
+                        help='insert mode (default: from config)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated seconds per SQL statement of the '
+                        'stand-in database (default: 0)')
+    parser.add_argument('--postgres', action='store_true',
+                        help='write to the PostgreSQL in the config file '
+                        'instead of the stand-in database')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the JSON result to this file')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = harness(args)
+    text = json.dumps(result, indent=4, ensure_ascii=False)
+    if args.output:
+        with open(os.path.join(CWD, args.output), 'w',
+                  encoding='UTF-8') as f:
+            f.write(text + '\n')
+    print(text)
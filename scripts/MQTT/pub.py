@@ -6,20 +6,160 @@ Author: YJ
 Email: yj1516268@outlook.com
 Created Time: 2020-11-06 16:06:47
 
-Description: 发布消息到MQTT Server
+Description: 按目标速率发布消息到MQTT Server，用于对DataWizard施加负载
 
-使用方法：`python pub.py <number>`，其中<number>为单位时间内发布消息的数量
+使用方法：`python pub.py [options]`，选项见`python pub.py --help`，例如：
 
+    python pub.py --rate 20000 --devices 100 --fields 576 --processes 4
+
+为了不让生成数据成为瓶颈，所有数据在发布前准备好：
+    1. 用NumPy一次生成 变体数 x 设备数 x 字段数 的值数组并格式化（未安装NumPy时使用random，只是准备较慢）
+    2. 每个设备的每个变体预先序列化为bytes模板，模板在时间戳处切分
+    3. 发布时只需将当前时间戳拼入模板（bytes.join），然后调用publish
+
+发布按绝对时刻调度（第n条消息在start + n / rate时发出），不会累积误差；
+跟不上调度时跳过过期的消息并计入lagged，而不是突发补发
 """
 
+import argparse
+import itertools
 import json
-import random
+import os
+import signal
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Array, Event, Process
+from multiprocessing.connection import wait
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+    import random
 
 import paho.mqtt.client as mqtt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..'))
+
+from tools.genesis import NEBULA, humans  # noqa: E402
+
+# 时间戳占位符，序列化后在此处切分模板
+PLACEHOLDER = '\x00'
+# 时间戳格式
+TIMEFORMAT = '%Y-%m-%d %H:%M:%S'
+# 每个发布进程的统计项
+STATS = ['sent', 'errors', 'lagged', 'bytes']
+
+
+def values(variants, devices, fields, low=0, high=100):
+    """生成格式化后的值
+
+    :variants: 每个设备的变体数
+    :devices: 设备数
+    :fields: 字段数
+    :low: 最小值
+    :high: 最大值
+    :returns: 三层嵌套的str列表，[变体][设备][字段]
+
+    """
+    shape = (variants, devices, fields)
+    if numpy is not None:
+        array = numpy.random.default_rng().uniform(low, high, size=shape)
+        return numpy.char.mod('%.2f', array).tolist()
+
+    return [[[
+        '%.2f' % random.uniform(low, high) for _ in range(fields)
+    ] for _ in range(devices)] for _ in range(variants)]
+
+
+def record(schema, table, deviceid, names, value):
+    """构建一条数据的JSON文本，时间戳为占位符
+
+    :schema: Schema名
+    :table: Table名
+    :deviceid: 设备ID
+    :names: 字段名列表
+    :value: 与names对应的已格式化的值列表
+    :returns: str
+
+    """
+    fields = ','.join([
+        '{key}:{{"name":{key},"title":{title},"value":{value},'
+        '"type":"float","unit":{unit}}}'.format(
+            key=json.dumps(name, ensure_ascii=False),
+            title=json.dumps(name.upper(), ensure_ascii=False),
+            value=number,
+            unit=json.dumps(NEBULA[index % len(NEBULA)]))
+        for index, (name, number) in enumerate(zip(names, value))
+    ])
+
+    return ('{{"timestamp":"{ts}","schema":{schema},"table":{table},'
+            '"deviceid":{deviceid},"fields":{{{fields}}}}}'.format(
+                ts=PLACEHOLDER,
+                schema=json.dumps(schema),
+                table=json.dumps(table),
+                deviceid=json.dumps(deviceid),
+                fields=fields))
+
+
+def templates(args):
+    """预先序列化所有payload模板
+
+    shape为'dict'时每条消息是一个设备的一条数据，
+    shape为'list'时每条消息是list_size个设备的数据组成的list
+
+    :args: 命令行参数
+    :returns: 模板列表，每个模板是在时间戳处切分的bytes列表
+
+    """
+    names = humans(args.fields)
+    table = values(variants=args.variants,
+                   devices=args.devices,
+                   fields=args.fields)
+    deviceids = ['Device-{}'.format(index) for index in range(args.devices)]
+
+    result = list()
+    for variant in table:
+        records = [
+            record(schema=args.schema,
+                   table=args.table,
+                   deviceid=deviceid,
+                   names=names,
+                   value=value) for deviceid, value in zip(deviceids, variant)
+        ]
+        if args.shape in ['list']:
+            size = max(args.list_size, 1)
+            records = [
+                '[{}]'.format(','.join(records[start:start + size]))
+                for start in range(0, len(records), size)
+            ]
+        result.extend([
+            text.encode('UTF-8').split(PLACEHOLDER.encode('UTF-8'))
+            for text in records
+        ])
+
+    return result
+
+
+def connect(args, name):
+    """创建MQTT客户端并启动网络线程
+
+    :args: 命令行参数
+    :name: 客户端名
+    :returns: MQTT客户端
+
+    """
+    client = mqtt.Client(client_id='{}-{}'.format(name, os.getpid()))
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.connect(host=args.host, port=args.port, keepalive=args.keepalive)
+    client.loop_start()
+
+    return client
+
 
 def on_connect(client, userdata, flags, reasonCode, properties=None):
     """连接后事件"""
@@ -31,112 +171,237 @@ def on_connect(client, userdata, flags, reasonCode, properties=None):
 
 
 def on_disconnect(client, userdata, reasonCode, properties=None):
-    """断开连接后事件"""
+    """断开连接后事件，网络线程会自动重连"""
     print('MQTT disconnection, reasonCode = {}'.format(reasonCode))
 
 
-def on_publish(client, userdata, mid):
-    """发布完成后事件
-    对于QoS级别为0的消息，这仅代表消息已离开客户端
-    对于QoS级别为1或2的消息，这意味着适当的握手已完成
+def publish(args, pool, index, stats, times, stop):
+    """发布进程：按rate / processes的速率发布消息
+
+    :args: 命令行参数
+    :pool: templates返回的模板列表
+    :index: 进程序号
+    :stats: 共享统计数组，每个进程占len(STATS)个元素
+    :times: 共享时刻数组，每个进程占2个元素：开始和结束发布的时刻（time.time()）
+    :stop: 停止事件
+
     """
-    print('Published success, mid = {}'.format(mid))
+    # Ctrl-C由主进程处理，通过stop通知发布进程结束
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+    rate = args.rate / args.processes
+    offset = index * len(STATS)
+    client = None
+    if not args.dry_run:
+        client = connect(args, name='pub-{}'.format(index))
+    # 各进程从不同的模板开始，避免同一时刻发布相同的数据
+    payloads = itertools.islice(itertools.cycle(pool), index, None)
+    topics = itertools.cycle(args.topics)
+    # 最多落后0.1s，更早的消息视为过期
+    burst = max(int(rate * 0.1), 1)
 
-def start(tag):
-    """Start publish"""
-    # 发布数据
-    client.loop_start()
-    while True:
-        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
-        chaos = round(random.uniform(0, 999), 9)
-        data = {
-            'timestamp': ts,
-            'schema': 'alien',
-            'table': 'groot',
-            'id': 'groot',
-            'fields': {
-                'x': {
-                    'name': 'x',
-                    'title': 'X轴',
-                    'value': chaos,
-                    'type': 'float',
-                    'unit': 'mm',
-                },
-                'message': {
-                    'name': 'message',
-                    'title': '日志信息',
-                    'value': '当前值{}'.format(chaos),
-                    'type': 'str',
-                    'unit': None,
-                },
-                'source': {
-                    'name': 'source',
-                    'title': '日志来源',
-                    'value': 'TCP',
-                    'type': 'str',
-                    'unit': None,
-                },
-                'level': {
-                    'name': 'level',
-                    'title': '日志等级',
-                    'value': 1,
-                    'type': 'int',
-                    'unit': None,
-                },
-                'logpath': {
-                    'name': 'logpath',
-                    'title': '日志路径',
-                    'value': '',
-                    'type': 'str',
-                    'unit': None,
-                },
-            }
-        }
-        payload = json.dumps(data)
-
-        if client._state != 2:
-            # 发布/订阅
-            for topic in topics:
-                client.publish(topic=topic, payload=payload, qos=qos)
-        else:
-            print('连接失效，进行重连...')
-            client.disconnect()
-            client.loop_stop()
-            print('开始重连')
-            client.reconnect()
-            client.loop_start()
-        time.sleep(1)
+    sent = errors = lagged = size = 0
+    second = None
+    start = time.perf_counter()
+    times[index * 2] = time.time()
+    while not stop.is_set():
+        now = time.perf_counter()
+        if args.duration and now - start >= args.duration:
+            break
 
+        # 按调度应发出的消息数
+        due = int((now - start) * rate) - sent - lagged
+        if due > burst:
+            lagged += due - burst
+            due = burst
 
-if __name__ == "__main__":
-    # connect参数
-    hostname = "127.0.0.1"
-    port = 1883
-    alive = 60
+        # 时间戳每秒格式化一次
+        current = int(time.time())
+        if current != second:
+            second = current
+            stamp = time.strftime(TIMEFORMAT,
+                                  time.localtime(current)).encode('UTF-8')
 
-    # publish参数
-    qos = 0
-    topics = ['topic/x', 'topic/y']
+        for _ in range(due):
+            payload = stamp.join(next(payloads))
+            if client is not None:
+                info = client.publish(topic=next(topics),
+                                      payload=payload,
+                                      qos=args.qos)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    errors += 1
+            sent += 1
+            size += len(payload)
 
-    # 创建客户端
-    client = mqtt.Client()
+        stats[offset:offset + len(STATS)] = [sent, errors, lagged, size]
 
-    # 注册事件
-    client.on_connect = on_connect
-    client.on_publish = on_publish
-    client.on_disconnect = on_disconnect
+        # 等到下一条消息的调度时刻
+        delay = start + (sent + lagged + 1) / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    stats[offset:offset + len(STATS)] = [sent, errors, lagged, size]
+    times[index * 2 + 1] = time.time()
+    if client is not None:
+        client.loop_stop()
+        client.disconnect()
+
+
+def totals(stats, processes):
+    """汇总所有发布进程的统计
+
+    :stats: 共享统计数组
+    :processes: 进程数
+    :returns: 字典：{统计项: 值}
+
+    """
+    snapshot = stats[:]
+    return {
+        name: sum([
+            snapshot[index * len(STATS) + column]
+            for index in range(processes)
+        ])
+        for column, name in enumerate(STATS)
+    }
+
+
+def report(args, stats, workers):
+    """定期输出实际速率，直到所有发布进程结束
+
+    :args: 命令行参数
+    :stats: 共享统计数组
+    :workers: 发布进程列表
+
+    """
+    last_time = time.perf_counter()
+    last = totals(stats, args.processes)
+    sentinels = [worker.sentinel for worker in workers]
+    while sentinels:
+        deadline = last_time + args.report
+        # 等到下一次输出的时刻，期间结束的发布进程不再等待
+        while sentinels and time.perf_counter() < deadline:
+            for sentinel in wait(sentinels,
+                                 timeout=deadline - time.perf_counter()):
+                sentinels.remove(sentinel)
+        now = time.perf_counter()
+        current = totals(stats, args.processes)
+        elapsed = now - last_time
+        print('target {target:>9.0f}/s  achieved {rate:>9.0f}/s  '
+              '{mbps:>8.2f} MB/s  errors {errors}  lagged {lagged}'.format(
+                  target=args.rate,
+                  rate=(current['sent'] - last['sent']) / elapsed,
+                  mbps=(current['bytes'] - last['bytes']) / elapsed / 1e6,
+                  errors=int(current['errors'] - last['errors']),
+                  lagged=int(current['lagged'] - last['lagged'])))
+        last, last_time = current, now
+
+
+def summarize(args, stats, times):
+    """汇总所有发布进程的统计（须在发布进程结束后调用）
+
+    耗时取最早开始发布到最晚结束发布的时刻，不包括准备模板、连接和输出间隔
+
+    :args: 命令行参数
+    :stats: 共享统计数组
+    :times: 共享时刻数组
+    :returns: 汇总字典
+
+    """
+    snapshot = times[:]
+    starts = [start for start in snapshot[0::2] if start]
+    stops = [stop for stop in snapshot[1::2] if stop]
+    elapsed = max(stops) - min(starts) if starts and stops else 0
+    elapsed = max(elapsed, 1e-9)
+    current = totals(stats, args.processes)
+
+    return {
+        'target_per_s': args.rate,
+        'achieved_per_s': round(current['sent'] / elapsed, 2),
+        'mb_per_s': round(current['bytes'] / elapsed / 1e6, 3),
+        'elapsed': round(elapsed, 3),
+        'sent': int(current['sent']),
+        'errors': int(current['errors']),
+        'lagged': int(current['lagged']),
+        'processes': args.processes,
+        'shape': args.shape,
+        'devices': args.devices,
+        'fields': args.fields,
+        'generator': 'numpy' if numpy is not None else 'random',
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Publish pre-serialised payloads at a target rate')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='MQTT broker host (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=1883,
+                        help='MQTT broker port (default: 1883)')
+    parser.add_argument('--username', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--keepalive', type=int, default=60)
+    parser.add_argument('--qos', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--topics', nargs='+', default=['topic/x', 'topic/y'],
+                        help='topics, published in turn (default: topic/x '
+                        'topic/y)')
+    parser.add_argument('-r', '--rate', type=float, default=1000,
+                        help='total messages per second (default: 1000)')
+    parser.add_argument('-t', '--duration', type=float, default=0,
+                        help='seconds to run, 0 means forever (default: 0)')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='publisher processes (default: 1)')
+    parser.add_argument('-d', '--devices', type=int, default=10,
+                        help='number of devices (default: 10)')
+    parser.add_argument('-f', '--fields', type=int, default=576,
+                        help='fields per record (default: 576)')
+    parser.add_argument('--variants', type=int, default=8,
+                        help='pre-generated value sets per device '
+                        '(default: 8)')
+    parser.add_argument('--shape', default='dict', choices=['dict', 'list'],
+                        help="payload shape: one record or a list of records "
+                        "(default: dict)")
+    parser.add_argument('--list-size', type=int, default=10,
+                        help="records per payload when --shape list "
+                        "(default: 10)")
+    parser.add_argument('--schema', default='universe')
+    parser.add_argument('--table', default='earth')
+    parser.add_argument('--report', type=float, default=5,
+                        help='seconds between rate reports (default: 5)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='build payloads without publishing, to measure '
+                        'the generator itself')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.processes = max(args.processes, 1)
 
-    # 连接到服务器
-    client.connect(
-        host=hostname,
-        port=port,
-        keepalive=alive,
-    )
+    start_time = time.perf_counter()
+    pool = templates(args)
+    print('Prepared {count} payload templates in {cost:.2f}s ({generator})'.
+          format(count=len(pool),
+                 cost=time.perf_counter() - start_time,
+                 generator='numpy' if numpy is not None else 'random'))
 
-    numbers = int(sys.argv[1])
+    stats = Array('d', args.processes * len(STATS), lock=False)
+    times = Array('d', args.processes * 2, lock=False)
+    stop = Event()
+    workers = [
+        Process(target=publish,
+                args=(args, pool, index, stats, times, stop),
+                name='Publisher-{}'.format(index))
+        for index in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
 
-    with ThreadPoolExecutor(max_workers=numbers,
-                            thread_name_prefix='Mqtt_Publish') as executor:
-        executor.map(start, [number for number in range(numbers)],
-                     chunksize=len(topics))
+    try:
+        report(args=args, stats=stats, workers=workers)
+    except KeyboardInterrupt:
+        stop.set()
+    for worker in workers:
+        worker.join()
+    summary = summarize(args=args, stats=stats, times=times)
+    print(json.dumps(summary, indent=4))
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: conftest.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 10:12:37
+
+Description: pytest配置，测试在项目根目录下运行（mqtt_wrapper在导入时以相对路径读取配置文件）
+"""
+
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
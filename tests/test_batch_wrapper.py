@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_batch_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 16:31:05
+
+Description: Batcher和Chunker的测试
+
+运行方法：`python -m pytest tests`
+"""
+
+import time
+from queue import Empty, Queue
+
+from utils.batch_wrapper import Batcher, Chunker
+
+
+def build_material(table, columns, value, schema='universe'):
+    """构建一个入库物料
+
+    :table: table名
+    :columns: 列名元组
+    :value: 列值列表
+    :schema: schema名
+    :returns: 物料字典
+
+    """
+    return {
+        'schema': schema,
+        'table': table,
+        'sql': 'INSERT',
+        'column': {column: 'VARCHAR' for column in columns},
+        'columns': tuple(columns),
+        'value': [list(row) for row in value],
+    }
+
+
+def test_batcher_merges_same_table():
+    batcher = Batcher(size=100, linger=60)
+    batcher.add(build_material('earth', ('a', 'b'), [[1, 2]]))
+    batcher.add(build_material('earth', ('a', 'b'), [[3, 4], [5, 6]]))
+    batcher.add(build_material('mars', ('a', ), [[7]]))
+    assert len(batcher) == 4
+
+    materials = {material['table']: material for material in batcher.drain()}
+    assert sorted(materials) == ['earth', 'mars']
+    assert materials['earth']['value'] == [[1, 2], [3, 4], [5, 6]]
+    assert materials['mars']['value'] == [[7]]
+    assert len(batcher) == 0
+    assert batcher.drain() == list()
+
+
+def test_batcher_fills_union_of_columns_with_none():
+    batcher = Batcher(size=100, linger=60)
+    batcher.add(build_material('earth', ('a', 'b'), [[1, 2]]))
+    batcher.add(build_material('earth', ('c', 'a'), [[3, 4]]))
+    batcher.add(build_material('earth', ('b', ), [[5]]))
+
+    (material, ) = batcher.drain()
+    assert material['columns'] == ('a', 'b', 'c')
+    assert material['value'] == [[1, 2, None], [4, None, 3], [None, 5, None]]
+    assert sorted(material['column']) == ['a', 'b', 'c']
+    assert '(a,b,c)' in material['sql']
+
+
+def test_batcher_ignores_empty_material():
+    batcher = Batcher(size=1, linger=0)
+    batcher.add(dict())
+    batcher.add({'sql': None})
+    assert not batcher.due()
+    assert batcher.remaining() is None
+
+
+def test_batcher_due_by_size():
+    batcher = Batcher(size=3, linger=60)
+    batcher.add(build_material('earth', ('a', ), [[1], [2]]))
+    assert not batcher.due()
+    batcher.add(build_material('earth', ('a', ), [[3]]))
+    assert batcher.due()
+
+
+def test_batcher_due_by_linger():
+    batcher = Batcher(size=100, linger=0.1)
+    batcher.add(build_material('earth', ('a', ), [[1]]))
+    assert not batcher.due()
+    assert 0 < batcher.remaining() <= 0.1
+
+    time.sleep(0.15)
+    assert batcher.remaining() == 0
+    assert batcher.due()
+
+    # 时间片从下一批的第一条数据开始计算
+    batcher.drain()
+    batcher.add(build_material('earth', ('a', ), [[2]]))
+    assert not batcher.due()
+
+
+def drain(queue):
+    """读出队列中的所有数据或数据块"""
+    items = list()
+    while True:
+        try:
+            items.append(queue.get(block=False))
+        except Empty:
+            return items
+
+
+def wait_backlog(chunker, timeout=2):
+    """等待积压区补发完毕"""
+    deadline = time.monotonic() + timeout
+    while chunker.backlog() and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+
+def test_chunker_ships_full_chunk():
+    queue = Queue()
+    chunker = Chunker(name='chunk', queue=queue, size=3, linger=3600)
+    for index in range(7):
+        chunker.put(index)
+
+    assert drain(queue) == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_chunker_ships_partial_chunk_after_linger():
+    queue = Queue()
+    chunker = Chunker(name='linger', queue=queue, size=100, linger=0.05)
+    chunker.put(b'a')
+    chunker.put(b'b')
+
+    assert queue.get(timeout=2) == [b'a', b'b']
+
+
+def test_chunker_holds_backlog_in_order_when_full():
+    queue = Queue(maxsize=1)
+    chunker = Chunker(name='full', queue=queue, size=1, linger=0)
+    for index in range(4):
+        chunker.put(index)
+    assert chunker.backlog() == 3
+    assert chunker.depth() == 1 + 3
+
+    received = list()
+    deadline = time.monotonic() + 2
+    while len(received) < 4 and time.monotonic() < deadline:
+        received += drain(queue)
+        time.sleep(0.01)
+    wait_backlog(chunker)
+
+    assert received == [0, 1, 2, 3]
+    assert chunker.backlog() == 0
+    assert chunker.dropped == 0
+
+
+def test_chunker_drops_when_backlog_is_full():
+    queue = Queue(maxsize=1)
+    chunker = Chunker(name='limit', queue=queue, size=1, linger=0, limit=2)
+    for index in range(5):
+        chunker.put(index)
+    assert chunker.backlog() == 2
+    assert chunker.dropped == 2
+
+    received = list()
+    deadline = time.monotonic() + 2
+    while len(received) < 3 and time.monotonic() < deadline:
+        received += drain(queue)
+        time.sleep(0.01)
+    wait_backlog(chunker)
+
+    # 丢弃的是最新的数据，已暂存的数据按顺序补发
+    assert received == [0, 1, 2]
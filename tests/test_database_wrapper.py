@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_database_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 14:02:37
+
+Description: PostgresqlWrapper的测试，数据库由tools/fakedb中的替身代替
+
+运行方法：`python -m pytest tests`
+"""
+
+import json
+import logging
+import struct
+import threading
+import time
+
+import pytest
+
+# 依赖psycopg2和DBUtils，未安装时跳过
+database_wrapper = pytest.importorskip('utils.database_wrapper')
+fakedb = pytest.importorskip('tools.fakedb')
+
+from psycopg2.extensions import adapt  # noqa: E402
+
+from plugins.parser_postgresql import parse_data  # noqa: E402
+from tools.genesis import genesis  # noqa: E402
+
+
+def build_conf(tmp_path, spill=False, **kwargs):
+    """构建测试使用的数据库配置
+
+    :tmp_path: 临时目录
+    :spill: 是否启用溢写日志
+    :kwargs: 其他配置项
+    :returns: 配置字典
+
+    """
+    conf = {
+        'retry': {
+            'backoff': 0,
+            'dead_letter_file': str(tmp_path / 'dead_letter.jsonl'),
+        },
+        'spill': {
+            'enable': spill,
+            'path': str(tmp_path / 'spill'),
+            'interval': 0.1,
+        },
+    }
+    conf.update(kwargs)
+
+    return conf
+
+
+def build_material(width=4, deviceid='Device-0'):
+    """构建一个入库物料
+
+    :width: 字段数
+    :deviceid: 设备ID
+    :returns: 物料字典
+
+    """
+    storage_conf = {'select': 'postgresql', 'postgresql': dict()}
+    result = parse_data(flow='postgresql',
+                        config=storage_conf,
+                        datas=genesis(width=width, deviceid=deviceid))
+
+    return result[0]
+
+
+def test_spilling_ends_under_continuous_traffic(tmp_path):
+    sink = fakedb.RecordingDatabase(latency=0.02)
+    database = database_wrapper.PostgresqlWrapper(
+        conf=build_conf(tmp_path, spill=True), workers=2, creator=sink)
+    database._spilling.set()
+
+    # 回放期间持续写入：每20ms一个批
+    results = list()
+    stop = threading.Event()
+
+    def produce():
+        while not stop.is_set():
+            results.append(database.insert(material=build_material()))
+            time.sleep(0.02)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    deadline = time.monotonic() + 8
+    while (database._spilling.is_set() or len(database.spill)) and \
+            time.monotonic() < deadline:
+        time.sleep(0.05)
+    # 结束溢写后的批直接写入数据库
+    time.sleep(0.5)
+    stop.set()
+    producer.join()
+
+    assert not database._spilling.is_set()
+    assert len(database.spill) == 0
+    assert results[0] == database_wrapper.SPILLED
+    assert results[-1] == database_wrapper.INSERTED
+    assert set(results) == {database_wrapper.SPILLED,
+                            database_wrapper.INSERTED}
+
+
+def test_values_reports_rows_per_statement(tmp_path):
+    sink = fakedb.RecordingDatabase()
+    conf = build_conf(tmp_path, insert_mode='values', page_size=2)
+    database = database_wrapper.PostgresqlWrapper(conf=conf, creator=sink)
+    material = build_material()
+    material['value'] = material['value'] * 5
+
+    messages = list()
+    handler = logging.Handler()
+    handler.emit = lambda record: messages.append(record.getMessage())
+    logger = database_wrapper.logger
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    try:
+        assert database.insert(material=material) == database_wrapper.INSERTED
+        database_wrapper.VALUES_SUMMARY.flush(force=True)
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    assert any([
+        message.startswith('Inserted 5 rows in 3 VALUES statements into '
+                           '(universe.earth)') for message in messages
+    ])
+
+
+def test_defer_dead_letters_after_max_attempts(tmp_path):
+    conf = build_conf(tmp_path)
+    conf['retry'].update(max_attempts=2, max_size=1, backoff=60)
+    database = database_wrapper.PostgresqlWrapper(
+        conf=conf, creator=fakedb.RecordingDatabase())
+    material = build_material()
+
+    assert database.defer(material=material, attempts=1,
+                          reason='a') == database_wrapper.RETRY
+    # 重试队列已满
+    assert database.defer(material=material, attempts=1,
+                          reason='b') == database_wrapper.DEAD
+    # 重试次数用尽
+    assert database.defer(material=material, attempts=2,
+                          reason='c') == database_wrapper.DEAD
+    assert len(database.retry) == 1
+
+    with open(conf['retry']['dead_letter_file'], encoding='UTF-8') as f:
+        lines = [json.loads(line) for line in f]
+    assert [(line['attempts'], line['reason']) for line in lines] == [
+        (1, 'retry queue is full (b)'), (2, 'c')
+    ]
+
+
+def stored_text(value):
+    """executemany、values和prepared方式写入VARCHAR列后存储的文本
+
+    这些方式由psycopg2将值转换为SQL字面量，字符串字面量存储其内容，其他字面量存储其文本
+
+    :value: 列值
+    :returns: str
+
+    """
+    literal = adapt(value).getquoted().decode('UTF-8')
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+
+    return literal
+
+
+def decode_binary(stream):
+    """解析COPY binary数据流中的字段
+
+    :stream: _copy_binary返回的数据流
+    :returns: 各行字段（bytes，NULL为None）组成的列表
+
+    """
+    data = stream.getvalue()
+    offset = len(database_wrapper.PGCOPY_HEADER)
+    rows = list()
+    while True:
+        (count, ) = struct.unpack_from('>h', data, offset)
+        offset += 2
+        if count == -1:
+            return rows
+        row = list()
+        for _ in range(count):
+            (length, ) = struct.unpack_from('>i', data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(data[offset:offset + length])
+            offset += length
+        rows.append(row)
+
+
+@pytest.mark.parametrize('value', [True, False, 7, 1.5, 'text', "it's"])
+def test_copy_stores_same_text_as_other_modes(tmp_path, value):
+    database = database_wrapper.PostgresqlWrapper(
+        conf=build_conf(tmp_path), creator=fakedb.RecordingDatabase())
+
+    text = database._copy_text(value=[[value]]).getvalue()
+    binary = decode_binary(database._copy_binary(types=['str'],
+                                                 value=[[value]]))
+
+    assert text == stored_text(value) + '\n'
+    assert binary == [[stored_text(value).encode('UTF-8')]]
+
+
+def test_copy_renders_containers_as_json(tmp_path):
+    database = database_wrapper.PostgresqlWrapper(
+        conf=build_conf(tmp_path), creator=fakedb.RecordingDatabase())
+    value = {'a': [1, '中\t']}
+
+    text = database._copy_text(value=[[value, None]]).getvalue()
+    binary = decode_binary(database._copy_binary(types=['jsonb', 'str'],
+                                                 value=[[value, None]]))
+
+    assert text == '{"a": [1, "中\\\\t"]}\t\\N\n'
+    assert binary == [[b'\x01' + json.dumps(value, ensure_ascii=False).encode(
+        'UTF-8'), None]]
+
+
+def test_copy_binary_encodes_numbers_and_timestamps(tmp_path):
+    database = database_wrapper.PostgresqlWrapper(
+        conf=build_conf(tmp_path), creator=fakedb.RecordingDatabase())
+
+    binary = decode_binary(
+        database._copy_binary(types=['int', 'float', 'timestamp', 'timestamp'],
+                              value=[[3, 1.5, '2000-01-01 00:00:01',
+                                      None]]))
+
+    assert binary == [[
+        struct.pack('>d', 3.0),
+        struct.pack('>d', 1.5),
+        struct.pack('>q', 1000000), None
+    ]]
+
+
+def test_copy_text_escapes_special_characters(tmp_path):
+    database = database_wrapper.PostgresqlWrapper(
+        conf=build_conf(tmp_path), creator=fakedb.RecordingDatabase())
+
+    text = database._copy_text(value=[['a\tb', 'c\nd', 'e\\f'],
+                                      ['\r', None, 2]]).getvalue()
+
+    assert text == 'a\\tb\tc\\nd\te\\\\f\n\\r\t\\N\t2\n'
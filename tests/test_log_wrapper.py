@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_log_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 15:21:44
+
+Description: Summary的测试
+
+运行方法：`python -m pytest tests`
+"""
+
+import logging
+import time
+
+from utils.log_wrapper import Summary
+
+
+class Collector(logging.Handler):
+    """收集日志消息"""
+    def __init__(self):
+        super().__init__()
+        self.messages = list()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def build_logger(name):
+    logger = logging.getLogger('DataWizard.tests.{}'.format(name))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = Collector()
+    logger.addHandler(handler)
+
+    return logger, handler
+
+
+def test_add_emits_after_interval():
+    logger, handler = build_logger('interval')
+    summary = Summary(logger, 'Got %d in (%s) in the last %.0fs', interval=0.1)
+    summary.add('a', 1)
+    summary.add('a', 2)
+    assert handler.messages == list()
+
+    time.sleep(0.15)
+    summary.add('a', 3)
+    assert handler.messages == ['Got 6 in (a) in the last 0s']
+
+
+def test_idle_window_is_flushed_by_timer():
+    logger, handler = build_logger('idle')
+    summary = Summary(logger, 'Got %d in (%s) in the last %.0fs', interval=0.1)
+    summary.add('a', 1)
+    summary.add('b', 2)
+
+    # 之后不再有add调用，由后台线程输出
+    deadline = time.monotonic() + 3
+    while len(handler.messages) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert sorted(handler.messages) == [
+        'Got 1 in (a) in the last 0s', 'Got 2 in (b) in the last 0s'
+    ]
+
+
+def test_flush_all_emits_pending_counts():
+    logger, handler = build_logger('exit')
+    summary = Summary(logger, 'Got %d in (%s) in the last %.0fs', interval=60)
+    summary.add('a', 5)
+    Summary.flush_all()
+
+    assert handler.messages == ['Got 5 in (a) in the last 0s']
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_mqtt_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 17:28:03
+
+Description: TopicRouter的测试
+
+运行方法：`python -m pytest tests`
+"""
+
+import pytest
+
+# 依赖paho-mqtt，未安装时跳过
+mqtt_wrapper = pytest.importorskip('utils.mqtt_wrapper')
+
+
+@pytest.mark.parametrize('topic, expected', [
+    ('device/a/data', 'device/+/data'),
+    ('device/a/status', 'device/+/status'),
+    ('device/a/b/data', 'device/#'),
+    ('device', 'device/#'),
+    ('sensor/x', 'sensor/x'),
+    ('sensor/y', 'sensor/+'),
+    ('sensor', None),
+    ('sensor/x/y', None),
+    ('other', None),
+])
+def test_route_matches_wildcards(topic, expected):
+    router = mqtt_wrapper.TopicRouter(filters=[
+        'device/+/data', 'device/+/status', 'device/#', 'sensor/x', 'sensor/+'
+    ])
+    assert router.route(topic) == expected
+
+
+def test_multi_level_wildcard_skips_system_topics():
+    router = mqtt_wrapper.TopicRouter(filters=['#', '+/broker'])
+    assert router.route('other/a/b') == '#'
+    assert router.route('/leading') == '#'
+    assert router.route('$SYS/broker') is None
+
+
+def test_route_returns_first_configured_filter():
+    router = mqtt_wrapper.TopicRouter(filters=['device/#', 'device/+/data'])
+    assert router.route('device/a/data') == 'device/#'
+
+    router = mqtt_wrapper.TopicRouter(filters=['device/+/data', 'device/#'])
+    assert router.route('device/a/data') == 'device/+/data'
+
+
+def test_route_without_match():
+    router = mqtt_wrapper.TopicRouter(filters=['device/+', '$SYS/#'])
+    assert router.route('device') is None
+    assert router.route('device/a/b') is None
+    assert router.route('$SYS/broker/load') == '$SYS/#'
+    # 路由结果被缓存
+    assert router.route('device/a') == 'device/+'
+    assert router.route.cache_info().hits == 0
+    assert router.route('device/a') == 'device/+'
+    assert router.route.cache_info().hits == 1
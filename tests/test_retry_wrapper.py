@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_retry_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 16:52:19
+
+Description: RetryQueue和DeadLetterFile的测试
+
+运行方法：`python -m pytest tests`
+"""
+
+import json
+import threading
+import time
+
+from utils.retry_wrapper import DeadLetterFile, RetryQueue
+
+
+def test_delay_backs_off_exponentially():
+    retry = RetryQueue(backoff=1, max_backoff=10)
+    assert [retry.delay(attempts) for attempts in range(0, 6)] == [
+        1, 1, 2, 4, 8, 10
+    ]
+
+
+def test_max_backoff_is_not_below_backoff():
+    retry = RetryQueue(backoff=5, max_backoff=1)
+    assert retry.delay(3) == 5
+
+
+def test_push_rejects_when_full():
+    retry = RetryQueue(max_size=2, backoff=0)
+    assert retry.push(material={'id': 1}, attempts=1, reason='a')
+    assert retry.push(material={'id': 2}, attempts=1, reason='b')
+    assert not retry.push(material={'id': 3}, attempts=1, reason='c')
+    assert len(retry) == 2
+
+
+def test_pop_returns_batches_by_due_time():
+    retry = RetryQueue(backoff=0.05, max_backoff=1)
+    # 第3次失败后等待0.2s，第1次失败后等待0.05s
+    retry.push(material={'id': 'late'}, attempts=3, reason='late')
+    retry.push(material={'id': 'early'}, attempts=1, reason='early')
+
+    start = time.monotonic()
+    assert retry.pop(timeout=2) == ({'id': 'early'}, 1, 'early')
+    assert time.monotonic() - start >= 0.05
+    assert retry.pop(timeout=2) == ({'id': 'late'}, 3, 'late')
+    assert time.monotonic() - start >= 0.2
+    assert len(retry) == 0
+
+
+def test_pop_times_out_before_due():
+    retry = RetryQueue(backoff=10)
+    retry.push(material={'id': 1}, attempts=1, reason='a')
+
+    start = time.monotonic()
+    assert retry.pop(timeout=0.1) is None
+    assert 0.1 <= time.monotonic() - start < 5
+    assert len(retry) == 1
+
+
+def test_pop_wakes_up_on_push():
+    retry = RetryQueue(backoff=0)
+    results = list()
+    consumer = threading.Thread(
+        target=lambda: results.append(retry.pop(timeout=5)))
+    consumer.start()
+    time.sleep(0.05)
+    retry.push(material={'id': 1}, attempts=2, reason='a')
+    consumer.join(timeout=5)
+
+    assert results == [({'id': 1}, 2, 'a')]
+
+
+def test_dead_letter_file_appends_json_lines(tmp_path):
+    filename = tmp_path / 'logs' / 'dead_letter.jsonl'
+    dead_letters = DeadLetterFile(filename=str(filename))
+    material = {'schema': 'universe', 'table': 'earth', 'value': [['中', 1]]}
+    dead_letters.write(material=material, attempts=5, reason=ValueError('x'))
+    dead_letters.write(material=dict(), attempts=1, reason='y')
+
+    lines = [
+        json.loads(line)
+        for line in filename.read_text(encoding='UTF-8').splitlines()
+    ]
+    assert len(lines) == 2
+    assert lines[0]['schema'] == 'universe'
+    assert lines[0]['table'] == 'earth'
+    assert lines[0]['attempts'] == 5
+    assert lines[0]['reason'] == 'x'
+    assert lines[0]['material'] == material
+    assert (lines[1]['schema'], lines[1]['table']) == ('public', 'example')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_ring_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 14:40:18
+
+Description: RingBuffer的测试
+
+运行方法：`python -m pytest tests`
+"""
+
+import time
+from queue import Empty, Full
+
+import pytest
+
+from utils.batch_wrapper import Chunker
+from utils.ring_wrapper import LENGTH, RingBuffer
+
+
+@pytest.fixture
+def ring():
+    """容量为64字节的环形缓冲区"""
+    buffer = RingBuffer(size=64)
+    yield buffer
+    buffer.release()
+
+
+def drain(buffer):
+    """读出缓冲区中的所有记录"""
+    records = list()
+    while True:
+        try:
+            records.append(buffer.get(block=False))
+        except Empty:
+            return records
+
+
+def test_put_get_wraps_around(ring):
+    for index in range(20):
+        ring.put(b'record-%d' % index)
+        assert ring.get(block=False) == b'record-%d' % index
+    assert ring.empty()
+    assert ring.nbytes() == 0
+
+
+def test_chunk_returns_records_one_by_one(ring):
+    assert ring.put([b'a', b'bb', b'ccc']) == 3
+    assert ring.qsize() == 3
+    assert drain(ring) == [b'a', b'bb', b'ccc']
+
+
+def test_oversized_record_is_rejected(ring):
+    assert ring.put(b'x' * 100) == 1
+    assert ring.rejected() == 1
+    assert ring.empty()
+
+
+def test_full_chunk_is_not_written(ring):
+    ring.put(b'x' * (64 - LENGTH.size - 10))
+    with pytest.raises(Full):
+        ring.put([b'a' * 4, b'b' * 4], block=False)
+    assert ring.qsize() == 1
+
+
+def test_put_timeout(ring):
+    ring.put(b'x' * (64 - LENGTH.size))
+    start = time.monotonic()
+    with pytest.raises(Full):
+        ring.put(b'y', timeout=0.1)
+    assert time.monotonic() - start >= 0.1
+
+
+def test_oversized_chunk_is_written_in_part(ring):
+    chunk = [b'%02d' % index + b'-' * 10 for index in range(6)]
+    # 每条记录占16字节，64字节只能放下前4条
+    assert ring.put(chunk, block=False) == 4
+    assert drain(ring) == chunk[:4]
+
+
+def test_chunker_keeps_rest_without_duplicates(ring):
+    chunker = Chunker(name='ring', queue=ring, size=6, linger=3600)
+    chunk = [b'%02d' % index + b'-' * 10 for index in range(6)]
+    for record in chunk:
+        chunker.put(record)
+    assert chunker.backlog() == 2
+
+    received = drain(ring)
+    deadline = time.monotonic() + 2
+    while chunker.backlog() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    received += drain(ring)
+
+    assert received == chunk
+
+
+def test_chunker_depth_counts_bytes(ring):
+    chunker = Chunker(name='ring', queue=ring, size=1, linger=0)
+    chunker.put(b'x' * 40)
+    chunker.put(b'y' * 30)
+    # 第二条放不下，留在积压区
+    assert chunker.backlog() == 1
+    assert chunker.depth() == LENGTH.size + 40 + 30
+
+    # 读出后积压区补发完毕，再释放缓冲区
+    ring.get()
+    deadline = time.monotonic() + 2
+    while chunker.backlog() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert chunker.backlog() == 0
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_scale_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 16:08:27
+
+Description: Autoscaler的测试
+
+运行方法：`python -m pytest tests`
+"""
+
+import logging
+import threading
+
+from utils import scale_wrapper
+from utils.scale_wrapper import Autoscaler
+
+
+def spawn(topic, stop):
+    """启动一个等待停止事件的worker"""
+    task = threading.Thread(target=stop.wait, daemon=True)
+    task.start()
+
+    return task
+
+
+def test_hold_warns_only_on_state_change(caplog):
+    depth = {'a': 1000}
+    scaler = Autoscaler(topics=['a'],
+                        spawn=spawn,
+                        depth=depth.get,
+                        ping=lambda: 0.01,
+                        min_workers=1,
+                        max_workers=1,
+                        high=10)
+    scaler.start()
+    try:
+        with caplog.at_level(logging.DEBUG, logger=scale_wrapper.logger.name):
+            for _ in range(3):
+                scaler.step(rtt=0.01)
+            scaler.step(rtt=None)
+            # 积压消失后再次达到上限重新记录
+            depth['a'] = 0
+            scaler.step(rtt=0.01)
+            depth['a'] = 1000
+            scaler.step(rtt=0.01)
+    finally:
+        for topic in scaler.topics:
+            while scaler.workers(topic):
+                scaler._shrink(topic)
+
+    warnings = [
+        record.getMessage().split(' (depth')[0] for record in caplog.records
+        if record.levelno == logging.WARNING
+    ]
+    assert warnings == [
+        'Hold (a) at 1: reached maximum',
+        'Hold (a) at 1: reached maximum',
+    ]
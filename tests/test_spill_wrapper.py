@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_spill_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 17:10:46
+
+Description: SpillLog的测试
+
+运行方法：`python -m pytest tests`
+"""
+
+import os
+
+import pytest
+
+from utils.spill_wrapper import RECORD, SEGMENT, SpillLog
+
+
+def build_material(index):
+    """构建一个入库物料"""
+    return {
+        'schema': 'universe',
+        'table': 'earth',
+        'columns': ('id', 'name'),
+        'value': [[index, '中-{}'.format(index)]],
+    }
+
+
+def replay_all(spill):
+    """回放所有记录
+
+    :returns: 回放的物料列表
+
+    """
+    materials = list()
+    assert spill.replay(materials.append) == len(materials)
+
+    return materials
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_replay_in_order(tmp_path, compress):
+    spill = SpillLog(path=str(tmp_path), segment_size=100, compress=compress)
+    for index in range(10):
+        spill.append(build_material(index))
+    assert len(spill) == 10
+    assert spill.backlog()['segments'] > 1
+
+    assert replay_all(spill) == [build_material(index) for index in range(10)]
+    assert len(spill) == 0
+    assert os.listdir(str(tmp_path)) == list()
+
+
+def test_replay_resumes_from_failed_record(tmp_path):
+    spill = SpillLog(path=str(tmp_path))
+    for index in range(5):
+        spill.append(build_material(index))
+
+    materials = list()
+
+    def fail_on_third(material):
+        if len(materials) == 2:
+            raise ConnectionError('database is down')
+        materials.append(material)
+
+    with pytest.raises(ConnectionError):
+        spill.replay(fail_on_third)
+    assert len(spill) == 3
+
+    assert replay_all(spill) == [build_material(index) for index in (2, 3, 4)]
+
+
+def test_recover_segments_left_by_last_run(tmp_path):
+    spill = SpillLog(path=str(tmp_path), segment_size=100)
+    for index in range(6):
+        spill.append(build_material(index))
+    spill._seal()
+    # 空段在恢复时被删除
+    open(os.path.join(str(tmp_path), SEGMENT.format(seq=99)), 'wb').close()
+
+    recovered = SpillLog(path=str(tmp_path), segment_size=100)
+    assert len(recovered) == 6
+    assert recovered.size() == spill.size()
+    assert replay_all(recovered) == [
+        build_material(index) for index in range(6)
+    ]
+    # 新的段序号在遗留的段之后
+    recovered.append(build_material(6))
+    assert os.listdir(str(tmp_path)) == [SEGMENT.format(seq=100)]
+
+
+def test_recover_ignores_truncated_record(tmp_path):
+    spill = SpillLog(path=str(tmp_path))
+    for index in range(3):
+        spill.append(build_material(index))
+    spill._seal()
+    filename = os.path.join(str(tmp_path), SEGMENT.format(seq=0))
+    complete = os.path.getsize(filename)
+    # 模拟写入中途进程退出：末尾只有一部分记录
+    with open(filename, 'ab') as f:
+        f.write(RECORD.pack(100, 0) + b'partial')
+
+    assert SpillLog._scan(filename) == (complete, 3)
+    recovered = SpillLog(path=str(tmp_path))
+    assert len(recovered) == 3
+    assert replay_all(recovered) == [
+        build_material(index) for index in range(3)
+    ]
+
+
+def test_replay_skips_corrupted_record(tmp_path):
+    spill = SpillLog(path=str(tmp_path), compress=False)
+    for index in range(3):
+        spill.append(build_material(index))
+    spill._seal()
+    filename = os.path.join(str(tmp_path), SEGMENT.format(seq=0))
+    with open(filename, 'r+b') as f:
+        # 破坏第一条记录的数据，CRC32校验失败
+        f.seek(RECORD.size)
+        f.write(b'#')
+
+    recovered = SpillLog(path=str(tmp_path), compress=False)
+    assert replay_all(recovered) == [build_material(1), build_material(2)]
+    assert len(recovered) == 0
+
+
+def test_trim_drops_oldest_segment(tmp_path):
+    record = len(SpillLog(path=str(tmp_path / 'probe'),
+                          compress=False)._encode(
+                              build_material(0))) + RECORD.size
+    spill = SpillLog(path=str(tmp_path / 'spill'),
+                     segment_size=record * 2,
+                     max_size=record * 4,
+                     compress=False)
+    for index in range(5):
+        spill.append(build_material(index))
+
+    # 每段2条，第5条写入后总大小超过4条，丢弃最旧的段
+    assert spill.dropped == 2
+    assert spill.backlog()['dropped'] == 2
+    assert len(spill) == 3
+    assert replay_all(spill) == [
+        build_material(index) for index in range(2, 5)
+    ]
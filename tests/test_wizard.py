@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: test_wizard.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-17 10:15:04
+
+Description: Wizard进程的测试，数据库由tools/fakedb中的替身代替
+
+运行方法：`python -m pytest tests`
+"""
+
+import multiprocessing
+import time
+
+import pytest
+
+# 依赖psycopg2、DBUtils和paho-mqtt，未安装时跳过
+main = pytest.importorskip('main')
+fakedb = pytest.importorskip('tools.fakedb')
+
+from plugins.parser_postgresql import parse_data  # noqa: E402
+from tools.genesis import genesis  # noqa: E402
+
+# 'thread'和'autoscale'模式的Wizard进程由主进程fork
+fork = multiprocessing.get_context('fork')
+
+
+def build_config(tmp_path, spill=False):
+    """构建测试使用的配置
+
+    :tmp_path: 临时目录
+    :spill: 是否启用溢写日志
+    :returns: 配置字典
+
+    """
+    return {
+        'main': {
+            'mode': 'thread',
+            'number': 1,
+        },
+        'source': {
+            'select': 'mqtt',
+            'mqtt': {
+                'topics': ['test/0']
+            },
+        },
+        'storage': {
+            'select': 'postgresql',
+            'postgresql': {
+                'reject_file': str(),
+                'retry': {
+                    'backoff': 0,
+                    'dead_letter_file': str(tmp_path / 'dead_letter.jsonl'),
+                },
+                'spill': {
+                    'enable': spill,
+                    'path': str(tmp_path / 'spill'),
+                    'interval': 0.1,
+                },
+            },
+        },
+        'metrics': {
+            'enable': False
+        },
+        'log': {
+            'console': False,
+            'file': False
+        },
+    }
+
+
+def build_material(width=4):
+    """构建一个入库物料
+
+    :width: 字段数
+    :returns: 物料字典
+
+    """
+    storage_conf = {'select': 'postgresql', 'postgresql': dict()}
+    result = parse_data(flow='postgresql',
+                        config=storage_conf,
+                        datas=genesis(width=width))
+
+    return result[0]
+
+
+def wait_for(condition, timeout=5):
+    """等待condition()为真
+
+    :condition: 无参数的判断函数
+    :timeout: 最长等待时间（秒）
+    :returns: condition()最后一次的结果
+
+    """
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    return condition()
+
+
+def drain_retry(wizard, material, result):
+    """Wizard进程：将一个批交给重试队列，等待重试线程将其写入"""
+    database = wizard.open_database()
+    database.defer(material=material, attempts=1, reason='test')
+    inserted = wait_for(
+        lambda: wizard.creator.stats()['rows'] >= len(material['value']))
+    result.put((inserted, len(database.retry)))
+
+
+def test_deferred_batch_drained_after_fork(tmp_path):
+    sink = fakedb.RecordingDatabase()
+    wizard = main.Wizard(build_config(tmp_path), creator=sink)
+    # 数据存储客户端（及其重试线程）不在fork之前构建
+    assert wizard.database is None
+
+    material = build_material()
+    result = fork.Queue()
+    process = fork.Process(target=drain_retry,
+                           args=(wizard, material, result))
+    process.start()
+    inserted, remaining = result.get(timeout=10)
+    process.join(timeout=10)
+
+    assert inserted
+    assert remaining == 0
+
+
+def replay_spill(wizard, material, result):
+    """Wizard进程：数据库不可用期间写入溢写日志，等待回放线程回放并结束溢写"""
+    database = wizard.open_database()
+    database._spilling.set()
+    spilled = database.insert(material=material)
+    replayed = wait_for(lambda: not database._spilling.is_set())
+    result.put((spilled, replayed, len(database.spill)))
+
+
+def test_spilling_ends_after_fork(tmp_path):
+    sink = fakedb.RecordingDatabase()
+    wizard = main.Wizard(build_config(tmp_path, spill=True), creator=sink)
+
+    material = build_material()
+    result = fork.Queue()
+    process = fork.Process(target=replay_spill,
+                           args=(wizard, material, result))
+    process.start()
+    spilled, replayed, backlog = result.get(timeout=10)
+    process.join(timeout=10)
+
+    assert spilled == 'spilled'
+    assert replayed
+    assert backlog == 0
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: fakedb.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 19:42:18
+
+Description: For testing only
+
+记录SQL而不执行的PostgreSQL替身，兼容psycopg2的连接接口（DB-API 2），
+可作为PostgresqlWrapper和Wizard的creator参数，在没有数据库的情况下测量入库路径的开销
+
+    from tools.fakedb import RecordingDatabase
+    sink = RecordingDatabase(latency=0.001)
+    wizard = Wizard(config, creator=sink)
+    ... ...
+    print(sink.stats())
+"""
+
+import collections
+import threading
+import time
+
+from psycopg2 import (DatabaseError, Error, IntegrityError, InterfaceError,
+                      InternalError, OperationalError, ProgrammingError)
+
+
+def quote(value):
+    """将Python值转换为SQL字面量（只用于mogrify）
+
+    :value: Python值
+    :returns: str
+
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+class RecordingCursor(object):
+    """记录SQL的cursor"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self._result = list()
+
+    def _record(self, sql, rows=0, size=0):
+        self.connection.database.record(sql=sql, rows=rows, size=size)
+
+    def execute(self, sql, args=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode('UTF-8')
+        self._record(sql=sql)
+
+        # 只应答PostgresqlWrapper用到的查询，目录查询返回空（即数据库是空的）
+        if sql.startswith('SELECT 1'):
+            self._result = [(1, )]
+        elif sql.startswith('SELECT to_regclass'):
+            self._result = [(None, )]
+        else:
+            self._result = list()
+
+    def executemany(self, sql, args_list):
+        args_list = list(args_list)
+        self._record(sql=sql, rows=len(args_list))
+        self.rowcount = len(args_list)
+
+    def mogrify(self, sql, args=None):
+        if args is not None:
+            sql = sql % tuple([quote(arg) for arg in args])
+
+        return sql.encode('UTF-8')
+
+    def copy_expert(self, sql, file, size=8192):
+        copied = 0
+        while True:
+            block = file.read(size)
+            if not block:
+                break
+            copied += len(block)
+        self._record(sql=sql, size=copied)
+
+    def fetchall(self):
+        result, self._result = self._result, list()
+        return result
+
+    def fetchone(self):
+        return self._result.pop(0) if self._result else None
+
+    def close(self):
+        pass
+
+
+class RecordingConnection(object):
+    """记录SQL的连接"""
+    encoding = 'UTF8'
+    autocommit = False
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = 0
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(connection=self)
+
+    def commit(self):
+        self.database.record(sql='COMMIT')
+
+    def rollback(self):
+        self.database.record(sql='ROLLBACK')
+
+    def close(self):
+        self.closed = 1
+
+
+class RecordingDatabase(object):
+    """PostgreSQL替身，connect()返回记录SQL的连接
+
+    兼容DB-API 2模块的接口（connect、threadsafety和异常类），可直接用作DBUtils的creator
+    """
+    apilevel = '2.0'
+    threadsafety = 2
+    paramstyle = 'pyformat'
+
+    Error = Error
+    DatabaseError = DatabaseError
+    InterfaceError = InterfaceError
+    OperationalError = OperationalError
+    InternalError = InternalError
+    IntegrityError = IntegrityError
+    ProgrammingError = ProgrammingError
+
+    def __init__(self, latency=0, keep=0):
+        """初始化方法
+
+        :latency: 每条语句（包括COMMIT）模拟的往返时间（秒）
+        :keep: 保留最近的SQL语句条数，用于检查
+
+        """
+        self.latency = latency
+        self.statements = collections.deque(maxlen=keep or None)
+        self.keep = keep
+        self._lock = threading.Lock()
+        self.reset()
+
+    def connect(self, *args, **kwargs):
+        with self._lock:
+            self.connections += 1
+        return RecordingConnection(database=self)
+
+    def __call__(self, *args, **kwargs):
+        return self.connect(*args, **kwargs)
+
+    def reset(self):
+        """清空记录"""
+        with self._lock:
+            self.connections = 0
+            self.counts = collections.Counter()
+            self.rows = 0
+            self.copied = 0
+            self.statements.clear()
+
+    def record(self, sql, rows=0, size=0):
+        """记录一条语句
+
+        :sql: SQL语句
+        :rows: executemany的参数组数
+        :size: COPY的数据字节数
+
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        kind = sql.split(None, 1)[0].upper() if sql else str()
+        with self._lock:
+            self.counts[kind] += 1
+            self.rows += rows
+            self.copied += size
+            if self.keep:
+                self.statements.append(sql)
+
+    def stats(self):
+        """记录的统计信息
+
+        :returns: 字典，结构为：
+                  {
+                      'connections': 创建的连接数,
+                      'statements': {'INSERT': 语句数, 'COMMIT': 语句数, ...},
+                      'rows': executemany的参数组数,
+                      'copied': COPY的数据字节数,
+                  }
+
+        """
+        with self._lock:
+            return {
+                'connections': self.connections,
+                'statements': dict(self.counts),
+                'rows': self.rows,
+                'copied': self.copied,
+            }
@@ -23,10 +23,35 @@ BLACK_HOLE_MAX = 100
 LIGHT_YEAR = 2
 MAGNITUDE = ['int', 'float', 'str']
 NEBULA = ['time', 'kg', 'Nm', '%', 'PH', 'ppm', 'm/s', 'lm']
+# 默认字段数
+WIDTH = len(greek)**2
 
 
-def genesis():
+def humans(width):
+    """生成width个字段名，超过576个时在字段名后加序号
+
+    :width: 字段数
+    :returns: 字段名列表
+
+    """
+    names = ['{}{}'.format(x, y) for x in greek for y in greek]
+    result = names[:width]
+    rounds = 1
+    while len(result) < width:
+        result.extend([
+            '{}{}'.format(name, rounds)
+            for name in names[:width - len(result)]
+        ])
+        rounds += 1
+
+    return result
+
+
+def genesis(width=WIDTH, deviceid='Alpha'):
     """Genesis
+
+    :width: 字段数（默认576）
+    :deviceid: 设备ID
     :returns: universe
 
     """
@@ -36,26 +61,22 @@ def genesis():
     timestamp = time.time()
     timestr = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
 
-    deviceid = 'Alpha'
-
-    for x in greek:
-        for y in greek:
-            human = '{}{}'.format(x, y)
-            world.update({
-                human: {
-                    'name':
-                    human,
-                    'title':
-                    human.upper(),
-                    'value':
-                    round(random.uniform(BLACK_HOLE_MIN, BLACK_HOLE_MAX),
-                          LIGHT_YEAR),
-                    'type':
-                    random.choice(MAGNITUDE),
-                    'unit':
-                    random.choice(NEBULA)
-                }
-            })
+    for human in humans(width):
+        world.update({
+            human: {
+                'name':
+                human,
+                'title':
+                human.upper(),
+                'value':
+                round(random.uniform(BLACK_HOLE_MIN, BLACK_HOLE_MAX),
+                      LIGHT_YEAR),
+                'type':
+                random.choice(MAGNITUDE),
+                'unit':
+                random.choice(NEBULA)
+            }
+        })
 
     universe['timestamp'] = timestr
     universe['schema'] = 'universe'
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: batch_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 09:12:40
+
+Description: 数据分批，将入库物料按schema.table合并成批
+
+支持两种分批方案（可同时生效，先满足者触发）：
+    1. 按队列大小：批内行数达到batch_size
+    2. 按时间片：批内第一条数据等待时间达到linger秒
+
+数据源进程中的原始数据也以同样的方式攒成小块（Chunker）后再放入进程间队列，
+多进程模式下按deviceid的哈希值分片（shard），同一设备的数据始终进入同一个分片
+"""
+
+import collections
+import logging
+import re
+import threading
+import time
+import zlib
+from queue import Full
+
+from plugins.parser_postgresql import build_template
+from utils.log_wrapper import Summary
+
+logger = logging.getLogger('DataWizard.utils.batch_wrapper')
+
+# 热路径日志汇总
+OVERFLOW_SUMMARY = Summary(
+    logger,
+    'Dropped %d messages for (%s): local backlog is full, in the last %.0fs',
+    level=logging.ERROR)
+
+# 从原始数据中提取deviceid的值，无需解码整条JSON
+DEVICEID = re.compile(rb'"deviceid"\s*:\s*"?([^",}\s]*)')
+
+
+class Batcher(object):
+    """按schema.table合并入库物料的批处理器
+
+    同一schema.table的物料合并为一个物料，flush时每个table只执行一次insert
+    同一table的列集合不一致时取其并集，缺失的列值以None填充
+    """
+    def __init__(self, size, linger):
+        """初始化方法
+
+        :size: 批内行数阈值
+        :linger: 批内第一条数据的最长等待时间（秒）
+
+        """
+        self.size = max(int(size), 1)
+        self.linger = max(float(linger), 0)
+
+        self._batches = dict()  # {'schema.table': material}
+        self._rows = 0  # 批内总行数
+        self._deadline = None  # 时间片截止时刻
+
+    def __len__(self):
+        return self._rows
+
+    def add(self, material):
+        """将一个入库物料加入批
+
+        :material: parse_data返回的物料字典
+
+        """
+        if not material or not material.get('sql'):
+            return
+
+        schema = material.get('schema', 'public')
+        table = material.get('table', 'example')
+        columns = tuple(material.get('columns', tuple()))
+        values = material.get('value', list())
+        key = '{schema}.{table}'.format(schema=schema, table=table)
+
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = {
+                'schema': schema,
+                'table': table,
+                'sql': material.get('sql'),
+                'value': list(),
+                'column': dict(),
+                'columns': columns,
+            }
+            self._batches[key] = batch
+        batch['column'].update(material.get('column', dict()))
+
+        if columns is batch['columns'] or columns == batch['columns']:
+            # 列集合与批一致（通常是同一个模板缓存对象），直接合并列值
+            batch['value'].extend(values)
+        else:
+            # 列集合不一致，将列值按批的列顺序重排，新列追加到末尾
+            batch['columns'] += tuple([
+                column for column in columns
+                if column not in batch['columns']
+            ])
+            position = {
+                column: index
+                for index, column in enumerate(batch['columns'])
+            }
+            places = [position[column] for column in columns]
+            for value in values:
+                row = [None] * len(batch['columns'])
+                for place, item in zip(places, value):
+                    row[place] = item
+                batch['value'].append(row)
+
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self.linger
+        self._rows += len(values)
+
+    def remaining(self):
+        """距离时间片截止的剩余秒数
+
+        :returns: 批为空时返回None（无需等待），否则返回非负的剩余秒数
+
+        """
+        if self._deadline is None:
+            return None
+        return max(self._deadline - time.monotonic(), 0)
+
+    def due(self):
+        """判断是否需要flush
+
+        :returns: bool
+
+        """
+        if not self._rows:
+            return False
+        return self._rows >= self.size or self.remaining() == 0
+
+    def drain(self):
+        """取出批内所有物料并重置批
+
+        :returns: 物料列表，每个schema.table一个
+
+        """
+        materials = list()
+        for batch in self._batches.values():
+            width = len(batch['columns'])
+            for row in batch['value']:
+                # 补齐之后新增的列
+                if len(row) < width:
+                    row.extend([None] * (width - len(row)))
+            batch['sql'], _ = build_template(schema=batch['schema'],
+                                             table=batch['table'],
+                                             columns=batch['columns'])
+            materials.append(batch)
+
+        self._batches = dict()
+        self._rows = 0
+        self._deadline = None
+
+        return materials
+
+
+class Chunker(object):
+    """将原始数据攒成小块后放入进程间队列
+
+    块内数据条数达到size或第一条数据等待时间达到linger秒时，整块（list）放入队列，
+    以减少每条数据一次的Queue.put/get开销
+    放入队列不会阻塞调用者（paho网络线程）：队列已满时数据暂存在本地积压区，
+    由后台线程在队列有空间时按顺序补发；积压区也满时丢弃新数据并计数
+    """
+    def __init__(self, name, queue, size, linger, limit=0):
+        """初始化方法
+
+        :name: 队列名
+        :queue: 进程间队列
+        :size: 块内数据条数阈值，不大于1时每条数据单独放入队列
+        :linger: 块内第一条数据的最长等待时间（秒）
+        :limit: 积压区最多暂存的数据或数据块个数，不大于0表示不限制
+
+        """
+        self.name = name
+        self.queue = queue
+        self.size = max(int(size), 1)
+        self.linger = max(float(linger), 0)
+        self.limit = max(int(limit), 0)
+        # 因积压区已满而丢弃的数据条数
+        self.dropped = 0
+
+        self._chunk = list()
+        self._deadline = None
+        # 队列已满时暂存的数据或数据块：[(数据或数据块, 数据条数), ...]
+        self._backlog = collections.deque()
+        # 取块和放入队列在同一把锁内完成，保证块的先后顺序
+        self._lock = threading.Lock()
+
+        # 后台线程，size为1时只在积压区有数据时运行
+        self._flusher = None
+        if self.size > 1:
+            self._wake()
+
+    def _wake(self):
+        """启动后台线程（未运行时）"""
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name='Chunker-{}'.format(
+                                                 self.name),
+                                             daemon=True)
+            self._flusher.start()
+
+    def _put(self, item):
+        """将数据或数据块非阻塞地放入队列（调用者须持有锁）
+
+        RingBuffer可能只写入数据块的前若干条（见RingBuffer.put）
+
+        :item: 单条数据或数据块
+        :returns: 未放入队列的剩余数据块，None表示全部放入
+        :raises: 队列已满时抛出Full
+
+        """
+        done = self.queue.put(item, block=False)
+        if isinstance(item, list) and done is not None and done < len(item):
+            return item[done:]
+
+        return None
+
+    def _ship(self, item, count):
+        """将数据或数据块放入队列，队列已满时放入积压区（调用者须持有锁）
+
+        :item: 单条数据或数据块
+        :count: 数据条数
+
+        """
+        if not self._backlog:
+            try:
+                rest = self._put(item)
+                if rest is None:
+                    logger.debug('Put %d messages in the queue (%s)', count,
+                                 self.name)
+                    return
+                item, count = rest, len(rest)
+            except Full:
+                logger.error('Queue {name} is full, holding messages '
+                             'locally'.format(name=self.name))
+        if self.limit and len(self._backlog) >= self.limit:
+            self.dropped += count
+            OVERFLOW_SUMMARY.add(self.name, count)
+            return
+        self._backlog.append((item, count))
+        self._wake()
+
+    def _drain_backlog(self):
+        """将积压区的数据按顺序放入队列，直到队列再次变满（调用者须持有锁）"""
+        while self._backlog:
+            item, _ = self._backlog[0]
+            try:
+                rest = self._put(item)
+            except Full:
+                return
+            if rest is not None:
+                self._backlog[0] = (rest, len(rest))
+                return
+            self._backlog.popleft()
+
+    def backlog(self):
+        """积压区中的数据条数"""
+        return sum([count for _, count in list(self._backlog)])
+
+    def depth(self):
+        """队列深度，包括积压区中的数据或数据块
+
+        RingBuffer的容量以字节计，此时返回缓冲区已用字节数与积压区数据字节数之和
+
+        """
+        if hasattr(self.queue, 'nbytes'):
+            return self.queue.nbytes() + sum([
+                sum([len(data) for data in item]) if isinstance(
+                    item, list) else len(item)
+                for item, _ in list(self._backlog)
+            ])
+
+        return self.queue.qsize() + len(self._backlog)
+
+    def put(self, item):
+        """加入一条原始数据
+
+        :item: 原始数据
+
+        """
+        with self._lock:
+            if self.size == 1:
+                self._ship(item, 1)
+                return
+
+            self._chunk.append(item)
+            if self._deadline is None:
+                self._deadline = time.monotonic() + self.linger
+            if len(self._chunk) >= self.size:
+                chunk = self._take()
+                self._ship(chunk, len(chunk))
+
+    def _take(self):
+        """取出当前块（调用者须持有锁）"""
+        chunk = self._chunk
+        self._chunk = list()
+        self._deadline = None
+
+        return chunk
+
+    def _flush_loop(self):
+        """定时检查，补发积压区中的数据，块内第一条数据等待超过linger秒则放入队列"""
+        tick = min(self.linger, 0.01) or 0.001
+        while True:
+            time.sleep(tick)
+            with self._lock:
+                self._drain_backlog()
+                if self.size == 1 and not self._backlog:
+                    # 不攒块时没有需要定时放入的数据，积压区补发完即退出
+                    self._flusher = None
+                    return
+                if self._deadline is not None and \
+                        time.monotonic() >= self._deadline:
+                    chunk = self._take()
+                    self._ship(chunk, len(chunk))
+
+
+def shard(payload, fallback, count):
+    """计算原始数据所属的分片
+
+    按deviceid的CRC32分片（跨进程、跨重启稳定），同一设备的数据始终进入同一分片，
+    原始数据中没有deviceid时按fallback（通常是topic）分片
+
+    :payload: 原始数据（bytes）
+    :fallback: 没有deviceid时使用的分片键
+    :count: 分片数
+    :returns: 分片序号，范围为[0, count)
+
+    """
+    if count <= 1:
+        return 0
+
+    match = DEVICEID.search(payload)
+    key = match.group(1) if match else fallback.encode('UTF-8')
+
+    return zlib.crc32(key) % count
@@ -9,16 +9,32 @@ Created Time: 2020-10-27 17:25:23
 Description: 与数据库进行交互
 """
 
+import asyncio
+import io
+import itertools
 import json
 import logging
+import os
+import string
+import struct
+import threading
 import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 import psycopg2
 import toml
 # 在so文件中实现，因此定位不到，但可用
 from psycopg2.errors import (DuplicateSchema, DuplicateTable, InterfaceError,
-                             InvalidSchemaName, OperationalError,
-                             UndefinedColumn, UndefinedTable)
+                             InvalidSchemaName, InvalidSqlStatementName,
+                             OperationalError, UndefinedColumn,
+                             UndefinedTable)
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+from psycopg2.extras import execute_values
 
 try:
     # 不要使用DBUtils.PooledPg.PooledPg
@@ -27,51 +43,70 @@ except (ModuleNotFoundError, Exception):
     # 不要使用dbutils.pooled_pg.PooledPg
     from dbutils.pooled_db import PooledDB  # dbutils.__version__ >= 2.0
 
-logger = logging.getLogger('DataWizard.utils.database_wrapper')
-
-
-def checker(data):
-    """检查数据结构是否符合要求
+from plugins.parser_postgresql import checker
+from utils import metrics_wrapper as metrics
+from utils.log_wrapper import Summary
+from utils.retry_wrapper import DeadLetterFile, RetryQueue
+from utils.spill_wrapper import SpillLog
 
-    :data: 待检查数据
-    :returns: int
-
-    """
-    # 默认检查结果符合要求
-    result = 1
-
-    if isinstance(data, dict):
-        # 当data是字典，只有其'fields'元素的值是个双层嵌套字典才符合要求
-        fields = data.get('fields')
-        # 检查'fields'是否非空字典
-        if fields and isinstance(fields, dict):
-            for field in fields.values():
-                # 检查'fields'的第二层是否字典
-                if not isinstance(field, dict):
-                    result -= 1
-        else:
-            result -= 1
-    elif isinstance(data, list):
-        # 当data是列表，只有其每个元素都是字典
-        # 且每个字典的'fields'元素的值是个双层嵌套字典才符合要求
-        for dat in data:
-            # 检查列表的元素是否非空字典
-            if dat and isinstance(dat, dict):
-                fields = dat.get('fields')
-                # 检查'fields'是否非空字典
-                if fields and isinstance(fields, dict):
-                    for field in fields.values():
-                        # 检查'fields'的第二层是否字典
-                        if not isinstance(field, dict):
-                            result -= 1
-                else:
-                    result -= 1
-            else:
-                result -= 1
-    else:
-        result -= 1
+logger = logging.getLogger('DataWizard.utils.database_wrapper')
 
-    return result
+# COPY text格式需要转义的字符
+COPY_ESCAPE = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+# COPY binary格式的文件头（签名 + flags + 头扩展区长度）和文件尾
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+# TIMESTAMP在binary格式中以距2000-01-01的微秒数表示
+PG_EPOCH = datetime(2000, 1, 1)
+PACK_COUNT = struct.Struct('>h').pack  # 每行的列数
+PACK_LENGTH = struct.Struct('>i').pack  # 列值长度，-1表示NULL
+PACK_DOUBLE = struct.Struct('>id').pack  # 长度 + DOUBLE PRECISION
+PACK_BIGINT = struct.Struct('>iq').pack  # 长度 + TIMESTAMP
+# JSONB在binary格式中的版本号
+JSONB_VERSION = b'\x01'
+# 未加引号的标识符在PostgreSQL中只有ASCII大写字母会被转为小写
+FOLD_IDENTIFIER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+# insert的返回值：已写入、已写入溢写日志、已放入重试队列、已转入死信存储
+INSERTED = 'inserted'
+SPILLED = 'spilled'
+RETRY = 'retry'
+DEAD = 'dead'
+
+# 运行指标
+INSERT_RESULTS = metrics.counter('datawizard_insert_batches_total',
+                                 'Batches handled by insert, by result',
+                                 ['result'])
+INSERT_ROWS = metrics.counter('datawizard_insert_rows_total',
+                              'Rows written, by schema.table', ['table'])
+INSERT_LATENCY = metrics.histogram('datawizard_insert_seconds',
+                                   'Time to write one batch, by schema.table',
+                                   ['table'])
+DDL_EVENTS = metrics.counter('datawizard_ddl_total',
+                             'DDL executed to create schemas/tables/columns',
+                             ['kind'])
+RECONNECTS = metrics.counter('datawizard_reconnects_total',
+                             'Reconnections to PostgreSQL', ['client'])
+POOL_IN_USE = metrics.gauge('datawizard_pool_in_use',
+                            'Connections checked out of the pool', ['client'])
+POOL_MAX = metrics.gauge('datawizard_pool_max',
+                         'Maximum connections of the pool', ['client'])
+RETRY_QUEUE = metrics.gauge('datawizard_retry_queue',
+                            'Batches waiting in the retry queue', ['client'])
+SPILL_BACKLOG = metrics.gauge('datawizard_spill_backlog_records',
+                              'Spilled batches waiting for replay', ['client'])
+
+# 热路径日志汇总
+INSERTED_SUMMARY = Summary(
+    logger, 'Inserted %d rows in %d batches into (%s) in the last %.0fs')
+# insert_mode为'values'时的行数和语句数，两者之比即平均每条语句的行数，用于调整page_size
+VALUES_SUMMARY = Summary(
+    logger, 'Inserted %d rows in %d VALUES statements into (%s) '
+    'in the last %.0fs')
 
 
 class PostgresqlWrapper(object):
@@ -84,30 +119,71 @@ class PostgresqlWrapper(object):
         - 动态添加列    (ADD COLUMN)
         - 插入数据      (INSERT data)
         - 查询数据      (SELECT data)
+        - 目录缓存      (Catalog cache)
     """
-    def __init__(self, conf):
+    def __init__(self, conf, workers=1, spill_name='wizard', creator=None):
         """初始化方法
 
         1. 初始化配置信息
         2. 创建与PostgreSQL的连接（连接池）
-        3. 预先创建Schema和Hypertable
+        3. 加载数据库目录缓存，据此预先创建Schema、Hypertable和Column
 
         :conf: 配置参数
+        :workers: 使用本实例的worker线程数，用于确定连接池大小
+        :spill_name: 溢写日志的子目录名，多个实例（例如多个Wizard进程）须各不相同，
+                     None表示本实例不使用溢写日志
+        :creator: 连接池创建连接使用的DB-API 2模块或函数，None表示使用psycopg2
+                  （基准测试中可替换为tools/fakedb.RecordingDatabase）
 
         """
+        self._creator = creator or psycopg2
         # Database连接参数配置
         self._host = conf.get('host', '127.0.0.1')
         self._port = conf.get('port', 5432)
         self._user = conf.get('user', None)
         self._password = conf.get('password', None)
         self._dbname = conf.get('dbname', None)
+        # # 建立连接和测量往返时间（ping）的超时时间（秒），数据库所在网络中断时不会无限阻塞
+        self._connect_timeout = conf.get('connect_timeout', 5)
+        self._ping_timeout = conf.get('ping_timeout', 5)
+
+        # Database.Spill配置
+        # # 数据库不可用或过慢时将物料写入磁盘溢写日志，恢复后回放
+        spill_conf = conf.get('spill', dict())
+        self._spill_enable = spill_conf.get('enable',
+                                            False) and spill_name is not None
+        self._spill_path = spill_conf.get('path', 'spill')
+        self._spill_segment_size = spill_conf.get('segment_size',
+                                                  64 * 1024 * 1024)
+        self._spill_max_size = spill_conf.get('max_size', 1024 * 1024 * 1024)
+        self._spill_compress = spill_conf.get('compress', True)
+        # # 往返时间超过该值（秒）时视为过慢，0表示只在数据库不可用时溢写
+        self._spill_rtt = spill_conf.get('rtt_limit', 0)
+        # # 检查数据库状态和回放的间隔（秒）
+        self._spill_interval = spill_conf.get('interval', 2)
+
+        # Database.Retry配置
+        # # 写入失败的批按指数退避重试，max_attempts次仍失败则转入死信存储
+        retry_conf = conf.get('retry', dict())
+        self._retry_attempts = retry_conf.get('max_attempts', 5)
+        self._retry_size = retry_conf.get('max_size', 1000)
+        self._retry_backoff = retry_conf.get('backoff', 1)
+        self._retry_max_backoff = retry_conf.get('max_backoff', 60)
+        # # 死信数据表（例如'public.dead_letter'），为空则只写入死信文件
+        self._dead_letter_table = retry_conf.get('dead_letter_table', str())
+        self._dead_letter_file = retry_conf.get('dead_letter_file',
+                                                'logs/dead_letter.jsonl')
 
         # Database.Pool配置
+        # # 每个worker在flush期间独占一个连接，因此连接池大小由worker数决定
+        # # 另留一个连接用于重试，启用溢写日志时再留一个连接用于检查数据库状态和回放
+        self._workers = max(workers, 1) + 1 + (1 if self._spill_enable else 0)
         pool_conf = conf.get('pool', dict())
-        self._mincached = pool_conf.get('mincached', 10)
-        self._maxcached = pool_conf.get('maxcached', 0)
+        self._mincached = min(pool_conf.get('mincached', 10), self._workers)
+        self._maxcached = pool_conf.get('maxcached', 0) or self._workers
         self._maxshared = pool_conf.get('maxshared', 0)
-        self._maxconnections = pool_conf.get('maxconnections', 0)
+        self._maxconnections = pool_conf.get('maxconnections',
+                                             0) or self._workers
         self._blocking = pool_conf.get('blocking', True)
         self._maxusage = pool_conf.get('maxusage', 0)
         self._ping = pool_conf.get('ping', 1)
@@ -117,6 +193,18 @@ class PostgresqlWrapper(object):
         self._column_ts = column_conf.get('column_ts', 'timestamp')
         self._column_id = column_conf.get('column_id', 'deviceid')
 
+        # Database.Insert配置
+        # # 数据写入方式，可选值：'executemany'（逐行INSERT）、'copy'（COPY FROM STDIN）、
+        # # 'values'（多行INSERT ... VALUES (...),(...)）、
+        # # 'prepared'（服务端预备语句PREPARE/EXECUTE）
+        self._insert_mode = conf.get('insert_mode', 'executemany').lower()
+        # # insert_mode为'values'时单条INSERT语句包含的最大行数
+        self._page_size = conf.get('page_size', 100)
+        # # insert_mode为'prepared'时每个连接保留的最大预备语句数
+        self._prepared_max = conf.get('prepared_max', 64)
+        # # COPY的数据格式，可选值：'text'、'binary'
+        self._copy_format = conf.get('copy_format', 'text').lower()
+
         # message数据配置
         message_conf = conf.get('message', dict())
         self._message_switch = message_conf.get('message_switch', False)
@@ -124,10 +212,65 @@ class PostgresqlWrapper(object):
         self._message_table = message_conf.get('message_table', 'message')
         self._message_column = message_conf.get('message_column', list())
 
-        # 创建PostgreSQL连接对象
-        self._database = None
+        # 运行指标按客户端名区分
+        self._name = spill_name or 'ddl'
+        self._pool_in_use = POOL_IN_USE.labels(self._name)
+        POOL_MAX.labels(self._name).set(self._maxconnections)
+
+        # 创建PostgreSQL连接池，连接由各线程按需检出
+        self._pool = None
+        self._local = threading.local()
+        # 溢写日志，_spilling被设置时所有物料直接写入溢写日志
+        self.spill = None
+        self._spilling = threading.Event()
+        # 回放线程结束溢写时持有该锁回放剩余的尾部，期间到达的物料等待其结束后直接写入数据库
+        self._spill_gate = threading.Lock()
+        # 正在执行的ping（concurrent.futures.Future）
+        self._pinging = None
+        self._ping_lock = threading.Lock()
         self.connect()
 
+        # 数据库目录缓存，写入前据此补齐缺失的Schema/Table/Column
+        self._catalog = dict()  # {schema: {table: {column, ...}}}
+        self._proc_schemas = set()  # 存在create_hypertable存储过程的schema
+        self._catalog_lock = threading.Lock()
+        self.load_catalog()
+
+        # 各连接的预备语句：{连接: OrderedDict(SQL语句: 预备语句名)}
+        self._statements = weakref.WeakKeyDictionary()
+        self._statement_lock = threading.Lock()
+        self._statement_id = itertools.count(1)
+
+        # 正在执行的DDL：{'schema.table': threading.Event}
+        self._flights = dict()
+        self._flight_lock = threading.Lock()
+
+        # 重试队列和死信存储
+        self.retry = RetryQueue(max_size=self._retry_size,
+                                backoff=self._retry_backoff,
+                                max_backoff=self._retry_max_backoff)
+        self.dead_letters = DeadLetterFile(filename=self._dead_letter_file)
+        RETRY_QUEUE.labels(self._name).set_function(self.retry.__len__)
+        if self._dead_letter_table:
+            self.create_dead_letter()
+        retrier = threading.Thread(target=self._retry_loop,
+                                   name='Retrier',
+                                   daemon=True)
+        retrier.start()
+
+        # 溢写日志
+        if self._spill_enable:
+            self.spill = SpillLog(path=os.path.join(self._spill_path,
+                                                    spill_name),
+                                  segment_size=self._spill_segment_size,
+                                  max_size=self._spill_max_size,
+                                  compress=self._spill_compress)
+            SPILL_BACKLOG.labels(self._name).set_function(self.spill.__len__)
+            replayer = threading.Thread(target=self._replay_loop,
+                                        name='Replayer',
+                                        daemon=True)
+            replayer.start()
+
     def _create_pool(self):
         """创建PostgreSQL连接池
 
@@ -143,7 +286,7 @@ class PostgresqlWrapper(object):
         """
         pool = PooledDB(
             # DBUtils参数
-            creator=psycopg2,
+            creator=self._creator,
             mincached=self._mincached,
             maxcached=self._maxcached,
             maxshared=self._maxshared,
@@ -156,40 +299,403 @@ class PostgresqlWrapper(object):
             port=self._port,
             user=self._user,
             password=self._password,
-            dbname=self._dbname)
+            dbname=self._dbname,
+            connect_timeout=self._connect_timeout)
 
         return pool
 
+    @property
+    def _database(self):
+        """当前线程检出的PostgreSQL连接，尚未检出则从连接池获取
+
+        :returns: PostgreSQL连接对象
+
+        """
+        database = getattr(self._local, 'database', None)
+        if database is None:
+            database = self._local.database = self._pool.connection()
+            self._pool_in_use.inc()
+
+        return database
+
+    @contextmanager
+    def checkout(self):
+        """在with语句内为当前线程独占一个连接，退出时将其归还连接池
+
+        嵌套使用时复用外层检出的连接
+        溢写期间（回放线程除外）不检出连接，物料由insert直接写入溢写日志
+
+        """
+        if self._spilling.is_set() and not getattr(self._local, 'replayer',
+                                                   False):
+            yield None
+            return
+
+        nested = getattr(self._local, 'database', None) is not None
+        try:
+            database = self._database
+        except (OperationalError, InterfaceError) as err:
+            if self.spill is None:
+                raise
+            # 数据库不可用，转为溢写
+            logger.error('Database unavailable, spill data to disk: '
+                         '{text}'.format(text=err))
+            self._spilling.set()
+            yield None
+            return
+
+        try:
+            yield database
+        finally:
+            if not nested:
+                self.release()
+
+    @contextmanager
+    def scoped_connection(self):
+        """在with语句内使用一个不属于当前线程的连接，退出时将其归还连接池
+
+        用于ping等不在checkout内调用、也不应占用线程检出连接的场合
+
+        """
+        database = self._pool.connection()
+        self._pool_in_use.inc()
+        try:
+            yield database
+        finally:
+            self._pool_in_use.dec()
+            try:
+                database.close()
+            except Exception as err:
+                logger.error(err)
+
+    def release(self):
+        """将当前线程检出的连接归还连接池"""
+        database = getattr(self._local, 'database', None)
+        self._local.database = None
+        if database is not None:
+            self._pool_in_use.dec()
+            try:
+                database.close()
+            except Exception as err:
+                logger.error(err)
+
     def _reconnect(self):
-        """重开与PostgreSQL的连接"""
-        if not self._database._closed:
-            self._database.close()
-        self.connect()
+        """重开当前线程与PostgreSQL的连接，复用已有连接池
 
-    def connect(self):
-        """从连接池中获取一个PostgreSQL连接对象
+        只尝试一次，失败时抛出异常，不在此等待数据库恢复：
+        写入中的物料由溢写日志或重试队列处理，DDL的调用者（prepare）随写入一起失败
 
-        :returns: PostgreSQL连接对象
+        """
+        RECONNECTS.labels(self._name).inc()
+        self._forget_statements()
+        self.release()
+        self.connect(attempts=1)
+
+    def _try_reconnect(self):
+        """尝试重连一次，失败时只记录日志（用于不向调用者抛出异常的方法）"""
+        logger.error('Reconnect to the PostgreSQL...')
+        try:
+            self._reconnect()
+        except Exception as err:
+            logger.error('Reconnect failed: {text}'.format(text=err))
+
+    def connect(self, attempts=0):
+        """创建PostgreSQL连接池（只创建一次）并检验连接可用
+
+        :attempts: 最多尝试次数，0表示每2秒重试直到连接成功（启动时使用），
+                   尝试次数用尽时抛出最后一次的异常
 
         """
-        while True:
+        for attempt in itertools.count(1):
             try:
-                pool_obj = self._create_pool()
-                self._database = pool_obj.connection()
+                if self._pool is None:
+                    self._pool = self._create_pool()
+                self._pool.connection().close()
                 logger.info('Persistent database is connected')
                 break
             except OperationalError as err:
                 logger.error(
                     'Persistent database connection error: {text}'.format(
                         text=err))
-            except AttributeError:
+                error = err
+            except AttributeError as err:
                 logger.error('Persistent database connection pool error, '
                              'check configuration file')
+                error = err
             except Exception as err:
                 logger.error(err)
+                error = err
 
+            if attempts and attempt >= attempts:
+                raise error
             time.sleep(2)
 
+    def ping(self, timeout=None):
+        """测量与PostgreSQL的往返时间
+
+        'SELECT 1'在单独的线程中执行，调用者最多等待timeout秒；
+        上一次ping仍未返回时（例如网络中断，阻塞在socket上）等待它而不是再发起一次
+
+        :timeout: 最长等待时间（秒），None表示使用配置的ping_timeout
+        :returns: 执行'SELECT 1'的耗时（秒），连接出错或超时返回None
+
+        """
+        timeout = self._ping_timeout if timeout is None else timeout
+        with self._ping_lock:
+            if self._pinging is None or self._pinging.done():
+                self._pinging = Future()
+                pinger = threading.Thread(target=self._measure,
+                                          args=(self._pinging, ),
+                                          name='Pinger',
+                                          daemon=True)
+                pinger.start()
+            pinging = self._pinging
+
+        try:
+            return pinging.result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.error('Database ping timed out after {timeout}s'.format(
+                timeout=timeout))
+            return None
+
+    def _measure(self, future):
+        """执行'SELECT 1'并将耗时（或None）设置为future的结果
+
+        :future: concurrent.futures.Future
+
+        """
+        start_time = time.time()
+        rtt = None
+        try:
+            # 使用独立的连接，溢写期间checkout不检出连接，不能使用线程的检出连接
+            with self.scoped_connection() as database:
+                cursor = database.cursor()
+                cursor.execute('SELECT 1;')
+                cursor.fetchall()
+                database.commit()
+            rtt = time.time() - start_time
+        except (OperationalError, InterfaceError) as err:
+            logger.error('Database ping failed: {text}'.format(text=err))
+        except Exception as err:
+            logger.error(err)
+        finally:
+            future.set_result(rtt)
+
+    def load_catalog(self):
+        """从information_schema加载已有的Schema、Table和Column到目录缓存"""
+        SQL_SCHEMA = ("SELECT schema_name "
+                      "FROM information_schema.schemata;")
+        SQL_COLUMN = ("SELECT table_schema, table_name, column_name "
+                      "FROM information_schema.columns "
+                      "WHERE table_schema NOT IN "
+                      "('pg_catalog', 'information_schema');")
+        SQL_PROC = ("SELECT pg_namespace.nspname "
+                    "FROM pg_catalog.pg_proc "
+                    "JOIN pg_namespace "
+                    "ON pg_catalog.pg_proc.pronamespace = pg_namespace.oid "
+                    "WHERE proname = 'create_hypertable';")
+
+        catalog = dict()
+        try:
+            with self.checkout() as database:
+                if database is None:
+                    raise OperationalError('database is unavailable')
+                cursor = database.cursor()
+                cursor.execute(SQL_SCHEMA)
+                for (schema, ) in cursor.fetchall():
+                    catalog[schema] = dict()
+                cursor.execute(SQL_COLUMN)
+                for schema, table, column in cursor.fetchall():
+                    catalog.setdefault(schema, dict()).setdefault(
+                        table, set()).add(column)
+                cursor.execute(SQL_PROC)
+                proc_schemas = {schema for (schema, ) in cursor.fetchall()}
+                database.commit()
+        except (OperationalError, InterfaceError):
+            self._try_reconnect()
+        except Exception as err:
+            logger.error(err)
+        else:
+            with self._catalog_lock:
+                self._catalog = catalog
+                self._proc_schemas = proc_schemas
+            logger.info('Catalog loaded: {schemas} schemas, '
+                        '{tables} tables'.format(
+                            schemas=len(catalog),
+                            tables=sum([len(t) for t in catalog.values()])))
+
+    def _load_table(self, schema, table):
+        """从information_schema重新加载指定Table的Column到目录缓存
+
+        :schema: Schema名
+        :table: Table名
+
+        """
+        SQL = ("SELECT column_name "
+               "FROM information_schema.columns "
+               "WHERE table_schema = %s AND table_name = %s;")
+
+        schema = schema.translate(FOLD_IDENTIFIER)
+        table = table.translate(FOLD_IDENTIFIER)
+
+        cursor = self._database.cursor()
+        cursor.execute(SQL, (schema, table))
+        columns = {column for (column, ) in cursor.fetchall()}
+        self._database.commit()
+
+        with self._catalog_lock:
+            tables = self._catalog.setdefault(schema, dict())
+            if columns:
+                tables[table] = columns
+            else:
+                tables.pop(table, None)
+
+    def _catalog_add(self, schema, table=None, columns=()):
+        """DDL执行后更新目录缓存
+
+        :schema: Schema名
+        :table: Table名
+        :columns: 新增的Column名
+
+        """
+        with self._catalog_lock:
+            tables = self._catalog.setdefault(schema.translate(FOLD_IDENTIFIER),
+                                              dict())
+            if table is not None:
+                table = table.translate(FOLD_IDENTIFIER)
+                # 替换而不是原地修改，避免与其他线程的读取冲突
+                tables[table] = tables.get(table, set()) | {
+                    column.translate(FOLD_IDENTIFIER)
+                    for column in columns
+                }
+
+    def _catalog_discard(self, schema, table):
+        """从目录缓存中移除指定Table（缓存已过期时使用）
+
+        :schema: Schema名
+        :table: Table名
+
+        """
+        with self._catalog_lock:
+            self._catalog.get(schema.translate(FOLD_IDENTIFIER),
+                              dict()).pop(table.translate(FOLD_IDENTIFIER),
+                                          None)
+
+    def _single_flight(self, key, func, **kwargs):
+        """同一key的DDL在进程内只由一个调用者执行，其他调用者等待其完成
+
+        :key: DDL对象，形如'schema.table'
+        :func: 执行DDL的函数
+        :kwargs: func的参数
+        :returns: 当前调用者是否执行了func
+
+        """
+        with self._flight_lock:
+            event = self._flights.get(key)
+            leader = event is None
+            if leader:
+                event = self._flights[key] = threading.Event()
+
+        if not leader:
+            event.wait()
+            return False
+
+        try:
+            func(**kwargs)
+        finally:
+            with self._flight_lock:
+                self._flights.pop(key, None)
+            event.set()
+
+        return True
+
+    def _advisory_lock(self, cursor, key):
+        """获取事务级advisory lock，在多个DataWizard实例间串行化同一对象的DDL
+
+        锁在事务commit或rollback时自动释放
+
+        :cursor: 数据库cursor
+        :key: DDL对象，形如'schema.table'
+
+        """
+        SQL = "SELECT pg_advisory_xact_lock(hashtext(%s));"
+        cursor.execute(SQL, (key.translate(FOLD_IDENTIFIER), ))
+
+    def _ensure(self, schema, table, columns):
+        """补齐目录缓存中缺失的Schema、Table和Column
+
+        :schema: Schema名
+        :table: Table名
+        :columns: Column名及其数据类型
+
+        """
+        tables = self._catalog.get(schema.translate(FOLD_IDENTIFIER))
+        if tables is None:
+            logger.info('Creating schema...')
+            self.create_schema(schema=schema)
+            DDL_EVENTS.labels('schema').inc()
+            tables = dict()
+
+        exist = tables.get(table.translate(FOLD_IDENTIFIER))
+        if exist is None:
+            logger.info('Creating hypertable...')
+            self.create_hypertable(schema=schema,
+                                   hypertable=table,
+                                   columns=columns)
+            DDL_EVENTS.labels('table').inc()
+        else:
+            missing = {
+                column: type_
+                for column, type_ in columns.items()
+                if column.translate(FOLD_IDENTIFIER) not in exist
+            }
+            if missing:
+                logger.info('Adding column...')
+                self.add_column(schema=schema, table=table, columns=missing)
+                DDL_EVENTS.labels('column').inc(len(missing))
+
+    def _missing(self, schema, table, columns):
+        """根据目录缓存判断是否缺少Schema、Table或Column
+
+        :schema: Schema名
+        :table: Table名
+        :columns: Column名及其数据类型
+        :returns: bool
+
+        """
+        exist = self._catalog.get(schema.translate(FOLD_IDENTIFIER),
+                                  dict()).get(table.translate(FOLD_IDENTIFIER))
+        if exist is None:
+            return True
+        for column in columns:
+            if column.translate(FOLD_IDENTIFIER) not in exist:
+                return True
+
+        return False
+
+    def prepare(self, material):
+        """根据目录缓存检查物料的列集合，在写入前补齐缺失的Schema、Table和Column
+
+        同一schema.table的DDL在进程内只由一个线程执行，其他线程等待其完成后重新检查
+
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        schema = material.get('schema', 'public')
+        table = material.get('table', 'example')
+        column_type = material.get('column', dict())
+        key = '{schema}.{table}'.format(schema=schema, table=table)
+
+        # 等待的线程醒来后其列集合可能仍未被满足（例如比执行DDL的线程多了新列），需重新检查
+        for _ in range(3):
+            if not self._missing(schema, table, column_type):
+                break
+            self._single_flight(key=key,
+                                func=self._ensure,
+                                schema=schema,
+                                table=table,
+                                columns=column_type)
+
     def create_schema(self, schema):
         """创建Schema
 
@@ -197,20 +703,25 @@ class PostgresqlWrapper(object):
 
         """
         # 构建SQL语句
-        SQL = "CREATE SCHEMA {schema};".format(schema=schema)
+        SQL = "CREATE SCHEMA IF NOT EXISTS {schema};".format(schema=schema)
 
         # 执行SQL语句
         try:
             cursor = self._database.cursor()
+            self._advisory_lock(cursor=cursor, key=schema)
             cursor.execute(SQL)
             self._database.commit()
+            self._catalog_add(schema=schema)
         except DuplicateSchema as warn:
             logger.warning('Duplicate schema: {warn}'.format(warn=warn))
+            self._database.rollback()
+            self._catalog_add(schema=schema)
         except (OperationalError, InterfaceError):
             logger.error('Reconnect to the PostgreSQL...')
             self._reconnect()
         except Exception as err:
             logger.error(err)
+            self._database.rollback()
 
     def create_table(self, schema, table, columns):
         """创建Table
@@ -237,6 +748,9 @@ class PostgresqlWrapper(object):
             elif type_ in ['json']:
                 # json(list, dict)类型的数据默认存储为JSON
                 data_type = 'JSON'
+            elif type_ in ['jsonb']:
+                # 打包存储的字段集合存储为JSONB
+                data_type = 'JSONB'
             else:
                 # 其他类型的数据默认存储为VARCHAR
                 data_type = 'VARCHAR'
@@ -257,11 +771,13 @@ class PostgresqlWrapper(object):
             self._database.commit()
         except DuplicateTable as warn:
             logger.warning('Create table: {text}'.format(text=warn))
+            self._database.rollback()
         except (OperationalError, InterfaceError):
             logger.error('Reconnect to the PostgreSQL...')
             self._reconnect()
         except Exception as err:
             logger.error(err)
+            self._database.rollback()
 
     def create_hypertable(self, schema, hypertable, columns):
         """创建Hypertable
@@ -291,6 +807,9 @@ class PostgresqlWrapper(object):
             elif type_ in ['json']:
                 # json(list, dict)类型的数据默认存储为JSON
                 data_type = 'JSON'
+            elif type_ in ['jsonb']:
+                # 打包存储的字段集合存储为JSONB
+                data_type = 'JSONB'
             else:
                 # 其他类型的数据默认存储为VARCHAR
                 data_type = 'VARCHAR'
@@ -304,25 +823,23 @@ class PostgresqlWrapper(object):
 
         SQL = "CREATE TABLE {schema_name}.{table_name} ({columns});".format(
             schema_name=schema, table_name=hypertable, columns=columns_name)
-        SQL_JUDGE = ("SELECT EXISTS ("
-                     "SELECT * "
-                     "FROM pg_catalog.pg_proc "
-                     "JOIN pg_namespace "
-                     "ON pg_catalog.pg_proc.pronamespace = pg_namespace.oid "
-                     "WHERE proname = 'create_hypertable' "
-                     "AND pg_namespace.nspname = '{schema_name}');".format(
-                         schema_name=schema))
-
         # 执行SQL语句
         try:
             # 获取cursor
             cursor = self._database.cursor()
 
-            # 判断指定schema中是否存在create_hypertable存储过程
-            cursor.execute(SQL_JUDGE)
-            exist = cursor.fetchall()[0][0]
+            # 持锁后检查Hypertable是否已被其他DataWizard实例创建
+            key = '{schema}.{table}'.format(schema=schema, table=hypertable)
+            self._advisory_lock(cursor=cursor, key=key)
+            cursor.execute("SELECT to_regclass(%s);", (key, ))
+            if cursor.fetchall()[0][0] is not None:
+                self._database.commit()
+                self._load_table(schema=schema, table=hypertable)
+                return
+
+            # 判断指定schema中是否存在create_hypertable存储过程（查目录缓存）
             proc_schema = schema
-            if not exist:
+            if schema.translate(FOLD_IDENTIFIER) not in self._proc_schemas:
                 proc_schema = 'public'
                 logger.warning("Stored procedure {schema_name}.{proc_name} "
                                "does not exist, "
@@ -342,18 +859,26 @@ class PostgresqlWrapper(object):
             cursor.execute(SQL)
             cursor.execute(SQL_HYPERTABLE)
             self._database.commit()  # 在建表并设置为超表之后统一commit,否则可能会建一个普通表
+            self._catalog_add(schema=schema,
+                              table=hypertable,
+                              columns=[self._column_ts, self._column_id] +
+                              list(columns))
         except InvalidSchemaName as warn:  # Schema不存在
             # 尝试创建Schema
             logger.error('Undefined schema: {text}'.format(text=warn))
+            self._database.rollback()
             logger.info('Creating schema...')
             self.create_schema(schema=schema)
         except DuplicateTable as warn:  # Hypertable已存在
             logger.warning('Duplicate hypertable: {text}'.format(text=warn))
+            self._database.rollback()
+            self._load_table(schema=schema, table=hypertable)
         except (OperationalError, InterfaceError):
             logger.error('Reconnect to the PostgreSQL...')
             self._reconnect()
         except Exception as err:
             logger.error(err)
+            self._database.rollback()
 
     def add_column(self, schema, table, columns):
         """添加Column
@@ -372,6 +897,9 @@ class PostgresqlWrapper(object):
         """
         try:
             cursor = self._database.cursor()
+            self._advisory_lock(cursor=cursor,
+                                key='{schema}.{table}'.format(schema=schema,
+                                                              table=table))
             # PostgreSQL限制了一次只能新增一列
             for column, type_ in columns.items():
                 if type_ in ['int', 'float']:
@@ -380,6 +908,9 @@ class PostgresqlWrapper(object):
                 elif type_ in ['json']:
                     # json(list, dict)类型的数据默认存储为JSON
                     data_type = 'JSON'
+                elif type_ in ['jsonb']:
+                    # 打包存储的字段集合存储为JSONB
+                    data_type = 'JSONB'
                 else:
                     # 其他类型的数据默认存储为VARCHAR
                     data_type = 'VARCHAR'
@@ -393,12 +924,15 @@ class PostgresqlWrapper(object):
 
                 # 执行SQL语句
                 cursor.execute(SQL)
-                self._database.commit()
+            # 所有列在同一事务中添加，commit后释放advisory lock
+            self._database.commit()
+            self._catalog_add(schema=schema, table=table, columns=columns)
         except (OperationalError, InterfaceError):
             logger.error('Reconnect to the PostgreSQL...')
             self._reconnect()
         except Exception as err:
             logger.error(err)
+            self._database.rollback()
 
     def fork_message(self, datas):
         """转储message数据到一个独立的数据表
@@ -764,71 +1298,586 @@ class PostgresqlWrapper(object):
                             'successfully'.format(schema_name=curr_schema,
                                                   table_name=curr_table))
         except (OperationalError, InterfaceError):
-            logger.error('Reconnect to the PostgreSQL...')
-            self._reconnect()
+            self._try_reconnect()
         except Exception as err:
             logger.error(err)
+            self._database.rollback()
 
-    def insert(self, material):
-        """向数据表批量插入数据
+    @staticmethod
+    def _copy_timestamp(value):
+        """将时间戳转换为COPY binary格式需要的微秒数
+
+        :value: 时间字符串（例如'2020-10-21 10:19:11'）或Unix时间戳
+        :returns: 距2000-01-01的微秒数
+
+        """
+        if isinstance(value, (int, float)):
+            moment = datetime.fromtimestamp(value)
+        else:
+            moment = datetime.fromisoformat(str(value))
+        # TIMESTAMP列不保存时区信息
+        moment = moment.replace(tzinfo=None)
+
+        return (moment - PG_EPOCH) // timedelta(microseconds=1)
+
+    @staticmethod
+    def _copy_literal(item):
+        """将列值转换为COPY使用的文本
 
+        bool转换为'true'/'false'（与executemany等方式写入VARCHAR列的结果一致），
+        dict和list转换为JSON，其他值使用str()
+
+        :item: 列值（非None）
+        :returns: str
+
+        """
+        if isinstance(item, str):
+            return item
+        if isinstance(item, bool):
+            return 'true' if item else 'false'
+        if isinstance(item, (dict, list)):
+            return json.dumps(item, ensure_ascii=False)
+
+        return str(item)
+
+    def _copy_text(self, value):
+        """构建COPY text格式的数据流
+
+        :value: 多行列值组成的列表
+        :returns: 数据流
+
+        """
+        literal = self._copy_literal
+        lines = list()
+        for row in value:
+            lines.append('\t'.join([
+                '\\N' if item is None else literal(item).translate(COPY_ESCAPE)
+                for item in row
+            ]))
+        lines.append(str())
+
+        return io.StringIO('\n'.join(lines))
+
+    def _copy_binary(self, types, value):
+        """构建COPY binary格式的数据流
+
+        要求数据表由本程序创建，即列的数据类型与types的映射规则一致
+
+        :types: 各列的数据类型，与列值一一对应
+        :value: 多行列值组成的列表
+        :returns: 数据流
+
+        """
+        stream = io.BytesIO()
+        stream.write(PGCOPY_HEADER)
+        count = PACK_COUNT(len(types))
+        for row in value:
+            stream.write(count)
+            for type_, item in zip(types, row):
+                if item is None:
+                    stream.write(PACK_LENGTH(-1))
+                elif type_ in ['int', 'float']:
+                    # int和float类型的数据存储为DOUBLE PRECISION
+                    stream.write(PACK_DOUBLE(8, float(item)))
+                elif type_ in ['timestamp']:
+                    stream.write(PACK_BIGINT(8, self._copy_timestamp(item)))
+                elif type_ in ['jsonb']:
+                    # JSONB的binary格式是版本号（1）加文本的UTF-8编码
+                    data = self._copy_literal(item).encode('UTF-8')
+                    stream.write(PACK_LENGTH(len(data) + 1))
+                    stream.write(JSONB_VERSION)
+                    stream.write(data)
+                else:
+                    # VARCHAR和JSON的binary格式即其文本的UTF-8编码
+                    data = self._copy_literal(item).encode('UTF-8')
+                    stream.write(PACK_LENGTH(len(data)))
+                    stream.write(data)
+        stream.write(PGCOPY_TRAILER)
+        stream.seek(0)
+
+        return stream
+
+    def _copy(self, cursor, material):
+        """使用COPY ... FROM STDIN批量写入数据
+
+        :cursor: 数据库cursor
         :material: 一个字典，数据入库用到的物料
 
         """
         schema = material.get('schema', 'public')
         table = material.get('table', 'example')
-        sql = material.get('sql', None)
-        value = material.get('value', None)
+        value = material.get('value', list())
         column_type = material.get('column', dict())
+        columns = material.get('columns') or [self._column_ts, self._column_id
+                                              ] + list(column_type)
+
+        if self._copy_format == 'binary':
+            # 固有列依次为时间戳列和ID列
+            types = ['timestamp', 'str'] + [
+                column_type.get(column, 'str') for column in columns[2:]
+            ]
+            stream = self._copy_binary(types=types, value=value)
+            option = ' WITH (FORMAT binary)'
+        else:
+            stream = self._copy_text(value=value)
+            option = str()
+
+        SQL = ("COPY {schema_name}.{table_name} ({column_name}) "
+               "FROM STDIN{option};".format(schema_name=schema,
+                                            table_name=table,
+                                            column_name=','.join(columns),
+                                            option=option))
+        cursor.copy_expert(SQL, stream)
+
+    def _values(self, cursor, material):
+        """使用多行INSERT ... VALUES (...),(...),...批量写入数据
+
+        每条语句最多包含page_size行，适用于有触发器或需要ON CONFLICT的数据表
+
+        :cursor: 数据库cursor
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        schema = material.get('schema', 'public')
+        table = material.get('table', 'example')
+        sql = material.get('sql')
+        value = material.get('value', list())
+
+        # 将'INSERT ... VALUES (%s,%s);'拆分为语句和单行模板
+        statement, _, template = sql.rstrip(';').partition(' VALUES ')
+        execute_values(cursor,
+                       '{statement} VALUES %s;'.format(statement=statement),
+                       value,
+                       template=template,
+                       page_size=self._page_size)
+
+        # 语句数及平均每条语句的行数，用于调整page_size
+        statements = -(-len(value) // self._page_size)
+        VALUES_SUMMARY.add('{schema}.{table}'.format(schema=schema,
+                                                     table=table),
+                           len(value), statements)
+
+    def _prepared_statements(self):
+        """当前线程所用连接的预备语句表
+
+        预备语句属于数据库会话，因此按连接池中的底层连接区分
+
+        :returns: OrderedDict(SQL语句: 预备语句名)，按最近使用排序
+
+        """
+        connection = getattr(self._database, '_con', self._database)
+        with self._statement_lock:
+            statements = self._statements.get(connection)
+            if statements is None:
+                statements = self._statements[connection] = OrderedDict()
+
+        return statements
+
+    def _forget_statements(self):
+        """清空当前线程所用连接的预备语句表（连接重建或预备语句失效时使用）"""
+        database = getattr(self._local, 'database', None)
+        connection = getattr(database, '_con', database)
+        with self._statement_lock:
+            if connection is not None:
+                self._statements.pop(connection, None)
+
+    def _prepared(self, cursor, material):
+        """使用服务端预备语句批量写入数据
+
+        每个连接对每种语句只PREPARE一次，之后使用EXECUTE，省去重复的语句规划
+        预备语句数超过prepared_max时按LRU淘汰并DEALLOCATE
+
+        :cursor: 数据库cursor
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        sql = material.get('sql')
+        value = material.get('value', list())
+
+        # 'INSERT ... VALUES (%s,%s);'拆分为语句和单行占位符
+        statement, _, template = sql.rstrip(';').partition(' VALUES ')
+
+        statements = self._prepared_statements()
+        name = statements.get(sql)
+        if name is None:
+            # 淘汰最久未使用的预备语句
+            while statements and len(statements) >= self._prepared_max:
+                _, expired = statements.popitem(last=False)
+                cursor.execute('DEALLOCATE {name};'.format(name=expired))
+
+            name = 'datawizard_{id}'.format(id=next(self._statement_id))
+            params = ','.join([
+                '${index}'.format(index=index)
+                for index in range(1, template.count('%s') + 1)
+            ])
+            cursor.execute('PREPARE {name} AS {statement} '
+                           'VALUES ({params});'.format(name=name,
+                                                      statement=statement,
+                                                      params=params))
+            statements[sql] = name
+        else:
+            statements.move_to_end(sql)
 
+        cursor.executemany(
+            'EXECUTE {name} {template};'.format(name=name, template=template),
+            value)
+
+    def _write(self, cursor, material):
+        """根据insert_mode将物料写入数据表
+
+        :cursor: 数据库cursor
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        if self._insert_mode in ['copy']:
+            self._copy(cursor=cursor, material=material)
+        elif self._insert_mode in ['values']:
+            self._values(cursor=cursor, material=material)
+        elif self._insert_mode in ['prepared']:
+            self._prepared(cursor=cursor, material=material)
+        else:
+            cursor.executemany(material.get('sql'), material.get('value'))
+
+    def _replay(self, material):
+        """回放溢写日志中的一个物料，总是使用COPY批量写入
+
+        连接错误向调用者抛出，回放在下次从该物料继续；
+        其他错误（例如约束冲突、列类型冲突）说明物料本身无法写入，将其转入死信存储后继续回放
+
+        :material: 一个字典，数据入库用到的物料
+
+        """
         try:
-            # 执行SQL语句
-            if sql:
-                cursor = self._database.cursor()
-                cursor.executemany(sql, value)
-                self._database.commit()
-                logger.info('Data inserted into '
-                            '({schema_name}.{table_name}) successfully'.format(
-                                schema_name=schema, table_name=table))
+            self.prepare(material)
+            cursor = self._database.cursor()
+            self._copy(cursor=cursor, material=material)
+            self._database.commit()
+        except (OperationalError, InterfaceError):
+            raise
+        except Exception as e:
+            logger.error(
+                'Failed to replay into ({schema_name}.{table_name}): '
+                '{text}'.format(schema_name=material.get('schema', 'public'),
+                                table_name=material.get('table', 'example'),
+                                text=e))
+            try:
+                self._database.rollback()
+            except (OperationalError, InterfaceError):
+                raise
+            except Exception:
+                pass
+            self._dead_letter(material=material,
+                              attempts=1,
+                              reason='replay error: {text}'.format(text=e))
+
+    def _replay_spill(self):
+        """回放溢写日志，连接错误时重新进入溢写状态
+
+        :returns: True表示回放完成，False表示回放中途出错
+
+        """
+        start_time = time.time()
+        try:
+            with self.checkout():
+                count = self.spill.replay(self._replay)
+        except (OperationalError, InterfaceError) as e:
+            # 只有连接错误才继续溢写，回放在下次从失败的物料处继续
+            logger.error('Spill replay error: {text}'.format(text=e))
+            self._forget_statements()
+            self._spilling.set()
+            return False
+        except Exception as e:
+            logger.error('Spill replay error: {text}'.format(text=e))
+            return False
+        if count:
+            logger.warning('Replayed {count} spilled batches, time cost: '
+                           '{cost}s'.format(count=count,
+                                            cost=time.time() - start_time))
+
+        return True
+
+    def _replay_loop(self):
+        """周期性地检查数据库状态，决定是否溢写，并在数据库可用时回放溢写日志
+
+        溢写期间持续到达的物料仍写入溢写日志，先在锁外回放积压，
+        再在_spill_gate内停止溢写并回放剩余的尾部，之后到达的物料直接写入数据库
+        """
+        # 溢写期间只有回放线程可以检出连接
+        self._local.replayer = True
+        while True:
+            time.sleep(self._spill_interval)
+
+            rtt = self.ping()
+            if rtt is None or (self._spill_rtt and rtt > self._spill_rtt):
+                if not self._spilling.is_set():
+                    self._spilling.set()
+                    logger.error('Database is {state}, spill data to '
+                                 'disk'.format(state='unavailable'
+                                               if rtt is None else 'slow'))
+                if len(self.spill):
+                    logger.warning('Spill backlog: {records} records in '
+                                   '{segments} segments ({size} bytes), '
+                                   '{dropped} dropped'.format(
+                                       **self.spill.backlog()))
+                continue
+
+            if len(self.spill) and not self._replay_spill():
+                continue
+
+            if self._spilling.is_set():
+                with self._spill_gate:
+                    self._spilling.clear()
+                    if len(self.spill) and not self._replay_spill():
+                        continue
+                logger.warning('Database is available, stop spilling')
+
+    def spill_info(self):
+        """溢写日志的回放积压
+
+        :returns: SpillLog.backlog()的返回值，未启用溢写日志时返回None
+
+        """
+        if self.spill is None:
+            return None
+
+        return self.spill.backlog()
+
+    def _attempt(self, material):
+        """执行一次写入，缺少Table/Column或预备语句失效时补齐后在同一次尝试内重写
+
+        补齐或重写仍然失败时向调用者抛出异常
+
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        schema = material.get('schema', 'public')
+        table = material.get('table', 'example')
+
+        try:
+            # 根据目录缓存预先执行DDL，避免写入失败后重试
+            self.prepare(material)
+            cursor = self._database.cursor()
+            self._write(cursor=cursor, material=material)
+            self._database.commit()
         except UndefinedTable as e:
             # 数据库中缺少指定Table，动态创建
             logger.error('Undefined table: {text}'.format(text=e))
-            logger.info('Creating schema...')
-            self.create_schema(schema=schema)
-            logger.info('Creating hypertable...')
-            self.create_hypertable(schema=schema,
-                                   hypertable=table,
-                                   columns=column_type)
+            # 结束出错的事务，否则后续语句都会失败
+            self._database.rollback()
+            # 目录缓存已过期（例如Table被外部删除），重新创建
+            self._catalog_discard(schema=schema, table=table)
+            self.prepare(material)
 
             # 尝试再次执行SQL语句
-            if sql:
-                cursor = self._database.cursor()
-                cursor.executemany(sql, value)
-                self._database.commit()
-                logger.info('Data inserted into '
-                            '({schema_name}.{table_name}) successfully'.format(
-                                schema_name=schema, table_name=table))
+            cursor = self._database.cursor()
+            self._write(cursor=cursor, material=material)
+            self._database.commit()
         except UndefinedColumn as e:
             # 数据表中缺少指定Column，动态创建
             logger.warning('Undefined column: {text}'.format(text=e))
-            logger.info('Adding column...')
-            self.add_column(schema=schema, table=table, columns=column_type)
+            # 结束出错的事务，否则后续语句都会失败
+            self._database.rollback()
+            # 目录缓存已过期（例如Column被外部删除），重新加载后补齐
+            self._load_table(schema=schema, table=table)
+            self.prepare(material)
 
             # 尝试再次执行SQL语句
-            if sql:
-                cursor = self._database.cursor()
-                cursor.executemany(sql, value)
-                self._database.commit()
-                logger.info('Data inserted into '
-                            '({schema_name}.{table_name}) successfully'.format(
-                                schema_name=schema, table_name=table))
-        except (OperationalError, InterfaceError):
-            # 与数据库的连接断开，重新连接
-            logger.error('Reconnect to the PostgreSQL...')
-            self._reconnect()
+            cursor = self._database.cursor()
+            self._write(cursor=cursor, material=material)
+            self._database.commit()
+        except InvalidSqlStatementName as e:
+            # 预备语句已失效（例如连接被重建），清空预备语句表后重试
+            logger.warning('Invalid prepared statement: {text}'.format(text=e))
+            self._database.rollback()
+            self._forget_statements()
+
+            # 尝试再次执行SQL语句
+            cursor = self._database.cursor()
+            self._write(cursor=cursor, material=material)
+            self._database.commit()
+
+    def insert(self, material, attempts=1):
+        """向数据表批量插入数据
+
+        启用溢写日志时，数据库不可用或过慢期间物料写入溢写日志，恢复后由回放线程入库
+        写入失败的物料进入重试队列按指数退避重试，重试max_attempts次仍失败则转入死信存储，
+        任何失败都不会向调用者抛出异常
+
+        :material: 一个字典，数据入库用到的物料
+        :attempts: 本次是第几次尝试（由重试线程传入）
+        :returns: 写入结果，可选值：INSERTED、SPILLED、RETRY、DEAD
+
+        """
+        if not material.get('sql', None):
+            return INSERTED
+
+        result = self._insert(material=material, attempts=attempts)
+        INSERT_RESULTS.labels(result).inc()
+
+        return result
+
+    def _insert(self, material, attempts):
+        """insert的实现，参数和返回值与insert一致"""
+        schema = material.get('schema', 'public')
+        table = material.get('table', 'example')
+
+        if self.spill is not None and self._spilling.is_set():
+            with self._spill_gate:
+                if self._spilling.is_set():
+                    self.spill.append(material)
+                    return SPILLED
+
+        try:
+            start_time = time.perf_counter()
+            self._attempt(material)
+            key = '{schema}.{table}'.format(schema=schema, table=table)
+            INSERT_LATENCY.labels(key).observe(time.perf_counter() -
+                                               start_time)
+            rows = len(material.get('value', list()))
+            INSERT_ROWS.labels(key).inc(rows)
+            INSERTED_SUMMARY.add(key, rows, 1)
+            return INSERTED
+        except (OperationalError, InterfaceError) as e:
+            if self.spill is not None:
+                # 与数据库的连接断开，写入溢写日志，由回放线程重连
+                logger.error('Database unavailable, spill data to disk')
+                self._spilling.set()
+                self.spill.append(material)
+                self._forget_statements()
+                self.release()
+                return SPILLED
+
+            # 与数据库的连接断开，尝试重新连接，该批交由重试队列
+            self._try_reconnect()
+            return self.defer(material=material, attempts=attempts, reason=e)
         except Exception as e:
-            # 未知错误
-            logger.error(e)
+            # 其他错误（包括补齐Table/Column时出错），结束出错的事务后重试
+            logger.error(
+                'Failed to insert into ({schema_name}.{table_name}), attempt '
+                '{attempts}: {text}'.format(schema_name=schema,
+                                            table_name=table,
+                                            attempts=attempts,
+                                            text=e))
+            try:
+                self._database.rollback()
+            except Exception:
+                pass
+            return self.defer(material=material, attempts=attempts, reason=e)
+
+    def defer(self, material, attempts, reason):
+        """将失败的物料放入重试队列，重试次数用尽或队列已满时转入死信存储
+
+        :material: 一个字典，数据入库用到的物料
+        :attempts: 已尝试次数
+        :reason: 最近一次失败的原因
+        :returns: RETRY或DEAD
+
+        """
+        if attempts < self._retry_attempts:
+            if self.retry.push(material=material,
+                               attempts=attempts,
+                               reason=str(reason)):
+                return RETRY
+            reason = 'retry queue is full ({reason})'.format(reason=reason)
+
+        self._dead_letter(material=material, attempts=attempts, reason=reason)
+        return DEAD
+
+    def _dead_letter(self, material, attempts, reason):
+        """将物料写入死信存储（数据表或文件），写入数据表失败时写入文件
+
+        :material: 一个字典，数据入库用到的物料
+        :attempts: 已尝试次数
+        :reason: 最近一次失败的原因
+
+        """
+        logger.error('Dead letter ({schema_name}.{table_name}) after '
+                     '{attempts} attempts: {text}'.format(
+                         schema_name=material.get('schema', 'public'),
+                         table_name=material.get('table', 'example'),
+                         attempts=attempts,
+                         text=reason))
+
+        if self._dead_letter_table:
+            SQL = ("INSERT INTO {dead_letter} "
+                   "(schema_name, table_name, attempts, reason, material) "
+                   "VALUES (%s, %s, %s, %s, %s);".format(
+                       dead_letter=self._dead_letter_table))
+            try:
+                with self.checkout() as database:
+                    # 溢写期间不检出连接，直接写入死信文件
+                    if database is None:
+                        raise OperationalError('database is unavailable')
+                    try:
+                        cursor = database.cursor()
+                        cursor.execute(
+                            SQL, (material.get('schema', 'public'),
+                                  material.get('table', 'example'), attempts,
+                                  str(reason),
+                                  json.dumps(material,
+                                             ensure_ascii=False,
+                                             default=str)))
+                        database.commit()
+                    except Exception:
+                        try:
+                            database.rollback()
+                        except Exception:
+                            pass
+                        raise
+                return
+            except Exception as e:
+                logger.error('Unable to write dead letter table: '
+                             '{text}'.format(text=e))
+
+        try:
+            self.dead_letters.write(material=material,
+                                    attempts=attempts,
+                                    reason=reason)
+        except Exception as e:
+            logger.error('Unable to write dead letter file: {text}'.format(
+                text=e))
+
+    def create_dead_letter(self):
+        """创建死信数据表（如果不存在）"""
+        SQL = ("CREATE TABLE IF NOT EXISTS {dead_letter} ("
+               "time TIMESTAMPTZ NOT NULL DEFAULT now(), "
+               "schema_name TEXT, "
+               "table_name TEXT, "
+               "attempts INTEGER, "
+               "reason TEXT, "
+               "material JSONB);".format(dead_letter=self._dead_letter_table))
+        try:
+            with self.checkout() as database:
+                if database is None:
+                    raise OperationalError('database is unavailable')
+                cursor = database.cursor()
+                cursor.execute(SQL)
+                database.commit()
+        except Exception as e:
+            logger.error('Unable to create dead letter table, fall back to '
+                         'file: {text}'.format(text=e))
+            self._dead_letter_table = None
+
+    def _retry_loop(self):
+        """从重试队列取出到期的物料再次写入"""
+        while True:
+            try:
+                material, attempts, reason = self.retry.pop()
+                logger.warning(
+                    'Retry ({schema_name}.{table_name}), attempt {attempts}, '
+                    'last error: {text}'.format(
+                        schema_name=material.get('schema', 'public'),
+                        table_name=material.get('table', 'example'),
+                        attempts=attempts + 1,
+                        text=reason))
+                with self.checkout():
+                    self.insert(material=material, attempts=attempts + 1)
+            except Exception as e:
+                logger.error('Retry error: {text}'.format(text=e))
+
+    def retry_info(self):
+        """重试队列中等待重试的批数"""
+        return len(self.retry)
 
     def query(self, schema, table, column='*', order='id', limit=5):
         """从指定的表查询指定数据
@@ -861,11 +1910,12 @@ class PostgresqlWrapper(object):
             self._database.commit()
         except (UndefinedTable, UndefinedColumn) as warn:
             logger.error('Query error: {text}'.format(text=warn))
+            self._database.rollback()
         except (OperationalError, InterfaceError):
-            logger.error('Reconnect to the PostgreSQL...')
-            self._reconnect()
+            self._try_reconnect()
         except Exception as err:
             logger.error(err)
+            self._database.rollback()
 
         return result
 
@@ -882,10 +1932,227 @@ class PostgresqlWrapper(object):
             self._database.commit()
             print(data)
         except (OperationalError, InterfaceError):
-            logger.error('Reconnect to the PostgreSQL...')
-            self._reconnect()
+            self._try_reconnect()
         except Exception as err:
             logger.error(err)
+            self._database.rollback()
+
+
+class AsyncPostgresqlWrapper(object):
+    """PostgreSQL异步写入客户端
+
+    使用psycopg2的异步连接（async_=1），由asyncio事件循环等待socket就绪，
+    并发度由同时写入的批数（inflight，即异步连接数）决定，不占用线程
+    补齐Schema/Table/Column的DDL仍由PostgresqlWrapper在默认线程池中执行
+    """
+    def __init__(self, conf, inflight=4):
+        """初始化方法
+
+        :conf: 配置参数
+        :inflight: 同时写入的最大批数（异步连接数）
+
+        """
+        # Database连接参数配置
+        self._params = {
+            'host': conf.get('host', '127.0.0.1'),
+            'port': conf.get('port', 5432),
+            'user': conf.get('user', None),
+            'password': conf.get('password', None),
+            'dbname': conf.get('dbname', None),
+        }
+        self._inflight = max(int(inflight), 1)
+        # 单条INSERT语句包含的最大行数
+        self._page_size = conf.get('page_size', 100)
+
+        # 目录缓存和DDL，只需要一个同步连接
+        self.ddl = PostgresqlWrapper(conf=conf, workers=1, spill_name=None)
+
+        # 空闲的异步连接，在start中创建
+        self._idle = None
+
+    async def start(self):
+        """创建异步连接，须在事件循环中调用"""
+        self._idle = asyncio.Queue()
+        for _ in range(self._inflight):
+            self._idle.put_nowait(await self._connect())
+        logger.info('Persistent database is connected '
+                    '({count} async connections)'.format(count=self._inflight))
+
+    async def _connect(self):
+        """创建一个异步连接，失败时每2秒重试
+
+        :returns: psycopg2异步连接
+
+        """
+        while True:
+            try:
+                connection = psycopg2.connect(async_=1, **self._params)
+                await self._wait(connection)
+                return connection
+            except OperationalError as err:
+                logger.error(
+                    'Persistent database connection error: {text}'.format(
+                        text=err))
+            except Exception as err:
+                logger.error(err)
+
+            await asyncio.sleep(2)
+
+    @staticmethod
+    async def _wait(connection):
+        """等待异步连接上的操作完成
+
+        按poll()的结果在事件循环中注册读/写事件，操作出错时由poll()抛出异常
+
+        :connection: psycopg2异步连接
+
+        """
+        loop = asyncio.get_running_loop()
+        fileno = connection.fileno()
+        while True:
+            state = connection.poll()
+            if state == POLL_OK:
+                return
+
+            ready = loop.create_future()
+
+            def wake():
+                if not ready.done():
+                    ready.set_result(None)
+
+            if state == POLL_READ:
+                loop.add_reader(fileno, wake)
+                try:
+                    await ready
+                finally:
+                    loop.remove_reader(fileno)
+            elif state == POLL_WRITE:
+                loop.add_writer(fileno, wake)
+                try:
+                    await ready
+                finally:
+                    loop.remove_writer(fileno)
+            else:
+                raise OperationalError(
+                    'Bad result from poll: {state}'.format(state=state))
+
+    def _statement(self, cursor, material):
+        """将物料拼接为多行INSERT ... VALUES (...),(...),...
+
+        异步连接不支持COPY和executemany，因此在客户端用mogrify拼接，
+        每条语句最多包含page_size行，所有语句一次发送，在同一个隐式事务中执行
+
+        :cursor: 数据库cursor
+        :material: 一个字典，数据入库用到的物料
+        :returns: bytes类型的SQL语句
+
+        """
+        sql = material.get('sql')
+        value = material.get('value', list())
+
+        # 将'INSERT ... VALUES (%s,%s);'拆分为语句和单行模板
+        statement, _, template = sql.rstrip(';').partition(' VALUES ')
+        prefix = '{statement} VALUES '.format(
+            statement=statement).encode('UTF-8')
+
+        statements = list()
+        for start in range(0, len(value), self._page_size):
+            rows = [
+                cursor.mogrify(template, row)
+                for row in value[start:start + self._page_size]
+            ]
+            statements.append(prefix + b','.join(rows))
+
+        return b';'.join(statements) + b';'
+
+    async def _write(self, connection, material):
+        """将物料写入数据表
+
+        :connection: psycopg2异步连接
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        cursor = connection.cursor()
+        cursor.execute(self._statement(cursor=cursor, material=material))
+        await self._wait(connection)
+
+    def _checkout(self, func, *args):
+        """在线程池的线程中检出同步连接执行func，完成后归还连接"""
+        with self.ddl.checkout():
+            return func(*args)
+
+    async def _prepare(self, material):
+        """目录缓存中缺少Schema/Table/Column时，在线程池中执行DDL
+
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        if self.ddl._missing(material.get('schema', 'public'),
+                             material.get('table', 'example'),
+                             material.get('column', dict())):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._checkout, self.ddl.prepare,
+                                       material)
+
+    async def insert(self, material):
+        """向数据表批量插入数据
+
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        schema = material.get('schema', 'public')
+        table = material.get('table', 'example')
+        if not material.get('sql', None):
+            return
+
+        loop = asyncio.get_running_loop()
+        connection = await self._idle.get()
+        try:
+            # 根据目录缓存预先执行DDL，避免写入失败后重试
+            await self._prepare(material)
+            start_time = time.perf_counter()
+            try:
+                await self._write(connection=connection, material=material)
+            except UndefinedTable as e:
+                # 目录缓存已过期（例如Table被外部删除），重新创建后重试
+                logger.error('Undefined table: {text}'.format(text=e))
+                self.ddl._catalog_discard(schema=schema, table=table)
+                await self._prepare(material)
+                await self._write(connection=connection, material=material)
+            except UndefinedColumn as e:
+                # 目录缓存已过期（例如Column被外部删除），重新加载后补齐再重试
+                logger.warning('Undefined column: {text}'.format(text=e))
+                await loop.run_in_executor(None, self._checkout,
+                                           self.ddl._load_table, schema, table)
+                await self._prepare(material)
+                await self._write(connection=connection, material=material)
+            key = '{schema}.{table}'.format(schema=schema, table=table)
+            INSERT_LATENCY.labels(key).observe(time.perf_counter() -
+                                               start_time)
+            rows = len(material.get('value', list()))
+            INSERT_ROWS.labels(key).inc(rows)
+            INSERT_RESULTS.labels(INSERTED).inc()
+            INSERTED_SUMMARY.add(key, rows, 1)
+        except (OperationalError, InterfaceError):
+            # 与数据库的连接断开，重新连接，该批交由同步客户端重试
+            logger.error('Reconnect to the PostgreSQL...')
+            RECONNECTS.labels('async').inc()
+            try:
+                connection.close()
+            except Exception:
+                pass
+            connection = await self._connect()
+            self.ddl.defer(material=material,
+                           attempts=1,
+                           reason='connection lost')
+        except Exception as e:
+            # 其他错误，交由同步客户端重试，仍失败则转入死信存储
+            logger.error(
+                'Failed to insert into ({schema_name}.{table_name}): '
+                '{text}'.format(schema_name=schema, table_name=table, text=e))
+            self.ddl.defer(material=material, attempts=1, reason=e)
+        finally:
+            self._idle.put_nowait(connection)
 
 
 if __name__ == "__main__":
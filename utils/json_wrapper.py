@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: json_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 11:02:17
+
+Description: JSON解码器，直接解码bytes/memoryview类型的原始数据
+
+可选的解码器（需安装对应模块）：
+    - orjson: 直接接受bytes/bytearray/memoryview，速度最快
+    - ujson: 接受bytes，memoryview需先转换为bytes
+    - json: 标准库，接受bytes/bytearray（自动识别UTF-8/16/32编码）
+"""
+
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+logger = logging.getLogger('DataWizard.utils.json_wrapper')
+
+# 'auto'时的选择顺序
+PRIORITY = ['orjson', 'ujson', 'json']
+
+
+def _orjson_loads(payload):
+    return orjson.loads(payload)
+
+
+def _ujson_loads(payload):
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    return ujson.loads(payload)
+
+
+def _json_loads(payload):
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    return json.loads(payload)
+
+
+DECODERS = {
+    'orjson': _orjson_loads if orjson else None,
+    'ujson': _ujson_loads if ujson else None,
+    'json': _json_loads,
+}
+
+
+def available():
+    """当前环境可用的解码器名
+
+    :returns: 解码器名列表，按PRIORITY排序
+
+    """
+    return [name for name in PRIORITY if DECODERS.get(name)]
+
+
+def get_decoder(name='auto'):
+    """获取JSON解码函数
+
+    :name: 解码器名，可选值：'auto'、'orjson'、'ujson'、'json'
+           'auto'表示按PRIORITY选择第一个可用的解码器，
+           指定的解码器不可用时回退到标准库json
+    :returns: (解码器名, 解码函数)，解码函数接受bytes/bytearray/memoryview
+
+    """
+    name = (name or 'auto').lower()
+    if name == 'auto':
+        name = available()[0]
+    elif not DECODERS.get(name):
+        logger.warning('JSON decoder ({name}) is not available, '
+                       'fall back to json'.format(name=name))
+        name = 'json'
+
+    return name, DECODERS[name]
@@ -7,11 +7,135 @@ Email: yj1516268@outlook.com
 Created Time: 2020-11-02 15:10:19
 
 Description: 配置logger
+
+日志记录只是将记录放入队列，由专门的写日志线程输出到文件和终端，不阻塞worker线程和paho回调
+（消息参数的合并仍在调用处进行，写日志线程负责时间格式化、按格式输出和文件I/O）
+热路径（每条消息、每个批）不逐条记录，而是用Summary每隔一段时间输出一条汇总
 """
 
+import atexit
 import logging
 import logging.handlers
+import multiprocessing
 import os
+import threading
+import time
+import weakref
+
+
+class Summary(object):
+    """按key累计热路径上的计数，每隔interval秒输出一条汇总日志，代替逐条记录
+
+    例如：Summary(logger, 'Received %d messages from (%s) in the last %.0fs')，
+    每条消息调用一次add(topic, 1)，日志参数依次为各累计值、key和实际经过的秒数
+    流量停止后没有新的add调用，最后一段的累计值由后台线程到期输出，进程退出时全部输出
+    """
+    # 默认汇总间隔（秒），由setup_logging按配置设置
+    interval = 10
+    # 所有实例，以及定时输出到期汇总的后台线程（每个进程一个，首次add时启动）
+    _instances = weakref.WeakSet()
+    _flusher = None
+    _flusher_lock = threading.Lock()
+
+    def __init__(self, logger, msg, interval=None, level=logging.INFO):
+        """初始化方法
+
+        :logger: 输出汇总的logger
+        :msg: 汇总日志格式（%风格，仅在输出汇总时合并参数）
+        :interval: 汇总间隔（秒），None表示使用默认值
+        :level: 汇总日志等级
+
+        """
+        self.logger = logger
+        self.msg = msg
+        self.level = level
+        if interval is not None:
+            self.interval = interval
+
+        # 各key的累计值：{key: [值, ...]}
+        self._totals = dict()
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        Summary._instances.add(self)
+
+    def add(self, key, *values):
+        """累计一次事件，到达汇总间隔时输出所有key的汇总
+
+        :key: 汇总的分组（例如topic）
+        :values: 本次事件的各个计数
+
+        """
+        if Summary._flusher is None:
+            Summary._start_flusher()
+
+        now = time.monotonic()
+        with self._lock:
+            totals = self._totals.get(key)
+            if totals is None:
+                self._totals[key] = list(values)
+            else:
+                for index, value in enumerate(values):
+                    totals[index] += value
+            elapsed = now - self._start
+            if elapsed < self.interval:
+                return
+            totals, self._totals = self._totals, dict()
+            self._start = now
+
+        self._emit(totals, elapsed)
+
+    def _emit(self, totals, elapsed):
+        if self.logger.isEnabledFor(self.level):
+            for key, values in totals.items():
+                self.logger.log(self.level, self.msg, *values, key, elapsed)
+
+    def flush(self, force=False):
+        """输出已到达汇总间隔的累计值
+
+        :force: 为True时不论是否到达汇总间隔都输出
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._start
+            if not self._totals or (elapsed < self.interval and not force):
+                return
+            totals, self._totals = self._totals, dict()
+            self._start = now
+
+        self._emit(totals, elapsed)
+
+    @classmethod
+    def flush_all(cls):
+        """输出所有实例的累计值（进程退出时调用）"""
+        for summary in list(cls._instances):
+            summary.flush(force=True)
+
+    @classmethod
+    def _start_flusher(cls):
+        with cls._flusher_lock:
+            if cls._flusher is None:
+                cls._flusher = threading.Thread(target=cls._flush_loop,
+                                                name='Summary',
+                                                daemon=True)
+                cls._flusher.start()
+
+    @classmethod
+    def _flush_loop(cls):
+        """定时输出到期的汇总，流量停止后最后一段的累计值也不会一直滞留"""
+        while True:
+            time.sleep(min(cls.interval, 1))
+            for summary in list(cls._instances):
+                summary.flush()
+
+    @classmethod
+    def _after_fork(cls):
+        # 线程不会随fork进入子进程，子进程首次add时重新启动后台线程
+        cls._flusher = None
+        cls._flusher_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=Summary._after_fork)
 
 
 def setup_logging(conf):
@@ -37,9 +161,11 @@ def setup_logging(conf):
     max_size = conf.get('max_size', 10240000)  # size of each log file
     backup_count = conf.get('backup_count', 10)  # count of log files
     log_format = conf.get('format', '%(message)s')  # log format
+    # interval of hot-path summaries
+    Summary.interval = conf.get('summary_interval', 10)
 
     logger = logging.getLogger('DataWizard')
-    logger.setLevel(logging.DEBUG)
+    handlers = list()
 
     formatter = logging.Formatter(log_format, datefmt='%Y-%m-%d %H:%M:%S')
 
@@ -57,13 +183,32 @@ def setup_logging(conf):
                                                   encoding='utf-8')
         fh.setLevel(level[file_level])
         fh.setFormatter(formatter)
-        logger.addHandler(fh)
+        handlers.append(fh)
 
     if console:
         # 实例化一个流式处理器，将日志输出到终端
         ch = logging.StreamHandler()
         ch.setLevel(level[console_level])
         ch.setFormatter(formatter)
-        logger.addHandler(ch)
+        handlers.append(ch)
+
+    if not handlers:
+        logger.setLevel(logging.WARNING)
+        return logger
+
+    # 低于所有处理器等级的记录在调用处即被丢弃，不会创建和入队
+    logger.setLevel(min([handler.level for handler in handlers]))
+
+    # 使用进程间队列，fork出的数据源进程和Wizard进程的日志也由当前进程的写日志线程输出
+    # QueueHandler入队前在调用处合并消息参数（参数不一定能序列化），不能推迟到写日志线程
+    log_queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue,
+                                              *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    # atexit按注册的相反顺序执行，汇总在写日志线程停止之前输出
+    atexit.register(Summary.flush_all)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
     return logger
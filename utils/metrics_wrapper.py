@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: metrics_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 18:30:27
+
+Description: 运行指标，以Prometheus文本格式通过HTTP暴露
+
+指标类型：
+    - Counter: 单调递增的计数器
+    - Gauge: 可增可减的值，也可以在采集时调用函数取值
+    - Histogram: 按桶统计的分布（例如耗时）
+
+记录指标时先用labels()取得并缓存子指标，之后每次记录只是一次加锁的加法
+"""
+
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('DataWizard.utils.metrics_wrapper')
+
+# 默认的耗时桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n',
+                                                     '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{name}="{value}"'.format(name=name, value=_escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append('{name}="{value}"'.format(name=extra[0],
+                                               value=_escape(extra[1])))
+
+    return '{{{pairs}}}'.format(pairs=','.join(pairs)) if pairs else str()
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def collect(self):
+        return self.value
+
+
+class _GaugeChild(_CounterChild):
+    def __init__(self):
+        super().__init__()
+        self._function = None
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """采集时调用function取值"""
+        self._function = function
+
+    def collect(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                logger.error('Metric function error: {text}'.format(text=e))
+                return float('nan')
+        return self.value
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def collect(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Metric(object):
+    """指标，按标签值区分子指标"""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        """初始化方法
+
+        :name: 指标名
+        :documentation: 指标说明
+        :labelnames: 标签名
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = dict()
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """取得标签值对应的子指标（不存在则创建）
+
+        :values: 标签值，顺序与labelnames一致
+        :returns: 子指标
+
+        """
+        values = tuple([str(value) for value in values])
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+
+        return child
+
+    def __getattr__(self, attr):
+        # 没有标签的指标可以直接调用子指标的方法
+        if attr in ('inc', 'dec', 'set', 'set_function', 'observe'):
+            return getattr(self.labels(), attr)
+        raise AttributeError(attr)
+
+    def _samples(self, values, child):
+        yield self.name, _format_labels(self.labelnames,
+                                        values), child.collect()
+
+    def render(self):
+        """以Prometheus文本格式输出"""
+        lines = [
+            '# HELP {name} {doc}'.format(name=self.name,
+                                         doc=self.documentation),
+            '# TYPE {name} {kind}'.format(name=self.name, kind=self.kind)
+        ]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            for name, labels, value in self._samples(values, child):
+                lines.append('{name}{labels} {value}'.format(
+                    name=name, labels=labels, value=_format_value(value)))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _samples(self, values, child):
+        counts, total = child.collect()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), counts):
+            cumulative += count
+            yield '{name}_bucket'.format(name=self.name), _format_labels(
+                self.labelnames, values,
+                ('le', _format_value(bound))), cumulative
+        labels = _format_labels(self.labelnames, values)
+        yield '{name}_sum'.format(name=self.name), labels, total
+        yield '{name}_count'.format(name=self.name), labels, cumulative
+
+
+class Registry(object):
+    """指标注册表"""
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """注册指标，同名指标只注册一次
+
+        :metric: 指标
+        :returns: 已注册的同名指标
+
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """以Prometheus文本格式输出所有指标"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return '\n'.join([metric.render() for metric in metrics]) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(
+        Histogram(name, documentation, labelnames, buckets))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/metrics', '/']:
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('UTF-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_server(host='0.0.0.0', port=9108):
+    """在后台线程中启动指标HTTP服务
+
+    :host: 监听地址
+    :port: 监听端口
+    :returns: HTTP服务对象，启动失败时返回None
+
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.error('Unable to start metrics server on {host}:{port}: '
+                     '{text}'.format(host=host, port=port, text=e))
+        return None
+
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='Metrics',
+                              daemon=True)
+    thread.start()
+    logger.info('Metrics server is listening on {host}:{port}'.format(
+        host=host, port=port))
+
+    return server
@@ -9,15 +9,30 @@ Created Time: 2021-06-02 14:38:24
 Description: 与MQTT Broker进行交互
 """
 
+import asyncio
 import json
 import logging
+import threading
 import time
+from functools import lru_cache
+from multiprocessing import Value
 
 import paho.mqtt.client as Mqtt
 import toml
 
+from utils.batch_wrapper import Chunker, shard
+from utils.log_wrapper import Summary
+
 logger = logging.getLogger('DataWizard.utils.mqtt_wrapper')
 
+# 热路径日志汇总
+RECEIVED_SUMMARY = Summary(
+    logger, 'Received %d messages for (%s) in the last %.0fs')
+DROPPED_SUMMARY = Summary(
+    logger,
+    'Dropped %d messages from (%s): no queue matches, in the last %.0fs',
+    level=logging.WARNING)
+
 # Load configuration file
 confile = 'conf/config.toml'
 config = toml.load(confile)
@@ -50,6 +65,206 @@ RC_PHRASE = {
 }
 
 
+class TopicRouter(object):
+    """MQTT主题路由器
+
+    将消息的实际topic与配置的topic过滤器（支持'+'和'#'通配符）匹配，
+    过滤器预先编译为前缀树，最近的匹配结果使用LRU缓存
+    一个topic匹配多个过滤器时，取配置中最靠前的那个
+    """
+    def __init__(self, filters, cache_size=4096):
+        """初始化方法
+
+        :filters: topic过滤器列表，例如：['device/+/data', 'device/#']
+        :cache_size: 匹配结果缓存的最大条目数
+
+        """
+        self._filters = list(filters)
+        # 前缀树节点：[{层级名: 子节点}, [以该节点结尾的过滤器序号]]
+        self._trie = [dict(), list()]
+        for index, topic_filter in enumerate(self._filters):
+            node = self._trie
+            for level in topic_filter.split('/'):
+                node = node[0].setdefault(level, [dict(), list()])
+            node[1].append(index)
+
+        self.route = lru_cache(maxsize=cache_size)(self._match)
+
+    def _search(self, node, levels, depth, matches):
+        """在前缀树中查找与topic匹配的过滤器
+
+        :node: 当前节点
+        :levels: topic的各层级
+        :depth: 当前层级深度
+        :matches: 匹配到的过滤器序号
+
+        """
+        children = node[0]
+        # '$'开头的topic（例如$SYS）不与首层的通配符匹配
+        wildcard = depth > 0 or not levels[0].startswith('$')
+
+        # '#'匹配当前及之后的所有层级（包括父层级本身）
+        if wildcard and '#' in children:
+            matches.extend(children['#'][1])
+        if depth == len(levels):
+            matches.extend(node[1])
+            return
+
+        child = children.get(levels[depth])
+        if child is not None:
+            self._search(child, levels, depth + 1, matches)
+        if wildcard and '+' in children:
+            self._search(children['+'], levels, depth + 1, matches)
+
+    def _match(self, topic):
+        """匹配topic
+
+        :topic: 消息的实际topic
+        :returns: 匹配到的topic过滤器，没有匹配时返回None
+
+        """
+        matches = list()
+        self._search(self._trie, topic.split('/'), 0, matches)
+
+        return self._filters[min(matches)] if matches else None
+
+
+class AsyncioHelper(object):
+    """在asyncio事件循环中驱动paho客户端
+
+    paho在socket打开/关闭、需要写入时调用对应回调，将socket注册到事件循环，
+    可读/可写时调用loop_read/loop_write，心跳等定时任务（loop_misc）每秒执行一次，
+    因此不需要paho的网络线程
+    """
+    def __init__(self, loop, client):
+        """初始化方法
+
+        :loop: asyncio事件循环
+        :client: paho客户端
+
+        """
+        self.loop = loop
+        self.client = client
+        self.misc = None
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        """执行心跳和重传，连接断开时退出"""
+        while self.client.loop_misc() == Mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class FlowControl(object):
+    """按队列水位暂停/恢复订阅
+
+    某个队列的深度达到高水位时取消订阅对应的topic，降到低水位时重新订阅，
+    期间MQTT连接和会话保持（心跳照常），暂停时长累计到共享计数器中
+    暂停期间每次检查都将新增的时长计入共享计数器，其他进程读到的值包括正在进行中的暂停
+    暂停通过取消订阅实现：Broker不会为已取消的订阅保留消息，暂停期间发布到该topic的消息会丢失
+    （与QoS和clean_session无关），流控是以丢弃上游消息为代价保护本进程的内存
+    """
+    def __init__(self, client, depths, high, low, paused=None):
+        """初始化方法
+
+        :client: paho客户端
+        :depths: 获取队列深度的函数字典：{'topic': 函数}
+        :high: 高水位，队列深度达到该值时暂停订阅
+        :low: 低水位，队列深度降到该值时恢复订阅
+        :paused: 累计暂停时长（秒）的共享计数器字典：{'topic': multiprocessing.Value('d')}
+
+        """
+        self.client = client
+        self.depths = depths
+        self.high = max(int(high), 1)
+        self.low = min(max(int(low), 0), self.high - 1)
+        self.paused = dict(paused or dict())
+        # 未提供共享计数器的topic使用本地计数器
+        for topic in self.depths:
+            if topic not in self.paused:
+                self.paused[topic] = Value('d', 0.0)
+
+        # 正在暂停的topic及暂停开始时刻：{'topic': time.monotonic()}
+        self._since = dict()
+        # 正在暂停的topic已计入共享计数器的时刻：{'topic': time.monotonic()}
+        self._mark = dict()
+        self._lock = threading.Lock()
+
+    def is_paused(self, topic):
+        return topic in self._since
+
+    def paused_time(self, topic):
+        """topic累计暂停时长（秒），包括正在进行中的暂停"""
+        total = self.paused[topic].value if topic in self.paused else 0
+        mark = self._mark.get(topic)
+        if mark is not None:
+            total += time.monotonic() - mark
+
+        return total
+
+    def _account(self, topic, now):
+        """将topic上次计入之后的暂停时长计入共享计数器（调用者须持有锁）"""
+        mark = self._mark.get(topic)
+        if mark is None:
+            return
+        self._mark[topic] = now
+        with self.paused[topic].get_lock():
+            self.paused[topic].value += now - mark
+
+    def check(self):
+        """检查各队列水位，必要时暂停或恢复订阅"""
+        with self._lock:
+            for topic, depth in self.depths.items():
+                size = depth()
+                since = self._since.get(topic)
+                now = time.monotonic()
+                if since is not None:
+                    self._account(topic, now)
+                if since is None and size >= self.high:
+                    self.client.unsubscribe(topic)
+                    self._since[topic] = self._mark[topic] = now
+                    logger.warning('Queue ({topic}) reached the high watermark '
+                                   '({size} >= {high}), pause intake'.format(
+                                       topic=topic, size=size, high=self.high))
+                elif since is not None and size <= self.low:
+                    self.client.subscribe(topic=topic, qos=QOS)
+                    duration = now - since
+                    del self._since[topic]
+                    del self._mark[topic]
+                    logger.warning('Queue ({topic}) fell to the low watermark '
+                                   '({size} <= {low}), resume intake after '
+                                   '{duration:.3f}s, total paused = '
+                                   '{total:.3f}s'.format(
+                                       topic=topic,
+                                       size=size,
+                                       low=self.low,
+                                       duration=duration,
+                                       total=self.paused_time(topic)))
+
+    def run(self, interval=0.05):
+        """周期性地检查队列水位（阻塞）"""
+        while True:
+            self.check()
+            time.sleep(interval)
+
+
 def __on_connect(client, userdata, flags, reasonCode):
     if reasonCode == 0:
         logger.info('Connected to MQTT Broker')
@@ -107,7 +322,7 @@ def publisher(message):
                 result = client.publish(topic=topic, payload=payload, qos=QOS)
                 status = result[0]
                 if status == 0:
-                    logger.info('Send message to topic ({})'.format(topic))
+                    logger.debug('Send message to topic (%s)', topic)
                 else:
                     logger.error(
                         'Failed to send message to topic ({})'.format(topic))
@@ -117,32 +332,72 @@ def publisher(message):
         time.sleep(2)
 
 
-def subscriber(queues):
+def subscriber(queues,
+               chunk_size=1,
+               chunk_linger=0.005,
+               high=None,
+               low=None,
+               paused=None,
+               limit=0):
     """订阅者，从MQTT Broker指定主题订阅消息
 
     :queues: 队列字典，须topic和queue对应，例如：{'topic': Queue()}
+             多进程模式下值为分片队列列表，例如：{'topic': [Queue(), Queue()]}
+    :chunk_size: 每个数据块的最大消息数，不大于1时每条消息单独放入队列
+    :chunk_linger: 数据块中第一条消息的最长等待时间（秒）
+    :high: 高水位，队列深度达到该值时暂停订阅对应topic，None表示不做流控
+    :low: 低水位，队列深度降到该值时恢复订阅
+    :paused: 累计暂停时长（秒）的共享计数器字典：{'topic': multiprocessing.Value('d')}
+    :limit: 队列已满时每个队列在本地最多暂存的数据或数据块个数，不大于0表示不限制
     """
 
+    router = TopicRouter(filters=TOPICS)
+    chunkers = dict()
+    for name, queue in queues.items():
+        shards = queue if isinstance(queue, list) else [queue]
+        chunkers[name] = [
+            Chunker(name='{name}[{index}]'.format(name=name, index=index)
+                    if len(shards) > 1 else name,
+                    queue=shard_queue,
+                    size=chunk_size,
+                    linger=chunk_linger,
+                    limit=limit)
+            for index, shard_queue in enumerate(shards)
+        ]
+
     def on_message(client, userdata, message):
         # 获取实际topic名
         topic = message.topic
-        # 获取配置中的topic名（即队列名）
-        for queue_name in TOPICS:
-            msg = message.payload
-            logger.info(
-                'Received message from ({topic}) topic'.format(topic=topic))
-
-            topic_queue = queues.get(queue_name)
-            topic_queue.put(msg)
-            size = topic_queue.qsize()
-            logger.info(
-                'Put the message in the queue, queue size = {size}'.format(
-                    size=size))
-
-            # 队列大小检测
-            if topic_queue.full():
-                logger.error('Queue {name} is full, so it is blocking'.format(
-                    name=queue_name))
+
+        # 获取与之匹配的配置中的topic名（即队列名），每条消息只进入一个队列
+        queue_name = router.route(topic)
+        if queue_name is None:
+            DROPPED_SUMMARY.add(topic, 1)
+            return
+        RECEIVED_SUMMARY.add(queue_name, 1)
+
+        # 按deviceid选择分片，攒成数据块后放入队列
+        shards = chunkers[queue_name]
+        index = shard(payload=message.payload,
+                      fallback=topic,
+                      count=len(shards))
+        shards[index].put(message.payload)
+
+    # 队列水位流控，分片队列取其中最深的
+    flow = None
+    if high is not None:
+        flow = FlowControl(
+            client=client,
+            depths={
+                name: (lambda shards=shards: max(
+                    [chunker.depth() for chunker in shards]))
+                for name, shards in chunkers.items()
+            },
+            high=high,
+            low=low if low is not None else high // 2,
+            paused=paused)
+        threading.Thread(target=flow.run, name='FlowControl',
+                         daemon=True).start()
 
     client.on_message = on_message
     client.loop_start()
@@ -150,8 +405,85 @@ def subscriber(queues):
     while True:
         if client._state != 2:
             for topic in TOPICS:
-                client.subscribe(topic=topic, qos=QOS)
+                # 暂停中的topic由流控恢复订阅
+                if flow is None or not flow.is_paused(topic):
+                    client.subscribe(topic=topic, qos=QOS)
         else:
             logger.warning('MQTT connection lost, reconnecting...')
             __reconnect()
         time.sleep(2)
+
+
+async def async_subscriber(handler,
+                           depths=None,
+                           high=None,
+                           low=None,
+                           paused=None):
+    """订阅者（asyncio版），在当前事件循环中从MQTT Broker指定主题订阅消息
+
+    :handler: 消息处理函数，参数为(队列名, 原始数据)，在事件循环中被调用，不能阻塞
+    :depths: 获取队列深度的函数字典：{'topic': 函数}，用于流控
+    :high: 高水位，队列深度达到该值时暂停订阅对应topic，None表示不做流控
+    :low: 低水位，队列深度降到该值时恢复订阅
+    :paused: 累计暂停时长（秒）的共享计数器字典：{'topic': multiprocessing.Value('d')}
+    """
+
+    router = TopicRouter(filters=TOPICS)
+
+    def on_message(client, userdata, message):
+        # 获取实际topic名
+        topic = message.topic
+
+        # 获取与之匹配的配置中的topic名（即队列名），每条消息只进入一个队列
+        queue_name = router.route(topic)
+        if queue_name is None:
+            DROPPED_SUMMARY.add(topic, 1)
+            return
+        RECEIVED_SUMMARY.add(queue_name, 1)
+
+        handler(queue_name, message.payload)
+
+    # 队列水位流控
+    # 事件循环只弱引用任务，须保留流控任务的引用，否则可能被垃圾回收，订阅者退出时取消
+    flow = None
+    flow_task = None
+    if high is not None and depths:
+        flow = FlowControl(client=client,
+                           depths=depths,
+                           high=high,
+                           low=low if low is not None else high // 2,
+                           paused=paused)
+
+        async def watch():
+            while True:
+                flow.check()
+                await asyncio.sleep(0.05)
+
+        flow_task = asyncio.create_task(watch())
+
+    client.on_message = on_message
+    AsyncioHelper(loop=asyncio.get_running_loop(), client=client)
+
+    # 模块导入时建立的连接没有注册到事件循环，需重新连接
+    try:
+        client.reconnect()
+    except Exception as e:
+        logger.error('MQTT connection error: {}'.format(e))
+
+    try:
+        while True:
+            if client._state != 2 and client.socket() is not None:
+                for topic in TOPICS:
+                    # 暂停中的topic由流控恢复订阅
+                    if flow is None or not flow.is_paused(topic):
+                        client.subscribe(topic=topic, qos=QOS)
+            else:
+                logger.warning('MQTT connection lost, reconnecting...')
+                try:
+                    client.reconnect()
+                except Exception as e:
+                    logger.error('MQTT connection error: {}'.format(e))
+            await asyncio.sleep(2)
+    finally:
+        if flow_task is not None:
+            flow_task.cancel()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: retry_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 17:48:51
+
+Description: 写入失败的批数据的重试队列和死信存储
+
+重试间隔按指数退避：backoff * 2^(attempts - 1)，不超过max_backoff
+重试max_attempts次仍失败（或重试队列已满）的批数据转入死信存储（JSON Lines文件或数据表）
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('DataWizard.utils.retry_wrapper')
+
+
+class RetryQueue(object):
+    """按到期时间排序的有界重试队列"""
+    def __init__(self, max_size=1000, backoff=1, max_backoff=60):
+        """初始化方法
+
+        :max_size: 队列中最多容纳的批数
+        :backoff: 第一次重试的等待时间（秒）
+        :max_backoff: 最长等待时间（秒）
+
+        """
+        self.max_size = max(int(max_size), 1)
+        self.backoff = max(float(backoff), 0)
+        self.max_backoff = max(float(max_backoff), self.backoff)
+
+        # 堆元素：(到期时刻, 序号, 物料, 已尝试次数, 失败原因)
+        self._heap = list()
+        self._counter = itertools.count()
+        self._ready = threading.Condition()
+
+    def __len__(self):
+        with self._ready:
+            return len(self._heap)
+
+    def delay(self, attempts):
+        """第attempts次失败后的等待时间（秒）"""
+        return min(self.backoff * 2**(max(attempts, 1) - 1), self.max_backoff)
+
+    def push(self, material, attempts, reason):
+        """加入一个失败的批
+
+        :material: 一个字典，数据入库用到的物料
+        :attempts: 已尝试次数
+        :reason: 最近一次失败的原因
+        :returns: 队列已满时返回False
+
+        """
+        due = time.monotonic() + self.delay(attempts)
+        with self._ready:
+            if len(self._heap) >= self.max_size:
+                return False
+            heapq.heappush(
+                self._heap,
+                (due, next(self._counter), material, attempts, reason))
+            self._ready.notify()
+
+        return True
+
+    def pop(self, timeout=None):
+        """取出一个已到期的批，没有到期的批时阻塞
+
+        :timeout: 最长等待时间（秒），None表示一直等待
+        :returns: (物料, 已尝试次数, 失败原因)，超时返回None
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._ready:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    _, _, material, attempts, reason = heapq.heappop(
+                        self._heap)
+                    return material, attempts, reason
+
+                wait = self._heap[0][0] - now if self._heap else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = deadline - now if wait is None else min(
+                        wait, deadline - now)
+                self._ready.wait(wait)
+
+
+class DeadLetterFile(object):
+    """以JSON Lines格式追加写入的死信文件"""
+    def __init__(self, filename):
+        """初始化方法
+
+        :filename: 死信文件名
+
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+
+        dir_path = os.path.dirname(filename)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+    def write(self, material, attempts, reason):
+        """写入一个死信
+
+        :material: 一个字典，数据入库用到的物料
+        :attempts: 已尝试次数
+        :reason: 最近一次失败的原因
+
+        """
+        line = json.dumps(
+            {
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'schema': material.get('schema', 'public'),
+                'table': material.get('table', 'example'),
+                'attempts': attempts,
+                'reason': str(reason),
+                'material': material,
+            },
+            ensure_ascii=False,
+            default=str)
+        with self._lock:
+            with open(self.filename, 'a', encoding='UTF-8') as f:
+                f.write(line + '\n')
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: ring_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 13:41:06
+
+Description: 基于共享内存的环形缓冲区，用于数据源进程和Wizard进程之间传递原始数据
+
+与multiprocessing.Queue相比，数据不经过pickle和管道（也没有feeder线程），
+原始bytes以'4字节长度 + 数据'的形式直接写入共享内存，读取时只复制一次
+"""
+
+import atexit
+import logging
+import os
+import struct
+import time
+from multiprocessing import Condition, Lock, shared_memory
+from queue import Empty, Full
+
+from utils.log_wrapper import Summary
+
+logger = logging.getLogger('DataWizard.utils.ring_wrapper')
+
+# 热路径日志汇总
+REJECTED_SUMMARY = Summary(
+    logger,
+    'Rejected %d records larger than the ring buffer (%s bytes) '
+    'in the last %.0fs',
+    level=logging.ERROR)
+
+# 共享内存头部：写入位置(head)、读取位置(tail)、记录数(count)、拒绝的记录数(rejected)，
+# 位置单调递增
+HEADER = struct.Struct('QQQQ')
+# 每条记录的长度前缀
+LENGTH = struct.Struct('I')
+
+
+class RingBuffer(object):
+    """共享内存环形缓冲区
+
+    接口与multiprocessing.Queue一致（put/get/qsize/full/empty），
+    容量以字节计，写满时put阻塞，为空时get阻塞
+    单条记录超过容量时不写入，记录日志并计数（见rejected）
+    """
+    def __init__(self, size):
+        """初始化方法
+
+        :size: 缓冲区容量（字节）
+
+        """
+        self._size = int(size)
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=HEADER.size + self._size)
+        HEADER.pack_into(self._shm.buf, 0, 0, 0, 0, 0)
+
+        # 读写共用一把锁，两个条件变量分别通知'有数据'和'有空间'
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+
+        # 只由创建者进程在退出时释放共享内存
+        self._owner = os.getpid()
+        atexit.register(self.release)
+
+    def _header(self):
+        return HEADER.unpack_from(self._shm.buf, 0)
+
+    @staticmethod
+    def _remaining(deadline):
+        """距离deadline的剩余秒数，deadline为None时返回None"""
+        if deadline is None:
+            return None
+        return max(deadline - time.monotonic(), 0)
+
+    def _copy_in(self, position, data):
+        """从position开始写入数据，到达末尾时绕回开头"""
+        buf = self._shm.buf
+        offset = position % self._size
+        first = min(len(data), self._size - offset)
+        buf[HEADER.size + offset:HEADER.size + offset + first] = data[:first]
+        if first < len(data):
+            buf[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+    def _copy_out(self, position, length):
+        """从position开始读出length字节，到达末尾时绕回开头"""
+        buf = self._shm.buf
+        offset = position % self._size
+        first = min(length, self._size - offset)
+        data = bytes(buf[HEADER.size + offset:HEADER.size + offset + first])
+        if first < length:
+            data += bytes(buf[HEADER.size:HEADER.size + length - first])
+
+        return data
+
+    def put(self, item, block=True, timeout=None):
+        """写入记录
+
+        :item: bytes类型的原始数据，或多条原始数据组成的列表（数据块）
+               数据块中的记录在一次加锁内写入，读出时逐条返回
+        :block: 空间不足时是否阻塞
+        :timeout: 最长阻塞时间（秒），None表示一直阻塞
+        :returns: 已处理（写入或拒绝）的记录数
+                  数据块超过缓冲区容量时逐条写入，空间不足时只写入前若干条并返回其条数，
+                  调用者应保留其余的记录；一条都未写入时抛出Full
+
+        """
+        records = [bytes(data) for data in item] if isinstance(
+            item, list) else [bytes(item)]
+        need = sum([LENGTH.size + len(data) for data in records])
+        if need > self._size:
+            if len(records) == 1:
+                # 超过缓冲区容量的记录永远无法写入，直接拒绝，不向调用者（paho网络线程）抛出异常
+                self._reject(1)
+                return 1
+            # 数据块超过缓冲区容量则逐条写入
+            done = 0
+            for data in records:
+                try:
+                    self.put(data, block=block, timeout=timeout)
+                except Full:
+                    if not done:
+                        raise
+                    return done
+                done += 1
+            return done
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._not_full:
+            while True:
+                head, tail, count, rejected = self._header()
+                if self._size - (head - tail) >= need:
+                    break
+                remaining = self._remaining(deadline)
+                if not block or remaining == 0:
+                    raise Full
+                self._not_full.wait(remaining)
+
+            position = head
+            for data in records:
+                self._copy_in(position, LENGTH.pack(len(data)))
+                self._copy_in(position + LENGTH.size, data)
+                position += LENGTH.size + len(data)
+            HEADER.pack_into(self._shm.buf, 0, position, tail,
+                             count + len(records), rejected)
+            self._not_empty.notify(len(records))
+
+        return len(records)
+
+    def get(self, block=True, timeout=None):
+        """读出一条记录
+
+        :block: 没有数据时是否阻塞
+        :timeout: 最长阻塞时间（秒），None表示一直阻塞
+        :returns: bytes类型的原始数据
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._not_empty:
+            while True:
+                head, tail, count, rejected = self._header()
+                if count:
+                    break
+                remaining = self._remaining(deadline)
+                if not block or remaining == 0:
+                    raise Empty
+                self._not_empty.wait(remaining)
+
+            (length, ) = LENGTH.unpack(self._copy_out(tail, LENGTH.size))
+            data = self._copy_out(tail + LENGTH.size, length)
+            HEADER.pack_into(self._shm.buf, 0, head,
+                             tail + LENGTH.size + length, count - 1, rejected)
+            self._not_full.notify()
+
+        return data
+
+    def _reject(self, number):
+        """记录被拒绝的记录数
+
+        :number: 记录数
+
+        """
+        with self._lock:
+            head, tail, count, rejected = self._header()
+            HEADER.pack_into(self._shm.buf, 0, head, tail, count,
+                             rejected + number)
+        REJECTED_SUMMARY.add(self._size, number)
+
+    def rejected(self):
+        """因超过缓冲区容量而被拒绝的记录数"""
+        return self._header()[3]
+
+    def qsize(self):
+        """缓冲区中的记录数"""
+        return self._header()[2]
+
+    def nbytes(self):
+        """缓冲区已用字节数"""
+        head, tail, _, _ = self._header()
+        return head - tail
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        """剩余空间不足以容纳一条平均大小的记录时视为已满"""
+        head, tail, count, _ = self._header()
+        used = head - tail
+        average = used // count if count else LENGTH.size
+        return self._size - used < max(average, LENGTH.size + 1)
+
+    def release(self):
+        """关闭共享内存，创建者进程同时将其删除"""
+        try:
+            self._shm.close()
+            if os.getpid() == self._owner:
+                self._shm.unlink()
+        except (FileNotFoundError, BufferError):
+            pass
+        except Exception as e:
+            logger.error('Unable to release ring buffer: {text}'.format(
+                text=e))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: scale_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 16:20:35
+
+Description: 持久化worker的自动伸缩
+
+每隔interval秒按topic检查以下指标，在[min_workers, max_workers]之间增减worker：
+    1. 队列深度：队列中待处理的数据条数（或数据块数）
+    2. 繁忙度：worker在flush上花费的时间占比，由flush耗时统计得出
+    3. 数据库往返时间：SELECT 1的耗时，数据库变慢时增加worker无济于事，暂停扩容
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger('DataWizard.utils.scale_wrapper')
+
+
+class Autoscaler(object):
+    """按topic自动伸缩持久化worker
+
+    每个worker是一个线程，各持有一个停止事件，缩容时设置最新worker的停止事件，
+    worker将批内剩余数据入库后退出
+    """
+    def __init__(self,
+                 topics,
+                 spawn,
+                 depth,
+                 ping,
+                 min_workers=1,
+                 max_workers=10,
+                 interval=5,
+                 high=100,
+                 low=0,
+                 busy=0.8,
+                 idle=0.3,
+                 rtt_limit=0.5):
+        """初始化方法
+
+        :topics: topic列表
+        :spawn: 启动worker的函数，参数为(topic, 停止事件)，返回线程对象
+        :depth: 获取队列深度的函数，参数为topic
+        :ping: 测量数据库往返时间的函数，返回秒数，出错或超时时返回None
+               （须有超时，否则数据库不可用时伸缩检查会被阻塞）
+        :min_workers: 每个topic的最小worker数
+        :max_workers: 每个topic的最大worker数
+        :interval: 检查间隔（秒）
+        :high: 队列深度超过该值时扩容
+        :low: 队列深度不超过该值时才允许缩容
+        :busy: 繁忙度超过该值时扩容
+        :idle: 繁忙度低于该值时缩容
+        :rtt_limit: 数据库往返时间超过该值（秒）时暂停扩容
+
+        """
+        self.topics = list(topics)
+        self.spawn = spawn
+        self.depth = depth
+        self.ping = ping
+        self.min_workers = max(int(min_workers), 1)
+        self.max_workers = max(int(max_workers), self.min_workers)
+        self.interval = max(float(interval), 0.1)
+        self.high = high
+        self.low = low
+        self.busy = busy
+        self.idle = idle
+        self.rtt_limit = rtt_limit
+
+        # 各topic的worker：{topic: [(线程, 停止事件), ...]}
+        self._workers = {topic: list() for topic in self.topics}
+        # 各topic在本周期内的flush耗时之和与次数：{topic: [耗时, 次数]}
+        self._flushes = {topic: [0.0, 0] for topic in self.topics}
+        self._lock = threading.Lock()
+        # 各topic上一周期暂停扩容的原因，只在原因变化时记录WARNING：{topic: 原因}
+        self._holds = dict()
+
+    def observe(self, topic, cost):
+        """记录一次flush的耗时，由worker在flush后调用
+
+        :topic: topic name
+        :cost: flush耗时（秒）
+
+        """
+        with self._lock:
+            stats = self._flushes.setdefault(topic, [0.0, 0])
+            stats[0] += cost
+            stats[1] += 1
+
+    def workers(self, topic):
+        """topic当前存活的worker数"""
+        return len(self._workers.get(topic, list()))
+
+    def _grow(self, topic):
+        stop = threading.Event()
+        self._workers[topic].append((self.spawn(topic, stop), stop))
+
+    def _shrink(self, topic):
+        _, stop = self._workers[topic].pop()
+        stop.set()
+
+    def _reap(self, topic):
+        """清理意外退出的worker"""
+        alive = [(task, stop) for task, stop in self._workers[topic]
+                 if task.is_alive()]
+        if len(alive) < len(self._workers[topic]):
+            logger.error('{count} worker(s) of ({topic}) exited '
+                         'unexpectedly'.format(count=len(self._workers[topic]) -
+                                               len(alive),
+                                               topic=topic))
+        self._workers[topic] = alive
+
+    def start(self):
+        """为每个topic启动min_workers个worker"""
+        for topic in self.topics:
+            for _ in range(self.min_workers):
+                self._grow(topic)
+        logger.info('Autoscaler started with {count} worker(s) per topic, '
+                    'bounds = [{min}, {max}]'.format(count=self.min_workers,
+                                                     min=self.min_workers,
+                                                     max=self.max_workers))
+
+    def step(self, rtt):
+        """执行一个周期的伸缩检查
+
+        :rtt: 数据库往返时间（秒），None表示数据库不可用
+
+        """
+        with self._lock:
+            flushes = self._flushes
+            self._flushes = {topic: [0.0, 0] for topic in self.topics}
+
+        for topic in self.topics:
+            self._reap(topic)
+            workers = self.workers(topic)
+            depth = self.depth(topic)
+            cost, count = flushes.get(topic, [0.0, 0])
+            busy = cost / (self.interval * max(workers, 1))
+            latency = cost / count if count else 0
+            metrics = ('depth = {depth}, busy = {busy:.2f}, '
+                       'flush latency = {latency:.3f}s, rtt = {rtt}'.format(
+                           depth=depth,
+                           busy=busy,
+                           latency=latency,
+                           rtt='n/a' if rtt is None else '{:.3f}s'.format(rtt)))
+
+            if workers < self.min_workers:
+                # 补齐意外退出的worker
+                while self.workers(topic) < self.min_workers:
+                    self._grow(topic)
+                logger.warning('Scale ({topic}) {old} -> {new}: below minimum '
+                               '({metrics})'.format(topic=topic,
+                                                    old=workers,
+                                                    new=self.workers(topic),
+                                                    metrics=metrics))
+            elif depth > self.high or busy > self.busy:
+                if workers >= self.max_workers:
+                    self._hold(topic, workers, 'reached maximum', metrics)
+                    continue
+                elif rtt is None or rtt > self.rtt_limit:
+                    self._hold(topic, workers, 'database is slow or '
+                               'unavailable', metrics)
+                    continue
+                else:
+                    self._grow(topic)
+                    logger.warning('Scale ({topic}) {old} -> {new}: backlog '
+                                   '({metrics})'.format(topic=topic,
+                                                        old=workers,
+                                                        new=workers + 1,
+                                                        metrics=metrics))
+            elif depth <= self.low and busy < self.idle and \
+                    workers > self.min_workers:
+                self._shrink(topic)
+                logger.warning('Scale ({topic}) {old} -> {new}: idle '
+                               '({metrics})'.format(topic=topic,
+                                                    old=workers,
+                                                    new=workers - 1,
+                                                    metrics=metrics))
+            else:
+                logger.debug('Hold ({topic}) at {old} ({metrics})'.format(
+                    topic=topic, old=workers, metrics=metrics))
+            self._holds.pop(topic, None)
+
+    def _hold(self, topic, workers, reason, metrics):
+        """积压但无法扩容，原因变化时记录WARNING，否则记录DEBUG
+
+        :topic: 主题
+        :workers: 当前worker数
+        :reason: 暂停扩容的原因
+        :metrics: 指标描述
+
+        """
+        message = 'Hold ({topic}) at {old}: {reason} ({metrics})'.format(
+            topic=topic, old=workers, reason=reason, metrics=metrics)
+        if self._holds.get(topic) == reason:
+            logger.debug(message)
+        else:
+            self._holds[topic] = reason
+            logger.warning(message)
+
+    def run(self):
+        """启动worker并周期性地执行伸缩检查（阻塞）"""
+        self.start()
+        while True:
+            time.sleep(self.interval)
+            self.step(rtt=self.ping())
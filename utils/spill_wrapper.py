@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+File: spill_wrapper.py
+Author: YJ
+Email: yj1516268@outlook.com
+Created Time: 2026-10-16 17:05:12
+
+Description: 磁盘溢写日志，数据库不可用或过慢时暂存入库物料，恢复后按顺序回放
+
+溢写日志由若干只追加的段文件（spill-<序号>.log）组成，每条记录的格式为：
+    4字节长度 + 4字节CRC32 + 数据（JSON，可选zlib压缩）
+当前段达到segment_size时封存并新建下一段，总大小超过max_size时丢弃最旧的段
+回放时以只读内存映射读取封存的段，全部回放成功后删除该段
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger('DataWizard.utils.spill_wrapper')
+
+# 记录头：数据长度、CRC32
+RECORD = struct.Struct('>II')
+# 段文件名
+SEGMENT = 'spill-{seq:010d}.log'
+
+
+class SpillLog(object):
+    """基于段文件的溢写日志
+
+    写入和回放可以在不同线程中同时进行：写入只追加当前段，回放只读取已封存的段
+    回放保证至少一次：回放中途失败的段会在下次从失败的记录处继续，
+    但进程重启后会从段的开头重新回放
+    """
+    def __init__(self,
+                 path,
+                 segment_size=64 * 1024 * 1024,
+                 max_size=1024 * 1024 * 1024,
+                 compress=True):
+        """初始化方法
+
+        :path: 段文件所在目录
+        :segment_size: 单个段文件的大小上限（字节）
+        :max_size: 所有段文件的总大小上限（字节）
+        :compress: 是否使用zlib压缩记录
+
+        """
+        self.path = path
+        self.segment_size = max(int(segment_size), RECORD.size + 1)
+        self.max_size = max(int(max_size), self.segment_size)
+        self.compress = compress
+
+        # 已封存的段：[[序号, 字节数, 记录数], ...]，按序号排序
+        self._sealed = list()
+        # 最旧的段中已回放的位置和记录数
+        self._offset = 0
+        self._replayed = 0
+        # 当前段
+        self._seq = 0
+        self._file = None
+        self._bytes = 0
+        self._records = 0
+        # 因超出max_size被丢弃的记录数
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+        self._recover()
+
+    def _segment(self, seq):
+        return os.path.join(self.path, SEGMENT.format(seq=seq))
+
+    def _recover(self):
+        """加载上次运行遗留的段文件，全部视为已封存"""
+        for name in sorted(os.listdir(self.path)):
+            if not (name.startswith('spill-') and name.endswith('.log')):
+                continue
+            seq = int(name[len('spill-'):-len('.log')])
+            size, count = self._scan(self._segment(seq))
+            if count:
+                self._sealed.append([seq, size, count])
+            else:
+                os.remove(self._segment(seq))
+            self._seq = max(self._seq, seq + 1)
+
+        if self._sealed:
+            logger.warning('Recovered {records} spilled records in {segments} '
+                           'segments ({size} bytes)'.format(**self.backlog()))
+
+    @staticmethod
+    def _scan(filename):
+        """统计段文件中完整记录的字节数和记录数，忽略末尾不完整的记录
+
+        :filename: 段文件名
+        :returns: (字节数, 记录数)
+
+        """
+        size = count = 0
+        with open(filename, 'rb') as f:
+            while True:
+                head = f.read(RECORD.size)
+                if len(head) < RECORD.size:
+                    break
+                length, _ = RECORD.unpack(head)
+                if len(f.read(length)) < length:
+                    break
+                size += RECORD.size + length
+                count += 1
+
+        return size, count
+
+    def _encode(self, material):
+        data = json.dumps(material, ensure_ascii=False,
+                          default=str).encode('UTF-8')
+        if self.compress:
+            data = zlib.compress(data, 1)
+
+        return data
+
+    def _decode(self, data):
+        if self.compress:
+            data = zlib.decompress(data)
+        material = json.loads(data)
+        material['columns'] = tuple(material.get('columns', tuple()))
+
+        return material
+
+    def _seal(self):
+        """封存当前段（调用者须持有锁）"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self._records:
+            self._sealed.append([self._seq, self._bytes, self._records])
+        else:
+            os.remove(self._segment(self._seq))
+        self._seq += 1
+        self._bytes = 0
+        self._records = 0
+
+    def _trim(self):
+        """总大小超过max_size时丢弃最旧的段（调用者须持有锁）"""
+        while self._sealed and self.size() > self.max_size:
+            seq, _, count = self._sealed.pop(0)
+            dropped = count - self._replayed
+            self._offset = 0
+            self._replayed = 0
+            self.dropped += dropped
+            try:
+                os.remove(self._segment(seq))
+            except FileNotFoundError:
+                pass
+            logger.error('Spill log exceeds {max} bytes, dropped {count} '
+                         'records in the oldest segment'.format(
+                             max=self.max_size, count=dropped))
+
+    def append(self, material):
+        """追加一个入库物料
+
+        :material: 一个字典，数据入库用到的物料
+
+        """
+        data = self._encode(material)
+        record = RECORD.pack(len(data), zlib.crc32(data)) + data
+
+        with self._lock:
+            if self._file is not None and \
+                    self._bytes + len(record) > self.segment_size:
+                self._seal()
+            if self._file is None:
+                self._file = open(self._segment(self._seq), 'ab')
+            self._file.write(record)
+            self._file.flush()
+            self._bytes += len(record)
+            self._records += 1
+            self._trim()
+
+    def size(self):
+        """所有段文件的总字节数"""
+        return sum([size for _, size, _ in self._sealed]) + self._bytes
+
+    def backlog(self):
+        """待回放的数据量
+
+        :returns: 字典，结构为：
+                  {
+                      'records': 待回放的记录数,
+                      'segments': 段文件数,
+                      'size': 段文件总字节数,
+                      'dropped': 因超出max_size被丢弃的记录数,
+                  }
+
+        """
+        with self._lock:
+            return {
+                'records':
+                sum([count for _, _, count in self._sealed]) - self._replayed +
+                self._records,
+                'segments':
+                len(self._sealed) + (1 if self._file is not None else 0),
+                'size':
+                self.size(),
+                'dropped':
+                self.dropped,
+            }
+
+    def __len__(self):
+        return self.backlog()['records']
+
+    def replay(self, handler):
+        """按写入顺序回放所有记录
+
+        先封存当前段，再逐段读取，handler成功处理一个段的所有记录后删除该段
+        handler抛出异常时停止回放，下次从失败的记录处继续，
+        因此handler应自行处理物料本身导致的错误，只在需要稍后重试时抛出异常
+        校验失败或无法解码的记录被跳过
+
+        :handler: 处理函数，参数为入库物料
+        :returns: 本次回放的记录数
+
+        """
+        with self._lock:
+            self._seal()
+
+        replayed = 0
+        while True:
+            with self._lock:
+                if not self._sealed:
+                    break
+                seq, size, count = self._sealed[0]
+
+            filename = self._segment(seq)
+            with open(filename, 'rb') as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                while True:
+                    with self._lock:
+                        # 回放期间该段可能因超出max_size已被丢弃
+                        if not self._sealed or self._sealed[0][0] != seq or \
+                                self._offset >= size:
+                            break
+                        offset = self._offset
+
+                    length, crc = RECORD.unpack_from(buf, offset)
+                    start = offset + RECORD.size
+                    data = buf[start:start + length]
+                    material = None
+                    if zlib.crc32(data) != crc:
+                        logger.error('Corrupted spill record in {name} at '
+                                     '{offset}, skipped'.format(name=filename,
+                                                                offset=offset))
+                    else:
+                        try:
+                            material = self._decode(data)
+                        except (ValueError, zlib.error) as e:
+                            logger.error('Undecodable spill record in {name} '
+                                         'at {offset}, skipped: {text}'.format(
+                                             name=filename,
+                                             offset=offset,
+                                             text=e))
+                    if material is not None:
+                        handler(material)
+                        replayed += 1
+
+                    with self._lock:
+                        if self._sealed and self._sealed[0][0] == seq:
+                            self._offset = start + length
+                            self._replayed += 1
+
+            with self._lock:
+                if self._sealed and self._sealed[0][0] == seq:
+                    self._sealed.pop(0)
+                    self._offset = 0
+                    self._replayed = 0
+                    os.remove(filename)
+
+        return replayed